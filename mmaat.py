@@ -23,7 +23,7 @@ from PyQt4 import QtCore, QtGui
 
 from mmaat import ICONS_PATH
 from mmaat.ui.models.sensordata import SensorDataModel
-from mmaat.ui.widgets.plots import SensorPyplotView
+from mmaat.ui.widgets.plots import SENSOR_VIEWS, create_sensor_view
 from mmaat.ui.widgets.utilwidgets import PlotControl, \
     SingleItemMaintainAspectRatioLayout
 import cv2.cv as cv
@@ -33,10 +33,14 @@ import mmaat.analysis.report as report
 import mmaat.data as data
 import mmaat.utils.io as utils
 import thread
+import collections
 import os
 import re
 import sys
 import json
+import logging
+
+log = logging.getLogger("mmaat")
 
 """
 Multimodal Multisensor Activity Annotation Tool (MMAAT)
@@ -48,6 +52,8 @@ class MMAAT_UI(QtGui.QMainWindow):
     FIXED_HEIGHT             = 320
 
     DEFAULT_SEGMENT_COLOR    = QtGui.QColor(0,200,100)
+    SEGMENT_UPDATE_CHUNK     = 200 # segments applied to the plot control per event loop iteration
+    PAINTED_SEGMENT_TABS     = True # segment tabs are painted by the tab bars, see PlotControl
     #----------------------- SIGNALS ------------------------------------------
     plotcontrol_xlim_changed = QtCore.pyqtSignal(int,int,int)
     status_bar_changed       = QtCore.pyqtSignal(str,int)
@@ -56,7 +62,12 @@ class MMAAT_UI(QtGui.QMainWindow):
     settings_dict            = {}
     #--------------------------------------------------------------------------
 
-    def __init__(self):
+    def __init__(self, view=None):
+        """
+        Arguments:
+        view -- backend of the sensor data plot (see mmaat.ui.widgets.plots.SENSOR_VIEWS),
+                None for the one of the last session
+        """
         global ICON_NAME
         QtGui.QMainWindow.__init__(self)
         # UI config
@@ -65,8 +76,25 @@ class MMAAT_UI(QtGui.QMainWindow):
         self.setWindowTitle("Multimodal Multisensor Activity Annotation Tool (MMAAT)")
         self.hdf5_fname = ''
         self.algorithm_params = {}
+        self.session_file = os.path.join(MMAAT_UI.SETTINGS_PATH, 'last.session')
+        last_session = utils.unserialize_object(self.session_file)
+        self.settings_dict = last_session if last_session is not None else {
+                                 'last_save_path'  : '.',
+                                 'last_data_path'  : '.',
+                                 'last_report_path' : '.',
+                                 'last_import_path' : '.'
+                                }
+        data.set_storage_profile(self.settings_dict.get('storage_profile', data.STORAGE_PROFILE))
+        data.set_signal_layout(self.settings_dict.get('signal_layout', data.SIGNAL_LAYOUT), self.settings_dict.get('channel_group_size'))
+        if view is not None :
+            self.settings_dict['plot_view'] = view
+        if not self.settings_dict.get('plot_view', 'matplotlib') in SENSOR_VIEWS :
+            log.warning("unknown plot view '{0}' in {1}, using 'matplotlib'".format(self.settings_dict['plot_view'], self.session_file))
+            self.settings_dict['plot_view'] = 'matplotlib'
         # --------------------------------------------------------------------
         self.model = SensorDataModel()
+        self.segment_updates = collections.deque() # (slot, idx, sid) of batched segment changes not yet applied
+        self.segment_updates_scheduled = False
         self.image = {}
         self.depthimage = QtGui.QImage()
         self.main_tab = QtGui.QTabWidget()
@@ -77,14 +105,6 @@ class MMAAT_UI(QtGui.QMainWindow):
         # ----------------------- Generics displays --------------------------
         self.displays = {}
         # --------------------------------------------------------------------
-        self.session_file = os.path.join(MMAAT_UI.SETTINGS_PATH, 'last.session')
-        last_session = utils.unserialize_object(self.session_file)
-        self.settings_dict = last_session if last_session is not None else {
-                                 'last_save_path'  : '.',
-                                 'last_data_path'  : '.',
-                                 'last_report_path' : '.',
-                                 'last_import_path' : '.'
-                                }
         self.popup_triggered.connect(self.systray.showMessage)
         self.systray.show()
 
@@ -230,8 +250,8 @@ class MMAAT_UI(QtGui.QMainWindow):
         self.channelview = QtGui.QWidget()
         self.cvlayout = QtGui.QVBoxLayout(self.channelview)
         self.channelview.setObjectName("channelview")
-        self.sensorview = SensorPyplotView()
-        self.plotcontrol = PlotControl(self.sensorview)
+        self.sensorview = create_sensor_view(self.settings_dict.get('plot_view', 'matplotlib'))
+        self.plotcontrol = PlotControl(self.sensorview, painted_segments=self.PAINTED_SEGMENT_TABS)
         self.plotcontrol.set_ylim_spinner_range(-100000,1000000)
         #putting things together
         self.upper.setFixedHeight(self.FIXED_HEIGHT)
@@ -296,6 +316,8 @@ class MMAAT_UI(QtGui.QMainWindow):
                                "Generate report..",self)
         a_export = QtGui.QAction(QtGui.QIcon(os.path.join(ICONS_PATH, 'export.png')),
                                "Export labels..",self)
+        a_exportplot = QtGui.QAction(QtGui.QIcon(os.path.join(ICONS_PATH, 'export.png')),
+                               "Export plot..",self)
         openssessionslot = lambda : self.set_session(QtGui.QFileDialog.getOpenFileName(
                     parent=m_file,
                     caption="Choose session file..",
@@ -311,6 +333,11 @@ class MMAAT_UI(QtGui.QMainWindow):
                     caption="Save csv file..",
                     filter='CSV files (*.csv)',
                     directory=self.settings_dict['last_import_path']))
+        exportplot = lambda : self.export_plot(QtGui.QFileDialog.getSaveFileName(
+                    parent=m_export,
+                    caption="Save plot..",
+                    filter='Images (*.png *.pdf *.svg)',
+                    directory=self.settings_dict['last_report_path']))
         reportcall = lambda : self.generatereport(QtGui.QFileDialog.getExistingDirectory(
                     parent=m_report,
                     caption="Choose data directory",
@@ -329,10 +356,12 @@ class MMAAT_UI(QtGui.QMainWindow):
         a_dimport.triggered.connect(importcsv)
         a_report.triggered.connect(reportcall)
         a_export.triggered.connect(exportcsv)
+        a_exportplot.triggered.connect(exportplot)
         m_file.addAction(a_opensession)
         m_file.addAction(a_dopen)
         m_file.addAction(a_dimport)
         m_export.addAction(a_export)
+        m_export.addAction(a_exportplot)
         m_report.addAction(a_report)
         return mbar
 
@@ -356,18 +385,57 @@ class MMAAT_UI(QtGui.QMainWindow):
         self.popup_triggered.emit("Report Update", "Report generated: {0}".format(name))
 
     def set_segments_slot(self):
+        self.segment_updates.clear() # the segments are rebuilt from the model
         self.plotcontrol.clear_segments()
-
-        for s in self.model.get_labels() :
-            self.add_segment_slot(s.get_idx(), s.get_sid())
+        self._queue_segment_updates([(self.add_segment_slot, s.get_idx(), s.get_sid()) for s in self.model.get_labels()])
 
     def update_segment_slot(self, idx, sid):
         seg = self.model.get_label(idx, sid)
         if seg is None : return #robustness fix
         self.plotcontrol.move_segment(sid, seg.get_start(), seg.get_end())
 
+    def segments_changed_slot(self, changes):
+        '''
+        Queues the changes of a batch of segment operations. They are applied in chunks
+        of SEGMENT_UPDATE_CHUNK segments so that the UI stays responsive for large batches.
+        Arguments:
+            changes -- SegmentChanges
+        '''
+        updates = [(self.remove_segment_slot, idx, sid) for idx, sid in changes.removed()]
+        updates.extend([(self.update_segment_slot, idx, sid) for idx, sid in changes.changed()])
+        updates.extend([(self.add_segment_slot, idx, sid) for idx, sid in changes.added()])
+        self._queue_segment_updates(updates)
+
+    def _queue_segment_updates(self, updates):
+        '''
+        Queues segment updates for _apply_segment_updates.
+        Arguments:
+            updates -- list of (slot, idx, sid)
+        '''
+        self.segment_updates.extend(updates)
+        if len(self.segment_updates) > 0 and not self.segment_updates_scheduled :
+            self.segment_updates_scheduled = True
+            QtCore.QTimer.singleShot(0, self._apply_segment_updates)
+
+    def _apply_segment_updates(self):
+        '''
+        Applies the next chunk of queued segment changes.
+        '''
+        self.plotcontrol.setUpdatesEnabled(False)
+        try :
+            for i in xrange(min(self.SEGMENT_UPDATE_CHUNK, len(self.segment_updates))) :
+                slot, idx, sid = self.segment_updates.popleft()
+                slot(idx, sid)
+        finally :
+            self.plotcontrol.setUpdatesEnabled(True)
+        if len(self.segment_updates) > 0 :
+            QtCore.QTimer.singleShot(0, self._apply_segment_updates)
+        else :
+            self.segment_updates_scheduled = False
+
     def add_segment_slot(self, idx, sid):
         seg = self.model.get_label(idx, sid)
+        if seg is None : return # removed before a queued update was applied
         popup_s = QtGui.QMenu()
         f1 = lambda : self.model.remove_segment(idx,sid)
         f2 = None
@@ -422,6 +490,7 @@ class MMAAT_UI(QtGui.QMainWindow):
         self.model.segment_added.connect(self.add_segment_slot)
         self.model.segment_removed.connect(self.remove_segment_slot)
         self.model.segment_changed.connect(self.update_segment_slot)
+        self.model.segments_changed.connect(self.segments_changed_slot)
         self.model.animation_step.connect(lambda i : self.animation_slot(i, self.model))
         self.channelcontrol.setModel(self.model)
         self.plotcontrol.set_model(self.model)
@@ -431,7 +500,7 @@ class MMAAT_UI(QtGui.QMainWindow):
     def change_plotcontrol_xlim0(self,idx,s,e):
         self.plotcontrol.set_xlim(s,e,load_data=False)
 
-    def remove_segment_slot(self, sid):
+    def remove_segment_slot(self, idx, sid):
         self.plotcontrol.remove_segment(sid)
 
     def set_image(self, idx, fname):
@@ -488,6 +557,9 @@ class MMAAT_UI(QtGui.QMainWindow):
             :Parameters:
                 hdf5_fname - file name of the hdf5 file.
         """
+        if str(_hdf5_fname).endswith((data.PYRAMID_SUFFIX, data.SIGNATURE_ARCHIVE_SUFFIX)) : # the "*.h5" filter lists the sidecar files
+            log.warning("{0} is not a recording, ignored".format(_hdf5_fname))
+            return
         self.hdf5_fname = str(_hdf5_fname)
         if self.hdf5_fname is None or self.hdf5_fname == "" : return # ignore if nothing is selected
         self.set_hdf(self.hdf5_fname)
@@ -495,6 +567,7 @@ class MMAAT_UI(QtGui.QMainWindow):
         if not os.path.exists(dirname) :
             dirname = os.path.join(os.path.dirname(self.hdf5_fname), 'images')
         self.model.set_indexed_imagedir(dirname)
+        self.model.set_signature_source(self.hdf5_fname[:-3] + '_signature')
         self.update_statusbar(0)
         self.setup_image_displays(self.model.get_image_idxs())
         self.animation_slot(0, self.model)
@@ -527,7 +600,9 @@ class MMAAT_UI(QtGui.QMainWindow):
         if fname is None or fname == '' : return
         self.settings_dict['last_import_path'] = os.path.dirname(fname)
         h5_name = re.sub(r".csv",".h5", fname)
-        if h5_name == self.hdf5_fname : self.model.close()
+        if h5_name == self.hdf5_fname :
+            self.model.store_labels() # clears the journal of the file before it is replaced
+            self.model.close()
         data.convert_csv_to_hdf(fname, h5_name, True,
                                 mmaat.CLASSES,
                                 mmaat.IGNORE_FEATURES)
@@ -548,6 +623,17 @@ class MMAAT_UI(QtGui.QMainWindow):
                           for sensor_model_segment in self.model.get_labels()],
                           fname)
 
+    def export_plot(self, export_file) :
+        """
+        Saves the sensor data plot as it is shown, drawn with matplotlib.
+        Arguments:
+        export_file -- path to the image, the format is taken from the extension
+        """
+        fname = str(export_file)
+        if fname is None or fname == '' : return
+        self.settings_dict['last_report_path'] = os.path.dirname(fname)
+        self.sensorview.save_figure(fname)
+
     def update_statusbar(self, i):
         """
         Updates the status bar with the current index.
@@ -583,13 +669,19 @@ class MMAAT_UI(QtGui.QMainWindow):
         """
         if self.model is not None :
             self.model.store_labels()
+            self.model.close() # flushes the label journal if storing failed
         if not os.path.exists(MMAAT_UI.SETTINGS_PATH) :
             os.makedirs(MMAAT_UI.SETTINGS_PATH)
         utils.serialize_object(self.settings_dict, self.session_file)
         self.systray.hide()
 
 if __name__ == "__main__" :
-    app = QtGui.QApplication(sys.argv)
-    ui = MMAAT_UI()
+    app = QtGui.QApplication(sys.argv) # removes the Qt options from sys.argv
+    options = utils.read_commandline(sys.argv[1:], short="v:", long_des=["view="])
+    view = options.option(('v', 'view'), None)
+    if view is not None and not view in SENSOR_VIEWS :
+        print "ERROR : unknown view '{0}', choose one of {1}".format(view, ", ".join(SENSOR_VIEWS))
+        sys.exit(2)
+    ui = MMAAT_UI(view)
     ui.show()
     sys.exit(app.exec_())
@@ -51,8 +51,8 @@ def extract_gestures(h5_fname, report_path, plotdata=True, ignoreData=[]) :
     zdirname = h5_fname[:-3] + '_zimage'
     pgmlist = load_images(zdirname, 'pgm')
     timestamps = h5_obj['data']['timestamp'][:]
-    signal = h5_obj['data']['signal'][:, includeIndex]
-    target = h5_obj['data']['target'][:]
+    signal = data.read_signal(h5_obj, columns=includeIndex)
+    target = data.read_target(h5_obj)
     last_label = target[0]
     start = None
     gdata = {}
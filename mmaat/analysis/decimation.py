@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+'''
+ DFKI GmbH 2013 - 20xx
+ All rights reserved.
+ Maintainer: Markus Weber
+'''
+import numpy as np
+
+DECIMATION_METHODS = ('minmax', 'lttb')
+
+def _as_block(data):
+    '''
+        Returns data as float array (samples x channels).
+    '''
+    block = np.asarray(data, dtype=np.float64)
+    if block.ndim == 1 : block = block[:, np.newaxis]
+    return block
+
+def minmax(data, columns):
+    '''
+        Min/max envelope: every column is represented by its minimum and its
+        maximum, so peaks stay visible at any zoom level.
+        :Parameters:
+            data    - numpy array (samples x channels)
+            columns - number of columns, e.g. the pixel width of the plot
+        :Returns:
+            x - sample indices (2 * columns), shared by all channels
+            y - numpy array (2 * columns x channels)
+    '''
+    block = _as_block(data)
+    n = len(block)
+    columns = max(1, int(columns))
+    if n <= 2 * columns :
+        return np.arange(n), block
+    edges = np.linspace(0, n, columns + 1).astype(np.int64)[:-1]
+    y = np.empty((2 * columns, block.shape[1]), dtype=block.dtype)
+    y[0::2] = np.minimum.reduceat(block, edges, axis=0)
+    y[1::2] = np.maximum.reduceat(block, edges, axis=0)
+    return np.repeat(edges, 2), y
+
+def envelope(x, ymin, ymax, columns):
+    '''
+        Min/max envelope of block summaries, e.g. a level of the summary pyramid
+        of a recording. Blocks are merged until there are at most columns left.
+        :Parameters:
+            x       - first sample of every block
+            ymin    - numpy array with the block minima (blocks x channels)
+            ymax    - numpy array with the block maxima (blocks x channels)
+            columns - number of columns, e.g. the pixel width of the plot
+        :Returns:
+            x - sample indices (2 * blocks), shared by all channels
+            y - numpy array (2 * blocks x channels)
+    '''
+    ymin, ymax = _as_block(ymin), _as_block(ymax)
+    columns = max(1, int(columns))
+    if len(x) > columns :
+        edges = np.linspace(0, len(x), columns + 1).astype(np.int64)[:-1]
+        x = np.asarray(x)[edges]
+        ymin = np.fmin.reduceat(ymin, edges, axis=0)
+        ymax = np.fmax.reduceat(ymax, edges, axis=0)
+    y = np.empty((2 * len(x), ymin.shape[1]), dtype=ymin.dtype)
+    y[0::2] = ymin
+    y[1::2] = ymax
+    return np.repeat(x, 2), y
+
+def lttb(data, threshold):
+    '''
+        Largest-Triangle-Three-Buckets downsampling (Steinarsson 2013). Keeps
+        the shape of the signal with fewer points than the min/max envelope,
+        but does not guarantee that all peaks are kept.
+        :Parameters:
+            data      - numpy array (samples x channels)
+            threshold - number of points per channel
+        :Returns:
+            x - sample indices (threshold x channels)
+            y - numpy array (threshold x channels)
+    '''
+    block = _as_block(data)
+    n, nchannels = block.shape
+    if threshold >= n or threshold < 3 :
+        x = np.repeat(np.arange(n)[:, np.newaxis], nchannels, axis=1)
+        return x, block
+    channels = np.arange(nchannels)
+    # first and last sample are kept, the others are split into threshold-2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    x = np.zeros((threshold, nchannels), dtype=np.int64)
+    x[-1] = n - 1
+    a = np.zeros(nchannels, dtype=np.int64)
+    for i in xrange(threshold - 2) :
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges) :
+            nlo, nhi = edges[i + 1], edges[i + 2]
+        else :
+            nlo, nhi = n - 1, n
+        avg_x = (nlo + nhi - 1) / 2.0
+        avg_y = block[nlo:nhi].mean(axis=0)
+        ay = block[a, channels]
+        xs = np.arange(lo, hi)[:, np.newaxis]
+        area = np.abs((a - avg_x) * (block[lo:hi] - ay) - (a - xs) * (avg_y - ay))
+        a = lo + np.argmax(np.where(np.isnan(area), -1, area), axis=0)
+        x[i + 1] = a
+    return x, block[x, channels]
+
+def decimate(data, columns, method='minmax'):
+    '''
+        Reduces the channels of a block to the resolution of a plot.
+        :Parameters:
+            data    - numpy array (samples x channels)
+            columns - number of pixel columns the samples are drawn on
+            method  - 'minmax' (two points per column) or 'lttb' (one point per column)
+        :Returns:
+            x - sample indices, 1d if shared by all channels, else (points x channels)
+            y - numpy array (points x channels)
+    '''
+    if method == 'minmax' :
+        return minmax(data, columns)
+    elif method == 'lttb' :
+        return lttb(data, max(3, int(columns)))
+    raise ValueError("Unknown decimation method '{0}'".format(method))
@@ -5,6 +5,7 @@
  Maintainer: Markus Weber
 '''
 import data_tools as dt
+import mmaat.data as data
 import multiprocessing as mp
 import numpy as np
 import os
@@ -79,8 +80,8 @@ def generate_report_var(data_dir, report_path=None, callback_done=None):
         report_path = os.path.dirname(report_file)
         if not os.path.exists(report_path) : os.makedirs(report_path)
     
-    # collect all data files
-    h5_files = [os.path.join(data_dir, fname) for fname in os.listdir(data_dir) if fname.endswith('.h5') ]
+    # collect all data files that contain gestures
+    h5_files = data.get_catalog(data_dir).files(labeled=True)
     # extract the gestures 
     all_gestures = {}
     DATA_DESCRIPTION = None
@@ -125,8 +126,8 @@ def generate_report_dist(data_dir, report_path=None, callback_done=None):
     # Create directory for report
     if not os.path.exists(report_path) :
         os.makedirs(report_path)
-    # collect all data files
-    h5_files = [os.path.join(data_dir, fname) for fname in os.listdir(data_dir) if fname.endswith('.h5') ]
+    # collect all data files that contain gestures
+    h5_files = data.get_catalog(data_dir).files(labeled=True)
     # extract the gestures 
     all_gestures = {}
     for h5_file in h5_files :
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+'''
+ DFKI GmbH 2013 - 20xx
+ All rights reserved.
+ Maintainer: Markus Weber
+'''
+import numpy as np
+
+RESERVOIR_SIZE = 10000 # number of samples kept for the percentile estimates
+
+class RunningStats(object):
+    '''
+        Per feature statistics that are updated block wise in a single pass.
+        Mean and variance are merged with the parallel algorithm of Chan et al.
+        (Welford for blocks), so partial results of several files or processes
+        can be combined with merge(). Missing values (NaN) are ignored.
+        Percentiles are estimated from a uniform reservoir of samples.
+    '''
+    def __init__(self, nfeatures, reservoir_size=RESERVOIR_SIZE):
+        '''
+            :Parameters:
+                nfeatures      - number of features
+                reservoir_size - number of samples kept for percentiles
+        '''
+        self.count = np.zeros((nfeatures), dtype=np.float64)
+        self.mean = np.zeros((nfeatures), dtype=np.float64)
+        self.m2 = np.zeros((nfeatures), dtype=np.float64)
+        self.min = np.empty((nfeatures), dtype=np.float64)
+        self.min.fill(np.inf)
+        self.max = np.empty((nfeatures), dtype=np.float64)
+        self.max.fill(-np.inf)
+        self.reservoir_size = reservoir_size
+        self.reservoir = np.zeros((0, nfeatures), dtype=np.float32)
+        self.samples = 0 # number of rows seen, the reservoir is a uniform sample of them
+
+    def __len__(self):
+        return self.samples
+
+    def _merge_moments(self, count, mean, m2):
+        '''
+            Chan et al. merge of count, mean and sum of squared deviations.
+        '''
+        total = self.count + count
+        valid = total > 0
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore') :
+            w = np.where(valid, count / np.where(valid, total, 1), 0)
+        self.mean = self.mean + delta * w
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * w
+        self.count = total
+
+    def _merge_reservoir(self, rows, samples):
+        '''
+            Merges a uniform sample of another stream so that the reservoir
+            stays a uniform sample of all rows seen.
+        '''
+        total = self.samples + samples
+        if total == 0 : return
+        if len(self.reservoir) + len(rows) <= self.reservoir_size :
+            self.reservoir = np.vstack((self.reservoir, rows.astype(np.float32)))
+        else :
+            k = int(round(self.reservoir_size * float(self.samples) / total))
+            k = min(k, len(self.reservoir))
+            k = max(k, self.reservoir_size - len(rows))
+            a = self.reservoir[np.random.choice(len(self.reservoir), k, replace=False)]
+            b = rows[np.random.choice(len(rows), min(len(rows), self.reservoir_size - k), replace=False)]
+            self.reservoir = np.vstack((a, b.astype(np.float32)))
+        self.samples = total
+
+    def update(self, block):
+        '''
+            Adds a block of samples.
+            :Parameters:
+                block - numpy array (samples x features)
+        '''
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim == 1 : block = block[:, np.newaxis]
+        if len(block) == 0 : return
+        mask = ~np.isnan(block)
+        count = mask.sum(axis=0).astype(np.float64)
+        filled = np.where(mask, block, 0)
+        with np.errstate(invalid='ignore', divide='ignore') :
+            mean = np.where(count > 0, filled.sum(axis=0) / np.where(count > 0, count, 1), 0)
+        m2 = (np.where(mask, block - mean, 0) ** 2).sum(axis=0)
+        self._merge_moments(count, mean, m2)
+        self.min = np.fmin(self.min, np.where(mask, block, np.inf).min(axis=0))
+        self.max = np.fmax(self.max, np.where(mask, block, -np.inf).max(axis=0))
+        self._merge_reservoir(block, len(block))
+
+    def merge(self, other):
+        '''
+            Adds the statistics of another stream (e.g. another file).
+            :Parameters:
+                other - RunningStats with the same number of features
+        '''
+        self._merge_moments(other.count, other.mean, other.m2)
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        self._merge_reservoir(other.reservoir, other.samples)
+        return self
+
+    def variance(self):
+        '''
+            :Returns:
+                population variance per feature
+        '''
+        return self.m2 / np.maximum(self.count, 1)
+
+    def std(self):
+        '''
+            :Returns:
+                population standard deviation per feature
+        '''
+        return np.sqrt(self.variance())
+
+    def percentiles(self, q=(5, 25, 50, 75, 95)):
+        '''
+            Percentile estimates from the sample reservoir.
+            :Parameters:
+                q - percentiles in [0, 100]
+            :Returns:
+                numpy array (len(q) x features)
+        '''
+        if len(self.reservoir) == 0 :
+            return np.zeros((len(q), len(self.mean)))
+        return np.nanpercentile(self.reservoir, q, axis=0)
+
+    def factors(self, method='2sigma', columns=None):
+        '''
+            Normalization factors of the statistics.
+            :Parameters:
+                method  - '2sigma' (scale by two standard deviations) or 'zscore'
+                columns - feature indices, None for all
+            :Returns:
+                (offset, scale) where normalized = (x - offset) / scale
+        '''
+        if method == '2sigma' :
+            scale = self.std() * 2
+        elif method == 'zscore' :
+            scale = self.std()
+        else :
+            raise ValueError("Unknown normalization method '{0}'".format(method))
+        offset = self.mean
+        if columns is not None :
+            offset = offset[columns]
+            scale = scale[columns]
+        return offset, scale
+
+    def save(self, fname):
+        '''
+            Stores the statistics in a .npz file.
+            :Parameters:
+                fname - path to file
+        '''
+        np.savez(fname, count=self.count, mean=self.mean, m2=self.m2, min=self.min, max=self.max,
+                 reservoir=self.reservoir, samples=self.samples, reservoir_size=self.reservoir_size)
+
+    @staticmethod
+    def load(fname):
+        '''
+            Loads statistics stored with save().
+            :Parameters:
+                fname - path to file
+            :Returns:
+                RunningStats
+        '''
+        d = np.load(fname)
+        stats = RunningStats(len(d['mean']), int(d['reservoir_size']))
+        stats.count = d['count']
+        stats.mean = d['mean']
+        stats.m2 = d['m2']
+        stats.min = d['min']
+        stats.max = d['max']
+        stats.reservoir = d['reservoir']
+        stats.samples = int(d['samples'])
+        return stats
+
+def normalize(block, factors):
+    '''
+        Applies normalization factors to a block of samples. Features with a
+        scale of zero are only shifted.
+        :Parameters:
+            block   - numpy array (samples x features)
+            factors - (offset, scale) as returned by RunningStats.factors
+        :Returns:
+            normalized float32 array
+    '''
+    offset, scale = factors
+    scale = np.where(scale > 0, scale, 1)
+    return ((block - offset) / scale).astype(np.float32)
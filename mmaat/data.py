@@ -4,86 +4,306 @@
  All rights reserved.
  Maintainer: Markus Weber
 '''
-import xml.dom.minidom as dom
+import xml.etree.cElementTree as ElementTree
+import collections
 import csv
 import h5py as h5
+import hashlib
+import itertools
+import json
+import logging
 import mmaat
-import mmaat.analysis.processing as p
+import mmaat.analysis.statistics as statistics
+import mmaat.utils.io as io
+import multiprocessing as mp
 import numpy as np
 import os
+import Queue
 import shutil
+import threading
 
+log = logging.getLogger("mmaat.data")
+
+CSV_BLOCK_SIZE = 10000 # number of csv rows that are parsed and written at once
+XML_SHARD_SIZE = 500   # number of pose files parsed by one worker at once
+
+"""
+    Storage profiles:
+        chunk_bytes      : size of a chunk, chunks span all columns of a dataset
+        compression      : HDF5 filter (None, 'lzf' or 'gzip')
+        compression_opts : level of the gzip filter
+        shuffle          : byte shuffle before compression
+        signal_dtype     : data type of the 'signal' dataset
+"""
+STORAGE_PROFILES = {
+    'plain'   : {'chunk_bytes' : 256 * 1024, 'compression' : None, 'shuffle' : False, 'signal_dtype' : np.float32},
+    'default' : {'chunk_bytes' : 256 * 1024, 'compression' : 'lzf', 'shuffle' : True, 'signal_dtype' : np.float32},
+    'archive' : {'chunk_bytes' : 1024 * 1024, 'compression' : 'gzip', 'compression_opts' : 4, 'shuffle' : True, 'signal_dtype' : np.float32},
+    'compact' : {'chunk_bytes' : 1024 * 1024, 'compression' : 'gzip', 'compression_opts' : 4, 'shuffle' : True, 'signal_dtype' : np.float16},
+}
+STORAGE_PROFILE = 'default'
+
+"""
+    Signal layouts:
+        rows    : one dataset 'data/signal' with one row per sample
+        columns : datasets 'data/channels/<k>' each holding a group of
+                  CHANNEL_GROUP_SIZE consecutive channels, so reading a few
+                  channels only touches their own chunks
+"""
+SIGNAL_LAYOUTS = ('rows', 'columns')
+SIGNAL_LAYOUT = 'rows'
+CHANNEL_GROUP_SIZE = 1
+
+CATALOG_FNAME = '.mmaat_catalog' # catalog of a data directory (see Catalog)
+TIMESTAMP_DATASETS = ('timestamp', 'timestamps') # names of the timestamp dataset written by the importers
+
+LABEL_GROUP = 'labels' # group with one interval table per annotation layer (see write_label_table)
+JOURNAL_SUFFIX = '.journal' # journal of segment operations next to the data file (see LabelJournal)
+
+SIGNATURE_ARCHIVE_SUFFIX = '.sig.h5' # container of pack_signatures next to the signature directory
+SIGNATURE_CACHE_SIZE = 512           # number of hand signatures kept in memory
+SIGNATURE_READ_AHEAD = 32            # number of hand signatures read ahead of the playhead
+
+PYRAMID_SUFFIX = '.pyr.h5' # summary pyramid next to the data file (see build_pyramid)
+PYRAMID_BASE = 16          # samples per block of the finest summary level
+PYRAMID_FACTOR = 4         # blocks of a summary level merged into one block of the next level
+PYRAMID_MIN_BLOCKS = 64    # no coarser summary level is built below this number of blocks
+
+WINDOW_BLOCK_SIZE = 4096          # rows of an aligned block of the window cache (see WindowCache)
+WINDOW_CACHE_BYTES = 128 * 2**20  # memory of the blocks kept by the window cache
+WINDOW_PREFETCH_BLOCKS = 4        # blocks read ahead of a window in the direction it moved
 
 def fid(feature,desc):
     return desc.index(feature)
 def normalization_factors(dset, method='2sigma'):
-    nf = len(dset.getSequence(0)[0][0])
-    total = 0
-    means = np.zeros((nf), dtype=float)
-    sds = np.zeros((nf), dtype=float)
-    for si in xrange(dset.getNumSequences()) :
-        for vec in dset.getSequence(si)[0] :
-            total += 1
-            for fi in xrange(nf) : means[fi] += vec[fi]
-    means /= total
+    '''
+    Computes the normalization factors of a sequential dataset in one pass.
+    Arguments:
+    dset   -- dataset
+    method -- '2sigma' (scale by two standard deviations) or 'zscore'
+
+    Returns: means, scale
+    '''
+    stats = statistics.RunningStats(len(dset.getSequence(0)[0][0]))
     for si in xrange(dset.getNumSequences()) :
-        for vec in dset.getSequence(si)[0] :
-            for fi in xrange(nf) : sds[fi] += (vec[fi] - means[fi]) ** 2
-    sds /= total
-    sds = np.sqrt(sds)
-    return means, sds * 2
+        stats.update(np.asarray(dset.getSequence(si)[0]))
+    return stats.factors(method)
+
+# -------------------------- Statistics ---------------------------------------
+def _file_statistics(args):
+    '''
+    Computes the statistics of the selected features of one file (used by the
+    process pool of directory_statistics).
+    Arguments:
+    args -- tuple (h5 file, features or None for all columns, block size)
+
+    Returns: RunningStats
+    '''
+    fname, features, block_size = args
+    h5file = h5.File(fname, "r")
+    try :
+        n, ncols = signal_shape(h5file)
+        columns = None if features is None else feature_indices(list(h5file['data_desc']['description'][:]), features)
+        stats = statistics.RunningStats(ncols if columns is None else len(columns))
+        for b in xrange(0, n, block_size) :
+            stats.update(read_signal(h5file, b, b + block_size, columns))
+        return stats
+    finally :
+        h5file.close()
+
+def signal_statistics(fname, features=None, block_size=10 * CSV_BLOCK_SIZE):
+    '''
+    Computes mean, variance, min, max and percentile estimates of a file block wise.
+    Arguments:
+    fname      -- the name of the HDF5 file
+    features   -- selected features, None for all columns of the signal
+    block_size -- number of rows read at once
+
+    Returns: RunningStats
+    '''
+    return _file_statistics((fname, features, block_size))
+
+def directory_statistics(h5dir, features=None, fname_out=None, processes=None, block_size=10 * CSV_BLOCK_SIZE):
+    '''
+    Computes the statistics of all files of a directory in parallel and merges
+    the partial results.
+    Arguments:
+    h5dir      -- directory with h5 files
+    features   -- selected features, None for all columns (files must share the description)
+    fname_out  -- if given the statistics are stored there (see RunningStats.load)
+    processes  -- number of worker processes, by default one less than the number of cpus
+    block_size -- number of rows read at once
+
+    Returns: RunningStats
+    '''
+    jobs = [(fname, features, block_size) for fname in get_catalog(h5dir).files()]
+    if processes is None :
+        processes = max(1, mp.cpu_count() - 1)
+    stats = None
+    if len(jobs) > 0 :
+        pool = mp.Pool(min(processes, len(jobs)))
+        try :
+            for part in pool.imap_unordered(_file_statistics, jobs) :
+                stats = part if stats is None else stats.merge(part)
+        finally :
+            pool.close()
+            pool.join()
+    if stats is None :
+        stats = statistics.RunningStats(0 if features is None else len(features))
+    if fname_out is not None :
+        stats.save(fname_out)
+    return stats
 
 # -------------------------- PyBrain sequential dataset -----------------------
-def add_to_dataset(dset,h5file,features=mmaat.FEATURES, classes=mmaat.CLASSES):
+def feature_indices(desc, features):
     '''
-    Adding data to the sequential dataset.
+    Resolves the signal columns of features.
+    Arguments:
+    desc     -- description of the file (list of feature names)
+    features -- selected features
+
+    Returns: numpy array with one column index per feature
+    '''
+    lookup = dict((str(x), i) for i, x in enumerate(desc))
+    return np.array([lookup[x] for x in features], dtype=np.intp)
+
+def read_features(h5file, features):
+    '''
+    Reads the selected features of all samples of a file at once.
     Arguments:
-    dset     -- dataset
     h5file   -- h5 data file
-    features -- Selected features
+    features -- selected features
+
+    Returns: numpy array (samples x features)
     '''
     d = list(h5file['data_desc']['description'][:])
-    len_classes = len(classes)
-    signal = h5file['data']['signal']
-    target = h5file['data']['target']
+    return read_signal(h5file, columns=feature_indices(d, features))
+
+def one_hot(target, num_classes):
+    '''
+    Converts label ids into one-hot rows.
+    Arguments:
+    target      -- numpy array with one label id per sample
+    num_classes -- number of classes
+
+    Returns: numpy array (samples x num_classes)
+    '''
+    target = np.asarray(target, dtype=np.intp)
+    tar = np.zeros((len(target), num_classes), dtype=np.int32)
+    tar[np.arange(len(target)), target] = 1
+    return tar
+
+def add_to_dataset(dset,h5file,features=mmaat.FEATURES, classes=mmaat.CLASSES, normalization=None):
+    '''
+    Adding data to the sequential dataset.
+    Arguments:
+    dset          -- dataset
+    h5file        -- h5 data file
+    features      -- Selected features
+    normalization -- (offset, scale) of the features (see RunningStats.factors), None for raw values
+    '''
+    dat = read_features(h5file, features)
+    tar = one_hot(read_target(h5file), len(classes))
+    # samples where all features are equal carry no information
+    keep = ~np.all(dat == dat[:, :1], axis=1)
+    if normalization is not None :
+        dat = statistics.normalize(dat, normalization)
 
     dset.newSequence()
-    for i in xrange(len(signal)) :
-        si = signal[i]
-        ti = target[i]
-        dat = [si[fid(x,d)] for x in features]
-        tar = [0] * len_classes
-        tar[ti] = 1
-        if all([dat[0] == item for item in dat]) :
-            continue
-        dset.addSample(dat,tar)
+    for i in np.flatnonzero(keep) :
+        dset.addSample(dat[i], tar[i])
 
-def load_numpy_dataset(h5dir,features=mmaat.FEATURES):
+def load_numpy_dataset(h5dir,features=mmaat.FEATURES, normalization=None):
     '''
     Load dataset.
     Arguments:
-        h5dir    -- directory with h5 files.
-        features -- features used
+        h5dir         -- directory with h5 files.
+        features      -- features used
+        normalization -- (offset, scale) of the features (see RunningStats.factors), None for raw values
 
     '''
     dataset = []
     targets = []
-    for fname in os.listdir(h5dir) :
-        if not fname.endswith(".h5") : continue
-        h5file = h5.File(os.path.join(h5dir,fname),"r")
-        if not 'classes' in h5file['data_desc'] : continue #file must be labeled
-        d = list(h5file['data_desc']['description'][:])
-        signal = h5file['data']['signal']
-        target = h5file['data']['target']
-        for i in xrange(len(signal)) :
-            si = signal[i]
-            ti = target[i]
-            dat = [si[fid(x,d)] for x in features]
-            tar = 1 if ti > 0 else 0
-            dataset.append(dat)
-            targets.append(tar)
+    for fname in get_catalog(h5dir).files() : #file must be labeled
+        h5file = h5.File(fname,"r")
+        try :
+            dat = read_features(h5file, features)
+            dataset.append(dat if normalization is None else statistics.normalize(dat, normalization))
+            targets.append((read_target(h5file) > 0).astype(np.int))
+        finally :
+            h5file.close()
+    if len(dataset) == 0 :
+        return np.array(dataset), np.array(targets)
+    return np.concatenate(dataset), np.concatenate(targets)
+
+def _fill_dataset_rows(args):
+    '''
+    Copies the samples of one file into its row range of the memory mapped
+    output (used by the process pool of load_numpy_dataset_memmap).
+    Arguments:
+        args -- tuple (h5 file, features, data file, target file, first row, block size, normalization)
+
+    Returns: number of rows written
+    '''
+    fname, features, data_fname, target_fname, offset, block_size, normalization = args
+    X = np.load(data_fname, mmap_mode='r+')
+    y = np.load(target_fname, mmap_mode='r+')
+    h5file = h5.File(fname, "r")
+    try :
+        columns = feature_indices(list(h5file['data_desc']['description'][:]), features)
+        n = signal_shape(h5file)[0]
+        for b in xrange(0, n, block_size) :
+            e = min(n, b + block_size)
+            dat = read_signal(h5file, b, e, columns)
+            X[offset + b:offset + e] = dat if normalization is None else statistics.normalize(dat, normalization)
+            y[offset + b:offset + e] = read_target(h5file, b, e) > 0
+    finally :
         h5file.close()
-    return np.array(dataset), np.array(targets)
+    X.flush()
+    y.flush()
+    del X, y
+    return n
+
+def load_numpy_dataset_memmap(h5dir, data_fname, target_fname=None, features=mmaat.FEATURES, processes=None, block_size=10 * CSV_BLOCK_SIZE, normalization=None):
+    '''
+    Load dataset into memory mapped .npy files. The number of samples of all
+    labeled files is taken from the catalog, then worker processes copy the files into
+    disjoint row ranges of the preallocated output, so the dataset can be
+    larger than the main memory.
+    Arguments:
+        h5dir         -- directory with h5 files.
+        data_fname    -- .npy file for the samples (samples x features, float32)
+        target_fname  -- .npy file for the binary targets, by default data_fname with suffix '_target'
+        features      -- features used
+        processes     -- number of worker processes, by default one less than the number of cpus
+        block_size    -- number of rows a worker copies at once
+        normalization -- (offset, scale) of the features (see RunningStats.factors), None for raw values
+
+    Returns: tuple (samples, targets) of read-only memory maps
+    '''
+    if target_fname is None :
+        target_fname = '{0}_target.npy'.format(data_fname[:-4] if data_fname.endswith('.npy') else data_fname)
+    catalog = get_catalog(h5dir, processes)
+    files = [(fname, catalog.entry(fname)['samples']) for fname in catalog.files()]
+    num_samples = sum([n for _, n in files])
+    X = np.lib.format.open_memmap(data_fname, mode='w+', dtype=np.float32, shape=(num_samples, len(features)))
+    y = np.lib.format.open_memmap(target_fname, mode='w+', dtype=np.int8, shape=(num_samples,))
+    del X, y # the headers are written, the workers open the files on their own
+    jobs = []
+    offset = 0
+    for fname, n in files :
+        jobs.append((fname, list(features), data_fname, target_fname, offset, block_size, normalization))
+        offset += n
+    if processes is None :
+        processes = max(1, mp.cpu_count() - 1)
+    if len(jobs) > 0 :
+        pool = mp.Pool(min(processes, len(jobs)))
+        try :
+            for _ in pool.imap_unordered(_fill_dataset_rows, jobs) : pass
+        finally :
+            pool.close()
+            pool.join()
+    return np.load(data_fname, mmap_mode='r'), np.load(target_fname, mmap_mode='r')
 
 
 def read_description(hdf5_obj) :
@@ -115,8 +335,8 @@ def get_array_data_for_object(h5_obj):
              of the 'signal' field in the HDF5 'data' directory
     """
     try :
-        signal = h5_obj['data']['signal']
-        target = h5_obj['data']['target']
+        signal = read_signal(h5_obj)
+        target = read_target(h5_obj)
         timestamp = h5_obj['data']['timestamp']
         a = np.zeros((len(signal),len(mmaat.FEATURES) + 3),dtype=np.float32)
         a[:,:-3] = signal
@@ -166,7 +386,7 @@ def get_labels_for_object(h5_obj):
 
     Returns: numpy array with data of 'target'
     """
-    labels = h5_obj['data']['target'][:]
+    labels = read_target(h5_obj)
     return labels
 
 def read_hand_signature(fname):
@@ -180,19 +400,9 @@ def read_hand_signature(fname):
     """
     if not os.path.exists(fname) :
         return None
-    data = []
     with open(fname, 'rb') as csvfile:
-        datareader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        bHeader = True
-        headers = []
-        for row in datareader:
-            if bHeader :
-                for i in xrange(len(row)) :
-                    headers.append(row[i])
-                bHeader = False
-            else :
-                data.append([round(float(v), 4) for v in row][::-1])
-    return np.array(data, dtype=np.float32)
+        data = parse_csv_block(csvfile.readlines()[1:])
+    return data[:, ::-1]
 
 def read_signatures(dname):
     """
@@ -210,10 +420,1381 @@ def read_signatures(dname):
         signatures.append(read_hand_signature(os.path.join(dname, sfile)))
     return signatures
 
-def convert_csv_to_hdf(fname, fname_out, preserve_target=True, classes=[], exclude=[], rel_data=[]):
+def _signature_files(dname):
+    """
+    Lists the signature csv files of a directory in index order.
+
+    Arguments:
+    dname -- the name of directory
+
+    Returns: list of tuples (index, path)
+    """
+    lst = [x for x in os.listdir(dname) if x.endswith('.csv')]
+    return sorted([(int(x[:-4]), os.path.join(dname, x)) for x in lst])
+
+def pack_signatures(dname, fname_out=None, profile=None):
+    """
+    Packs a directory of hand signature csv files into one HDF5 container.
+    The signatures are stored flat in 'signatures/values' and addressed by
+    'signatures/offsets' (start of each signature, plus the end) and
+    'signatures/shapes'. 'signatures/indices' keeps the index of the csv file.
+
+    Arguments:
+    dname     -- the name of directory
+    fname_out -- name of the container, by default dname + SIGNATURE_ARCHIVE_SUFFIX
+    profile   -- storage profile of the datasets (see get_storage_profile)
+
+    Returns: name of the container
+    """
+    if fname_out is None :
+        fname_out = dname.rstrip(os.sep) + SIGNATURE_ARCHIVE_SUFFIX
+    files = _signature_files(dname)
+    shapes = np.zeros((len(files), 2), dtype=np.int64)
+    offsets = np.zeros((len(files) + 1), dtype=np.int64)
+    f = h5.File(fname_out, 'w')
+    try :
+        group = f.create_group('signatures')
+        values = _create_appendable_dataset(group, 'values', np.float32, profile=profile)
+        for k, (_, path) in enumerate(files) :
+            sig = read_hand_signature(path)
+            shapes[k] = sig.shape if sig.ndim == 2 else (len(sig), 1)
+            offsets[k + 1] = offsets[k] + sig.size
+            _append_rows(values, sig.ravel())
+        create_dataset(group, 'offsets', data=offsets, profile=profile)
+        create_dataset(group, 'shapes', data=shapes, profile=profile)
+        create_dataset(group, 'indices', data=np.array([i for i, _ in files], dtype=np.int64), profile=profile)
+    finally :
+        f.close()
+    return fname_out
+
+class SignatureArchive(object):
+    """
+    Indexed access to hand signatures, either from a container written by
+    pack_signatures or from a directory of csv files. Signatures are kept in a
+    bounded LRU cache. On a miss the neighbourhood of the requested index is
+    read at once, so playing a recording forwards or backwards hits the cache.
+    """
+    def __init__(self, source, cache_size=SIGNATURE_CACHE_SIZE, read_ahead=SIGNATURE_READ_AHEAD):
+        """
+        Arguments:
+        source     -- container written by pack_signatures or directory with csv files
+        cache_size -- maximal number of signatures kept in memory
+        read_ahead -- number of signatures read after (and half as many before)
+                      a requested index that is not cached
+        """
+        self.source = source
+        self.cache_size = max(1, cache_size)
+        self.read_ahead = read_ahead
+        self.cache = collections.OrderedDict()
+        self.h5file = None
+        if os.path.isdir(source) :
+            self.files = [path for _, path in _signature_files(source)]
+            self.length = len(self.files)
+        else :
+            self.h5file = h5.File(source, 'r')
+            group = self.h5file['signatures']
+            self.offsets = group['offsets'][:]
+            self.shapes = group['shapes'][:]
+            self.values = group['values']
+            self.length = len(self.shapes)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.length :
+            raise IndexError(i)
+        if i in self.cache :
+            sig = self.cache.pop(i)
+            self.cache[i] = sig # most recently used
+            return sig
+        begin = max(0, i - self.read_ahead // 2)
+        end = min(self.length, i + self.read_ahead + 1)
+        for k, sig in zip(xrange(begin, end), self._read(begin, end)) :
+            self.cache.pop(k, None)
+            self.cache[k] = sig
+        self.cache[i] = self.cache.pop(i) # the requested signature is the most recent one
+        while len(self.cache) > self.cache_size :
+            self.cache.popitem(last=False)
+        return self.cache[i]
+
+    def _read(self, begin, end):
+        """
+        Reads the signatures [begin, end) from the source.
+        """
+        if self.h5file is None :
+            return [read_hand_signature(path) for path in self.files[begin:end]]
+        flat = self.values[self.offsets[begin]:self.offsets[end]]
+        sigs = []
+        for k in xrange(begin, end) :
+            a, b = self.offsets[k] - self.offsets[begin], self.offsets[k + 1] - self.offsets[begin]
+            sigs.append(flat[a:b].reshape(self.shapes[k]))
+        return sigs
+
+    def close(self):
+        """
+        Closes the container.
+        """
+        self.cache.clear()
+        if self.h5file is not None :
+            self.h5file.close()
+            self.h5file = None
+
+# -------------------------- Dataset catalog ---------------------------------
+def description_hash(desc):
+    """
+    Fingerprint of a feature description, files with the same hash share
+    their signal columns.
+
+    Arguments:
+    desc -- list of feature names
+
+    Returns: hex digest
+    """
+    return hashlib.md5('\n'.join([str(x) for x in desc])).hexdigest()
+
+def describe_file(fname):
+    """
+    Collects the metadata of a data file that is kept in the catalog.
+
+    Arguments:
+    fname -- the name of the HDF5 file
+
+    Returns: dict with the keys
+             samples         -- number of samples
+             description     -- list of feature names
+             desc_hash       -- see description_hash
+             classes         -- list of class names
+             class_counts    -- dict class name -> number of samples
+             class_segments  -- dict class name -> number of labeled segments
+             class_durations -- dict class name -> duration in timestamp units
+                                (number of samples if the file has no timestamps)
+             labeled         -- number of samples with a label other than the first class
+             timestamps      -- (first, last) timestamp or None
+             or None if the file is not a data file
+    """
+    try :
+        h5file = h5.File(fname, 'r')
+    except IOError :
+        return None
+    try :
+        if not 'data' in h5file or not 'data_desc' in h5file or not 'classes' in h5file['data_desc'] :
+            return None
+        desc, classes = read_description(h5file)
+        n = signal_shape(h5file)[0]
+        target = read_target(h5file, 0, n).astype(np.intp)
+        ts = None
+        for name in TIMESTAMP_DATASETS :
+            if name in h5file['data'] :
+                ts = h5file['data'][name][:n].astype(np.float64)
+                break
+    finally :
+        h5file.close()
+    nclasses = max(len(classes), int(target.max()) + 1 if len(target) > 0 else 0)
+    names = list(classes) + [str(i) for i in xrange(len(classes), nclasses)]
+    counts = np.bincount(target, minlength=nclasses)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(target)) + 1)) if len(target) > 0 else np.zeros((0), dtype=np.intp)
+    segments = np.bincount(target[starts], minlength=nclasses)
+    if ts is not None and len(ts) > 1 :
+        dt = np.diff(ts)
+        durations = np.bincount(target, weights=np.append(dt, np.median(dt)), minlength=nclasses)
+    else :
+        durations = counts.astype(np.float64)
+    return {'samples'         : n,
+            'description'     : desc,
+            'desc_hash'       : description_hash(desc),
+            'classes'         : classes,
+            'class_counts'    : dict(zip(names, [int(x) for x in counts])),
+            'class_segments'  : dict(zip(names, [int(x) for x in segments])),
+            'class_durations' : dict(zip(names, [float(x) for x in durations])),
+            'labeled'         : int(np.count_nonzero(target)),
+            'timestamps'      : None if ts is None or len(ts) == 0 else (float(ts[0]), float(ts[-1]))}
+
+def _describe_file_job(fname):
+    """
+    Wrapper of describe_file for the process pool of Catalog.update.
+    """
+    return fname, describe_file(fname)
+
+class Catalog(object):
+    """
+    Persisted metadata of all data files of a directory. Entries are reused as
+    long as modification time and size of a file are unchanged, so loaders and
+    reports can select files without opening them. Files that are not data
+    files are remembered the same way and not opened again.
+    """
+    VERSION = 1
+
+    def __init__(self, data_dir, fname=None):
+        """
+        Arguments:
+        data_dir -- directory with the h5 files
+        fname    -- location of the catalog, by default CATALOG_FNAME in data_dir
+        """
+        self.data_dir = data_dir
+        self.fname = fname if fname is not None else os.path.join(data_dir, CATALOG_FNAME)
+        stored = io.unserialize_object(self.fname)
+        self.entries = {}
+        self.rejected = {} # name -> (mtime, size) of the h5 files that are not data files
+        if isinstance(stored, dict) and stored.get('version') == Catalog.VERSION :
+            self.entries = stored['entries']
+            self.rejected = stored.get('rejected', {})
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.files())
+
+    def update(self, processes=None):
+        """
+        Re-reads the files that were added or changed since the last update and
+        stores the catalog.
+
+        Arguments:
+        processes -- number of worker processes, by default one less than the number of cpus
+
+        Returns: self
+        """
+        current = {}
+        rejected = {}
+        stale = []
+        for name in sorted(os.listdir(self.data_dir)) :
+            if not name.endswith('.h5') or name.endswith(('.bck.h5', '.repack.h5', PYRAMID_SUFFIX, SIGNATURE_ARCHIVE_SUFFIX)) : continue
+            st = os.stat(os.path.join(self.data_dir, name))
+            entry = self.entries.get(name)
+            if entry is not None and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size :
+                current[name] = entry
+            elif self.rejected.get(name) == (st.st_mtime, st.st_size) :
+                rejected[name] = self.rejected[name]
+            else :
+                stale.append(name)
+        changed = len(stale) > 0 or len(current) != len(self.entries) or len(rejected) != len(self.rejected)
+        if len(stale) > 0 :
+            paths = [os.path.join(self.data_dir, name) for name in stale]
+            if processes is None :
+                processes = max(1, mp.cpu_count() - 1)
+            if len(paths) == 1 or processes == 1 :
+                results = [_describe_file_job(path) for path in paths]
+            else :
+                pool = mp.Pool(min(processes, len(paths)))
+                try :
+                    results = pool.map(_describe_file_job, paths)
+                finally :
+                    pool.close()
+                    pool.join()
+            for path, entry in results :
+                st = os.stat(path)
+                if entry is None :
+                    rejected[os.path.basename(path)] = (st.st_mtime, st.st_size)
+                    continue
+                entry['mtime'] = st.st_mtime
+                entry['size'] = st.st_size
+                current[os.path.basename(path)] = entry
+        self.entries = current
+        self.rejected = rejected
+        if changed :
+            self.save()
+        return self
+
+    def save(self):
+        """
+        Stores the catalog, a read-only data directory is ignored.
+        """
+        try :
+            io.serialize_object({'version' : Catalog.VERSION, 'entries' : self.entries, 'rejected' : self.rejected}, self.fname)
+        except IOError :
+            pass
+
+    def entry(self, fname):
+        """
+        Returns the metadata of a file (see describe_file).
+
+        Arguments:
+        fname -- name or path of the file
+        """
+        return self.entries.get(os.path.basename(fname))
+
+    def files(self, classes=None, labeled=False, description=None, min_samples=0):
+        """
+        Selects files by their metadata.
+
+        Arguments:
+        classes     -- list of class names, only files with samples of one of these classes
+        labeled     -- if True only files with labeled samples
+        description -- list of feature names or description hash, only files with this description
+        min_samples -- minimal number of samples
+
+        Returns: sorted list of paths
+        """
+        if description is not None and not isinstance(description, basestring) :
+            description = description_hash(description)
+        selected = []
+        for name in sorted(self.entries.keys()) :
+            e = self.entries[name]
+            if e['samples'] < min_samples : continue
+            if labeled and e['labeled'] == 0 : continue
+            if description is not None and e['desc_hash'] != description : continue
+            if classes is not None and not any([e['class_counts'].get(c, 0) > 0 for c in classes]) : continue
+            selected.append(os.path.join(self.data_dir, name))
+        return selected
+
+    def class_counts(self, fnames=None):
+        """
+        Sums the number of samples per class.
+
+        Arguments:
+        fnames -- files to include, None for all
+
+        Returns: dict class name -> number of samples
+        """
+        return self._sum_entries('class_counts', fnames)
+
+    def class_durations(self, fnames=None):
+        """
+        Sums the duration per class.
+
+        Arguments:
+        fnames -- files to include, None for all
+
+        Returns: dict class name -> duration
+        """
+        return self._sum_entries('class_durations', fnames)
+
+    def class_segments(self, fnames=None):
+        """
+        Sums the number of labeled segments per class.
+
+        Arguments:
+        fnames -- files to include, None for all
+
+        Returns: dict class name -> number of segments
+        """
+        return self._sum_entries('class_segments', fnames)
+
+    def _sum_entries(self, key, fnames):
+        total = {}
+        names = self.entries.keys() if fnames is None else [os.path.basename(f) for f in fnames]
+        for name in names :
+            if not name in self.entries : continue
+            for c, v in self.entries[name][key].iteritems() :
+                total[c] = total.get(c, 0) + v
+        return total
+
+def get_catalog(data_dir, processes=None):
+    """
+    Returns the up to date catalog of a data directory.
+
+    Arguments:
+    data_dir  -- directory with the h5 files
+    processes -- number of worker processes for changed files
+
+    Returns: Catalog
+    """
+    return Catalog(data_dir).update(processes)
+
+# -------------------------- Storage profiles --------------------------------
+def get_storage_profile(profile=None):
+    """
+    Resolves a storage profile.
+
+    Arguments:
+    profile -- name of a profile in STORAGE_PROFILES, a profile dict or None
+               for the profile selected by STORAGE_PROFILE
+
+    Returns: profile dict
+    """
+    if profile is None :
+        profile = STORAGE_PROFILE
+    if isinstance(profile, dict) :
+        return profile
+    if not profile in STORAGE_PROFILES :
+        raise ValueError("Unknown storage profile '{0}', available: {1}".format(profile, ', '.join(sorted(STORAGE_PROFILES.keys()))))
+    return STORAGE_PROFILES[profile]
+
+def set_storage_profile(profile):
+    """
+    Selects the storage profile used by all writers of this module.
+
+    Arguments:
+    profile -- name of a profile in STORAGE_PROFILES
+    """
+    global STORAGE_PROFILE
+    get_storage_profile(profile) # validate
+    STORAGE_PROFILE = profile
+
+def dataset_options(shape, dtype, profile=None, resizable=False):
+    """
+    Computes the h5py create_dataset options of a storage profile. Chunks span
+    all columns and as many rows as fit into the chunk size of the profile, so
+    reading a time window touches only consecutive chunks.
+
+    Arguments:
+    shape     -- shape of the dataset
+    dtype     -- data type of the dataset
+    profile   -- storage profile (see get_storage_profile)
+    resizable -- if True the dataset can grow along the first axis
+
+    Returns: dict with keyword arguments for create_dataset
+    """
+    profile = get_storage_profile(profile)
+    options = {}
+    if not resizable and len(shape) > 0 and shape[0] == 0 :
+        return options # empty datasets cannot be chunked
+    if resizable :
+        options['maxshape'] = (None,) + tuple(shape[1:])
+    rowsize = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+    rows = max(1, profile['chunk_bytes'] // max(1, rowsize))
+    if not resizable and len(shape) > 0 :
+        rows = max(1, min(rows, shape[0]))
+    options['chunks'] = (rows,) + tuple(shape[1:])
+    if profile['compression'] is not None :
+        options['compression'] = profile['compression']
+        if profile.get('compression_opts') is not None :
+            options['compression_opts'] = profile['compression_opts']
+        options['shuffle'] = profile['shuffle']
+    return options
+
+def create_dataset(group, name, data=None, shape=None, dtype=None, profile=None, resizable=False):
+    """
+    Creates a numeric dataset with the layout of a storage profile. The 'signal'
+    dataset is stored with the signal data type of the profile.
+
+    Arguments:
+    group     -- HDF5 group in which the dataset is created
+    name      -- name of the dataset
+    data      -- numpy array with the content of the dataset
+    shape     -- shape of the dataset if data is None
+    dtype     -- data type of the dataset if data is None
+    profile   -- storage profile (see get_storage_profile)
+    resizable -- if True the dataset can grow along the first axis
+
+    Returns: the created dataset
+    """
+    if data is not None :
+        data = np.asarray(data)
+        shape = data.shape
+        dtype = data.dtype
+    if name == 'signal' :
+        dtype = get_storage_profile(profile)['signal_dtype']
+    options = dataset_options(shape, dtype, profile, resizable)
+    if data is not None and data.size > 0 :
+        return group.create_dataset(name, data=data.astype(dtype), **options)
+    return group.create_dataset(name, shape=shape, dtype=dtype, **options)
+
+def _create_appendable_dataset(group, name, dtype, ncols=None, profile=None):
+    """
+    Creates an empty, chunked dataset that can grow along the first axis.
+
+    Arguments:
+    group   -- HDF5 group in which the dataset is created
+    name    -- name of the dataset
+    dtype   -- data type of the dataset
+    ncols   -- number of columns, None for a one dimensional dataset
+    profile -- storage profile (see get_storage_profile)
+
+    Returns: the created dataset
+    """
+    shape = (0,) if ncols is None else (0, ncols)
+    return create_dataset(group, name, shape=shape, dtype=dtype, profile=profile, resizable=True)
+
+def write_target(h5_obj, target, profile=None):
+    """
+    Writes the dense target array of a file. The dataset is (re)created with
+    the storage profile if it does not exist or its size changed.
+
+    Arguments:
+    h5_obj  -- HDF5 object opened for writing
+    target  -- numpy array with one label id per sample
+    profile -- storage profile (see get_storage_profile)
+    """
+    group = h5_obj['data']
+    if 'target' in group and group['target'].shape == target.shape :
+        group['target'][:] = target
+        return
+    if 'target' in group :
+        del group['target']
+    create_dataset(group, 'target', data=np.asarray(target, dtype=np.int32), profile=profile)
+
+# -------------------------- Label store -------------------------------------
+def label_runs(labels):
+    """
+    Run-length encodes a dense label array. Runs of the first label (0, no
+    label) are dropped.
+
+    Arguments:
+    labels -- numpy array with one label id per sample
+
+    Returns: numpy array (runs x 3) with the columns start, end (exclusive), label id
+    """
+    labels = np.asarray(labels)
+    if len(labels) == 0 :
+        return np.zeros((0, 3), dtype=np.int64)
+    change = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(labels)]))
+    ids = labels[starts]
+    keep = ids != 0
+    return np.column_stack((starts[keep], ends[keep], ids[keep])).astype(np.int64)
+
+def dense_labels(intervals, begin, end, dtype=np.int32):
+    """
+    Materializes the labels of a window from an interval table. Later
+    intervals overwrite earlier ones.
+
+    Arguments:
+    intervals -- numpy array (intervals x 3) with start, end (exclusive), label id
+    begin     -- first sample of the window
+    end       -- end of the window (exclusive)
+    dtype     -- data type of the result
+
+    Returns: numpy array with one label id per sample of the window
+    """
+    target = np.zeros((max(0, end - begin)), dtype=dtype)
+    if len(intervals) == 0 : return target
+    intervals = np.asarray(intervals)
+    starts = np.clip(intervals[:, 0], begin, end) - begin
+    ends = np.clip(intervals[:, 1], begin, end) - begin
+    for k in np.flatnonzero(ends > starts) :
+        target[starts[k]:ends[k]] = intervals[k, 2]
+    return target
+
+def label_layers(h5_obj):
+    """
+    Returns the annotation layers with an interval table.
+
+    Arguments:
+    h5_obj -- the HDF5 object
+
+    Returns: list of layer names
+    """
+    if not LABEL_GROUP in h5_obj : return []
+    return [str(x) for x in h5_obj[LABEL_GROUP].keys()]
+
+def write_label_table(h5_obj, layer, intervals, names, profile=None):
+    """
+    Stores the interval table of an annotation layer, replacing the old one.
+
+    Arguments:
+    h5_obj    -- HDF5 object opened for writing
+    layer     -- name of the layer (e.g. 'gestures')
+    intervals -- list or array of (start, end, label id)
+    names     -- label names, the label id is the index into this list
+    profile   -- storage profile (see get_storage_profile)
+    """
+    group = h5_obj.require_group(LABEL_GROUP)
+    if layer in group :
+        del group[layer]
+    dset = create_dataset(group, layer, data=np.asarray(intervals, dtype=np.int64).reshape(-1, 3), profile=profile)
+    dset.attrs['names'] = '\n'.join(names)
+
+def read_label_table(h5_obj, layer):
+    """
+    Reads the interval table of an annotation layer.
+
+    Arguments:
+    h5_obj -- the HDF5 object
+    layer  -- name of the layer
+
+    Returns: tuple (intervals, names) or None if the layer has no table
+    """
+    if not layer in label_layers(h5_obj) : return None
+    dset = h5_obj[LABEL_GROUP][layer]
+    names = str(dset.attrs.get('names', ''))
+    return dset[:].reshape(-1, 3), names.split('\n') if len(names) > 0 else []
+
+def read_target(h5_obj, begin=None, end=None):
+    """
+    Reads the dense gesture labels of a window. If the file has an interval
+    table for the 'gestures' layer the labels are materialized from it,
+    otherwise the 'target' dataset is read.
+
+    Arguments:
+    h5_obj -- the HDF5 object
+    begin  -- first sample, None for the start of the recording
+    end    -- end of the window (exclusive), None for the end of the recording
+
+    Returns: numpy array (int32) with one label id per sample
+    """
+    table = read_label_table(h5_obj, 'gestures')
+    if table is None :
+        if 'target' in h5_obj['data'] :
+            return h5_obj['data']['target'][begin:end]
+        table = (np.zeros((0, 3), dtype=np.int64), [])
+    b, e, _ = slice(begin, end).indices(signal_shape(h5_obj)[0])
+    return dense_labels(table[0], b, e)
+
+def materialize_target(h5_obj, profile=None):
+    """
+    Writes the dense 'target' dataset from the interval table of the
+    'gestures' layer for tools that read it directly.
+
+    Arguments:
+    h5_obj  -- HDF5 object opened for writing
+    profile -- storage profile (see get_storage_profile)
+    """
+    write_target(h5_obj, read_target(h5_obj), profile)
+
+
+class LabelJournal(object):
+    """
+    Append-only journal of segment operations, one json object per line. The
+    operations are written and flushed by a background thread, so an
+    annotation session survives a crash and the cost of an edit does not
+    depend on the size of the recording. The journal is cleared when the
+    labels are stored in the data file.
+    """
+    _CLEAR = 'clear'
+
+    def __init__(self, fname):
+        """
+        Arguments:
+        fname -- path of the journal
+        """
+        self.fname = fname
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        """
+        Reads the operations of the journal. A line that was cut off by a
+        crash is ignored.
+
+        Returns: list of dicts
+        """
+        ops = []
+        if not os.path.exists(self.fname) : return ops
+        with open(self.fname, 'r') as f :
+            for line in f :
+                try :
+                    ops.append(json.loads(line))
+                except ValueError :
+                    break
+        return ops
+
+    def append(self, op):
+        """
+        Queues an operation for the writer.
+
+        Arguments:
+        op -- dict with the operation
+        """
+        self.queue.put(op)
+
+    def clear(self):
+        """
+        Removes all operations written so far.
+        """
+        self.queue.put(LabelJournal._CLEAR)
+
+    def flush(self):
+        """
+        Waits until all queued operations are written.
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Writes the queued operations and stops the writer.
+        """
+        if self.thread is None : return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        f = None
+        try :
+            while True :
+                op = self.queue.get()
+                try :
+                    if op is None : break
+                    if op == LabelJournal._CLEAR :
+                        if f is not None : f.close()
+                        f = None
+                        if os.path.exists(self.fname) : os.remove(self.fname)
+                        continue
+                    if f is None : f = open(self.fname, 'a')
+                    f.write(json.dumps(op))
+                    f.write('\n')
+                    if self.queue.empty() : # flush once a burst of operations is written
+                        f.flush()
+                        os.fsync(f.fileno())
+                except Exception as e : # the writer has to keep running, flush() waits for it
+                    log.error("Writing the label journal {0} failed: {1}".format(self.fname, e))
+                    if f is not None and op != LabelJournal._CLEAR :
+                        try :
+                            f.close()
+                        except Exception :
+                            pass
+                        f = None # reopened by the next operation
+                finally :
+                    self.queue.task_done()
+        finally :
+            if f is not None : f.close()
+
+# -------------------------- Signal layouts ----------------------------------
+def signal_layout(h5_obj):
+    """
+    Returns the signal layout of a file.
+
+    Arguments:
+    h5_obj -- the HDF5 object
+
+    Returns: 'rows' or 'columns'
+    """
+    return 'columns' if 'channels' in h5_obj['data'] else 'rows'
+
+def _channel_datasets(h5_obj):
+    """
+    Returns the datasets of the column layout in channel order.
+
+    Arguments:
+    h5_obj -- the HDF5 object
+
+    Returns: list of datasets, each holding a group of consecutive channels
+    """
+    channels = h5_obj['data']['channels']
+    return [channels[name] for name in sorted(channels.keys(), key=int)]
+
+def signal_shape(h5_obj):
+    """
+    Returns the shape of the signal independent of the layout.
+
+    Arguments:
+    h5_obj -- the HDF5 object
+
+    Returns: tuple (number of samples, number of channels)
+    """
+    if signal_layout(h5_obj) == 'rows' :
+        return h5_obj['data']['signal'].shape
+    dsets = _channel_datasets(h5_obj)
+    if len(dsets) == 0 :
+        return (0, 0)
+    return (dsets[0].shape[0], sum([d.shape[1] for d in dsets]))
+
+def read_signal(h5_obj, begin=None, end=None, columns=None):
+    """
+    Reads a time window of the signal independent of the layout. With the row
+    layout the window is read as one slab, with the column layout only the
+    channel groups that contain the requested columns are read.
+
+    Arguments:
+    h5_obj  -- the HDF5 object
+    begin   -- first sample, None for the start of the recording
+    end     -- end of the window (exclusive), None for the end of the recording
+    columns -- list of channel indices in the order of the result, None for all
+
+    Returns: numpy array (samples x columns)
+    """
+    if signal_layout(h5_obj) == 'rows' :
+        block = h5_obj['data']['signal'][begin:end]
+        return block if columns is None else block[:, columns]
+    dsets = _channel_datasets(h5_obj)
+    n, ncols = signal_shape(h5_obj)
+    if columns is None :
+        columns = range(ncols)
+    b, e, _ = slice(begin, end).indices(n)
+    out = np.empty((max(0, e - b), len(columns)), dtype=dsets[0].dtype if len(dsets) > 0 else np.float32)
+    offsets = np.cumsum([0] + [d.shape[1] for d in dsets])
+    needed = {}
+    for k, c in enumerate(columns) :
+        g = int(np.searchsorted(offsets, c, side='right')) - 1
+        needed.setdefault(g, []).append((k, c - offsets[g]))
+    for g, cols in needed.iteritems() :
+        block = dsets[g][b:e]
+        for k, c in cols :
+            out[:, k] = block[:, c]
+    return out
+
+class WindowCache(object):
+    """
+    Cache for time windows of the signal. The recording is split into aligned
+    blocks of rows with all channels, a window is assembled from cached
+    blocks and the missing blocks are read as one contiguous slab. The least
+    recently used blocks are dropped when the cache is full. After every read
+    a background thread reads the blocks ahead of the window in the direction
+    it moved (and half as many behind it), so panning only waits for newly
+    exposed blocks.
+    """
+    def __init__(self, h5_obj, block_size=WINDOW_BLOCK_SIZE, cache_bytes=WINDOW_CACHE_BYTES, prefetch=WINDOW_PREFETCH_BLOCKS):
+        """
+        Arguments:
+        h5_obj      -- the HDF5 object
+        block_size  -- rows of a block
+        cache_bytes -- memory of the cached blocks
+        prefetch    -- number of blocks read ahead of a window, 0 disables the read-ahead
+        """
+        self.h5_obj = h5_obj
+        self.block_size = max(1, block_size)
+        self.samples, ncols = signal_shape(h5_obj)
+        self.dtype = read_signal(h5_obj, 0, 0).dtype
+        block_bytes = self.block_size * max(1, ncols) * self.dtype.itemsize
+        self.cache_blocks = max(1, cache_bytes // block_bytes)
+        self.prefetch = prefetch
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.last = None # (first, last block) of the last window
+        self.generation = 0 # read-ahead requests of older windows are dropped
+        self.queue = Queue.Queue()
+        self.thread = None
+        if self.prefetch > 0 :
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def read(self, begin=None, end=None, columns=None):
+        """
+        Reads a time window of the signal, see read_signal.
+
+        Arguments:
+        begin   -- first sample, None for the start of the recording
+        end     -- end of the window (exclusive), None for the end of the recording
+        columns -- list of channel indices in the order of the result, None for all
+
+        Returns: numpy array (samples x columns)
+        """
+        b, e, _ = slice(begin, end).indices(self.samples)
+        if e <= b :
+            return read_signal(self.h5_obj, 0, 0, columns)
+        first, last = b // self.block_size, (e - 1) // self.block_size
+        blocks = self._blocks(first, last)
+        self._read_ahead(first, last)
+        offset = first * self.block_size
+        blocks[-1] = blocks[-1][:e - last * self.block_size]
+        blocks[0] = blocks[0][b - offset:]
+        if columns is not None :
+            blocks = [block[:, columns] for block in blocks]
+        return np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+
+    def _blocks(self, first, last):
+        """
+        Returns the blocks [first, last], missing blocks are read at once.
+        """
+        with self.lock :
+            blocks = [self.cache.get(k) for k in xrange(first, last + 1)]
+        missing = [first + i for i, block in enumerate(blocks) if block is None]
+        if len(missing) > 0 :
+            loaded = self._load(missing[0], missing[-1])
+            blocks = [loaded[first + i] if block is None else block for i, block in enumerate(blocks)]
+        with self.lock :
+            for i, block in enumerate(blocks) :
+                self.cache.pop(first + i, None)
+                self.cache[first + i] = block # most recently used
+            self._evict()
+        return blocks
+
+    def _load(self, first, last):
+        """
+        Reads the blocks [first, last] as one slab and adds them to the cache.
+
+        Returns: dict block index -> block
+        """
+        slab = read_signal(self.h5_obj, first * self.block_size, (last + 1) * self.block_size)
+        loaded = {}
+        with self.lock :
+            for k in xrange(first, last + 1) :
+                a = (k - first) * self.block_size
+                loaded[k] = slab[a:a + self.block_size]
+                self.cache.pop(k, None)
+                self.cache[k] = loaded[k]
+        return loaded
+
+    def _evict(self):
+        while len(self.cache) > self.cache_blocks :
+            self.cache.popitem(last=False)
+
+    def _read_ahead(self, first, last):
+        """
+        Queues the blocks around a window for the background thread.
+        """
+        direction = 1
+        if self.last is not None :
+            if first < self.last[0] : direction = -1
+            elif first == self.last[0] and last == self.last[1] : return
+        self.last = (first, last)
+        if self.thread is None : return
+        nblocks = (self.samples + self.block_size - 1) // self.block_size
+        ahead, behind = self.prefetch, self.prefetch // 2
+        if direction > 0 :
+            wanted = range(last + 1, last + 1 + ahead) + range(first - behind, first)
+        else :
+            wanted = range(first - ahead, first)[::-1] + range(last + 1, last + 1 + behind)
+        # never evict the window itself for blocks that are only guessed
+        wanted = [k for k in wanted if 0 <= k < nblocks][:max(0, self.cache_blocks - (last - first + 1))]
+        self.generation += 1
+        self.queue.put((self.generation, wanted))
+
+    def _run(self):
+        while True :
+            request = self.queue.get()
+            if request is None : break
+            generation, wanted = request
+            for k in wanted :
+                if generation != self.generation : break # the window moved on
+                with self.lock :
+                    if k in self.cache : continue
+                try :
+                    self._load(k, k)
+                except Exception :
+                    break # the file was closed
+            with self.lock :
+                self._evict()
+
+    def clear(self):
+        """
+        Drops all cached blocks.
+        """
+        with self.lock :
+            self.cache.clear()
+        self.last = None
+
+    def close(self):
+        """
+        Stops the background thread and drops all cached blocks.
+        """
+        if self.thread is not None :
+            self.generation += 1
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.clear()
+
+def create_signal(group, ncols, profile=None, layout=None, group_size=None):
+    """
+    Creates empty, resizable signal datasets in a layout.
+
+    Arguments:
+    group      -- the 'data' group of the file
+    ncols      -- number of channels
+    profile    -- storage profile (see get_storage_profile)
+    layout     -- 'rows' or 'columns', None for SIGNAL_LAYOUT
+    group_size -- channels per dataset of the column layout, None for CHANNEL_GROUP_SIZE
+
+    Returns: list of signal datasets in channel order (see append_signal)
+    """
+    if layout is None : layout = SIGNAL_LAYOUT
+    if group_size is None : group_size = CHANNEL_GROUP_SIZE
+    if not layout in SIGNAL_LAYOUTS :
+        raise ValueError("Unknown signal layout '{0}', available: {1}".format(layout, ', '.join(SIGNAL_LAYOUTS)))
+    if layout == 'rows' :
+        return [_create_appendable_dataset(group, 'signal', np.float32, ncols, profile)]
+    channels = group.create_group('channels')
+    dsets = []
+    for k, b in enumerate(xrange(0, ncols, group_size)) :
+        # datasets of the column layout follow the signal dtype of the profile
+        dset = create_dataset(channels, str(k), shape=(0, min(group_size, ncols - b)),
+                              dtype=get_storage_profile(profile)['signal_dtype'], profile=profile, resizable=True)
+        dsets.append(dset)
+    return dsets
+
+def set_signal_layout(layout, group_size=None):
+    """
+    Selects the signal layout used by all writers of this module.
+
+    Arguments:
+    layout     -- 'rows' or 'columns'
+    group_size -- channels per dataset of the column layout
+    """
+    global SIGNAL_LAYOUT, CHANNEL_GROUP_SIZE
+    if not layout in SIGNAL_LAYOUTS :
+        raise ValueError("Unknown signal layout '{0}', available: {1}".format(layout, ', '.join(SIGNAL_LAYOUTS)))
+    SIGNAL_LAYOUT = layout
+    if group_size is not None :
+        CHANNEL_GROUP_SIZE = max(1, int(group_size))
+
+def append_signal(dsets, block):
+    """
+    Appends samples to signal datasets created by create_signal.
+
+    Arguments:
+    dsets -- list of signal datasets
+    block -- numpy array (samples x channels)
+    """
+    b = 0
+    for dset in dsets :
+        _append_rows(dset, block[:, b:b + dset.shape[1]])
+        b += dset.shape[1]
+
+def repack_hdf(fname, profile=None, block_size=CSV_BLOCK_SIZE, layout=None, group_size=None):
+    """
+    Rewrites a data file in place with the layout of a storage profile.
+    Numeric datasets of the 'data' group are copied block wise, everything else
+    is copied unchanged. The signal can be converted to another layout.
+
+    Arguments:
+    fname      -- the name of the HDF5 file
+    profile    -- storage profile (see get_storage_profile)
+    block_size -- number of rows copied at once
+    layout     -- signal layout of the result, None keeps the layout of the file
+    group_size -- channels per dataset of the column layout, None for CHANNEL_GROUP_SIZE
+    """
+    tmp_name = '{0}.repack.h5'.format(fname)
+    src = h5.File(fname, 'r')
+    dst = h5.File(tmp_name, 'w')
+    try :
+        for key, value in src.attrs.items() :
+            dst.attrs[key] = value
+        for gname in src :
+            if gname != 'data' or not isinstance(src[gname], h5.Group) :
+                src.copy(gname, dst)
+                continue
+            group = dst.create_group(gname)
+            for key, value in src[gname].attrs.items() :
+                group.attrs[key] = value
+            n, ncols = signal_shape(src)
+            dsets = create_signal(group, ncols, profile, layout or signal_layout(src), group_size)
+            for b in xrange(0, n, block_size) :
+                append_signal(dsets, read_signal(src, b, b + block_size))
+            for name in src[gname] :
+                if name in ('signal', 'channels') : continue
+                dset = src[gname][name]
+                if not isinstance(dset, h5.Dataset) or dset.dtype.kind not in 'biuf' or len(dset.shape) == 0 :
+                    src[gname].copy(name, group)
+                    continue
+                out = create_dataset(group, name, shape=dset.shape, dtype=dset.dtype, profile=profile)
+                for b in xrange(0, dset.shape[0], block_size) :
+                    out[b:b + block_size] = dset[b:b + block_size]
+                for key, value in dset.attrs.items() :
+                    out.attrs[key] = value
+    finally :
+        src.close()
+        dst.close()
+    shutil.move(tmp_name, fname)
+
+# -------------------------- Summary pyramid ---------------------------------
+def pyramid_fname(fname):
+    """
+    Returns the name of the summary pyramid of a data file.
+    """
+    return fname + PYRAMID_SUFFIX
+
+def _summarize_blocks(block, size):
+    """
+    Min, max, mean and number of valid values of consecutive blocks of rows.
+    NaN values are ignored, the last block may be shorter.
+
+    Arguments:
+    block -- numpy array (samples x channels)
+    size  -- rows per block
+
+    Returns: (min, max, mean, count), arrays (blocks x channels)
+    """
+    starts = np.arange(0, len(block), size)
+    valid = ~np.isnan(block)
+    count = np.add.reduceat(valid, starts, axis=0).astype(np.int32)
+    total = np.add.reduceat(np.where(valid, block, 0), starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore') :
+        mean = total / count
+    return np.fmin.reduceat(block, starts, axis=0), np.fmax.reduceat(block, starts, axis=0), mean, count
+
+def _merge_summaries(mn, mx, mean, count, factor):
+    """
+    Merges groups of factor consecutive summary blocks (see _summarize_blocks).
+    """
+    starts = np.arange(0, len(mn), factor)
+    count_m = np.add.reduceat(count, starts, axis=0)
+    total = np.add.reduceat(np.where(count > 0, mean * count, 0), starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore') :
+        mean_m = total / count_m
+    return np.fmin.reduceat(mn, starts, axis=0), np.fmax.reduceat(mx, starts, axis=0), mean_m, count_m
+
+def _signal_fingerprint(h5_obj, probes=16, rows=64):
+    """
+    Fingerprint of the signal from its shape and a few rows spread over the
+    recording. Unlike the modification time it does not change when labels
+    are written to the file.
+
+    Returns: hex digest
+    """
+    n, ncols = signal_shape(h5_obj)
+    md5 = hashlib.md5(str((n, ncols)))
+    for b in np.unique(np.linspace(0, max(0, n - rows), probes).astype(np.int64)) :
+        md5.update(np.ascontiguousarray(read_signal(h5_obj, b, b + rows)).tostring())
+    return md5.hexdigest()
+
+def build_pyramid(fname, fname_out=None, base=PYRAMID_BASE, factor=PYRAMID_FACTOR, block_size=10 * CSV_BLOCK_SIZE, profile=None, cancel=None):
+    """
+    Writes the summary pyramid of a data file: for every channel the min, max
+    and mean of blocks of base samples, and coarser levels that merge factor
+    blocks of the level below, until a level has less than PYRAMID_MIN_BLOCKS
+    blocks. The signal is read once in blocks, the levels above the finest are
+    computed from the level below. The pyramid is written to a temporary file
+    that replaces fname_out when it is complete. A cancelled build closes the
+    data file after the current block and removes the temporary file.
+
+    Arguments:
+    fname      -- the name of the HDF5 file
+    fname_out  -- name of the pyramid, None for pyramid_fname(fname)
+    base       -- samples per block of the finest level
+    factor     -- blocks merged per level
+    block_size -- number of rows read at once
+    profile    -- storage profile (see get_storage_profile)
+    cancel     -- threading.Event that cancels the build when it is set
+
+    Returns: the name of the pyramid, None if the build was cancelled
+    """
+    cancelled = lambda : cancel is not None and cancel.is_set()
+    if fname_out is None : fname_out = pyramid_fname(fname)
+    block_size = max(base, block_size - block_size % base)
+    tmp_name = '{0}.tmp'.format(fname_out)
+    src = h5.File(fname, 'r')
+    dst = h5.File(tmp_name, 'w')
+    try :
+        n, ncols = signal_shape(src)
+        dst.attrs['samples'] = n
+        dst.attrs['source_hash'] = _signal_fingerprint(src)
+        levels = dst.create_group('levels')
+        level = levels.create_group('0')
+        level.attrs['block_size'] = base
+        dsets = [_create_appendable_dataset(level, name, dtype, ncols, profile)
+                 for name, dtype in (('min', np.float32), ('max', np.float32), ('mean', np.float32), ('count', np.int32))]
+        for b in xrange(0, n, block_size) :
+            if cancelled() : break
+            for dset, rows in zip(dsets, _summarize_blocks(read_signal(src, b, b + block_size).astype(np.float64), base)) :
+                _append_rows(dset, rows)
+        k = 0
+        while not cancelled() and level['min'].shape[0] >= PYRAMID_MIN_BLOCKS :
+            below = level
+            k += 1
+            level = levels.create_group(str(k))
+            level.attrs['block_size'] = below.attrs['block_size'] * factor
+            dsets = [_create_appendable_dataset(level, name, below[name].dtype, ncols, profile) for name in ('min', 'max', 'mean', 'count')]
+            step = factor * max(1, block_size // base)
+            for b in xrange(0, below['min'].shape[0], step) :
+                if cancelled() : break
+                parts = [below[name][b:b + step] for name in ('min', 'max', 'mean', 'count')]
+                for dset, rows in zip(dsets, _merge_summaries(*(parts + [factor]))) :
+                    _append_rows(dset, rows)
+    finally :
+        src.close()
+        dst.close()
+    if cancelled() :
+        os.remove(tmp_name)
+        return None
+    shutil.move(tmp_name, fname_out)
+    return fname_out
+
+def build_pyramid_async(fname, callback=None, cancel=None):
+    """
+    Builds the summary pyramid of a data file in a background thread. The
+    thread keeps the data file open for reading, it has to be cancelled and
+    joined before the file is opened for writing.
+
+    Arguments:
+    fname    -- the name of the HDF5 file
+    callback -- called with fname from the background thread when the pyramid is written
+    cancel   -- threading.Event that cancels the build when it is set
+
+    Returns: the started thread
+    """
+    def run() :
+        try :
+            if build_pyramid(fname, cancel=cancel) is None : return
+        except Exception :
+            log.exception("Building the summary of {0} failed".format(fname))
+            return
+        if callback is not None : callback(fname)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def get_pyramid(fname):
+    """
+    Opens the summary pyramid of a data file.
+
+    Returns: Pyramid or None if there is no pyramid or the signal changed since it was built
+    """
+    pname = pyramid_fname(fname)
+    if not os.path.exists(pname) : return None
+    try :
+        pyramid = Pyramid(pname)
+    except (IOError, KeyError) :
+        return None
+    src = h5.File(fname, 'r')
+    try :
+        fingerprint = _signal_fingerprint(src)
+    finally :
+        src.close()
+    if pyramid.stamp != fingerprint :
+        pyramid.close()
+        return None
+    return pyramid
+
+class Pyramid(object):
+    """
+    Read access to a summary pyramid written by build_pyramid. For a range of
+    samples drawn on a number of pixel columns the coarsest level with at
+    least one block per column is read, so an overview of a whole recording
+    reads a few thousand rows instead of the signal.
+    """
+    def __init__(self, fname):
+        """
+        Arguments:
+        fname -- name of the pyramid
+        """
+        self.h5file = h5.File(fname, 'r')
+        self.samples = int(self.h5file.attrs['samples'])
+        self.stamp = str(self.h5file.attrs['source_hash'])
+        group = self.h5file['levels']
+        self.levels = [group[str(k)] for k in xrange(len(group))]
+        self.block_sizes = [int(level.attrs['block_size']) for level in self.levels]
+
+    def level(self, samples, columns):
+        """
+        Returns the index of the coarsest level with at least one block per
+        column, None if the raw samples are needed.
+
+        Arguments:
+        samples -- number of samples of the range
+        columns -- number of pixel columns
+        """
+        per_column = float(samples) / max(1, columns)
+        best = None
+        for k, size in enumerate(self.block_sizes) :
+            if size <= per_column : best = k
+        return best
+
+    def read(self, begin, end, columns, channels=None, level=None):
+        """
+        Reads the summary of a range of samples.
+
+        Arguments:
+        begin    -- first sample
+        end      -- end of the range (exclusive)
+        columns  -- number of pixel columns the range is drawn on
+        channels -- list of column indices, None for all
+        level    -- level to read, None selects it with level()
+
+        Returns: (x, min, max, mean) with the first sample of every block and
+                 arrays (blocks x channels), None if the raw samples are needed
+        """
+        begin = max(0, begin)
+        end = min(self.samples, end)
+        if level is None : level = self.level(end - begin, columns)
+        if level is None or end <= begin : return None
+        size = self.block_sizes[level]
+        a, b = begin // size, (end + size - 1) // size
+        group = self.levels[level]
+        parts = []
+        for name in ('min', 'max', 'mean') :
+            dset = group[name]
+            if channels is None :
+                parts.append(dset[a:b])
+            elif len(channels) == 0 :
+                parts.append(np.zeros((b - a, 0), dtype=dset.dtype))
+            else :
+                # h5py needs increasing column indices
+                columns_u, inverse = np.unique(channels, return_inverse=True)
+                parts.append(dset[a:b, list(columns_u)][:, inverse])
+        return [np.arange(a, b) * size] + parts
+
+    def span(self, begin, end, channels=None, columns=1024):
+        """
+        Returns the minimum and maximum of a range of samples from a level
+        with about columns blocks; blocks at the borders may extend the range.
+
+        Returns: (min, max) or None if the raw samples are needed
+        """
+        summary = self.read(begin, end, columns, channels)
+        if summary is None or len(summary[0]) == 0 : return None
+        return np.nanmin(summary[1]), np.nanmax(summary[2])
+
+    def close(self):
+        """
+        Closes the pyramid.
+        """
+        if self.h5file is not None :
+            self.h5file.close()
+            self.h5file = None
+
+def _append_rows(dset, rows):
+    """
+    Appends rows to a resizable dataset.
+
+    Arguments:
+    dset -- dataset created by _create_appendable_dataset
+    rows -- numpy array with the rows to append
+    """
+    n = dset.shape[0]
+    dset.resize(n + len(rows), axis=0)
+    dset[n:] = rows
+
+def _parse_csv_rows(lines):
+    """
+    Parses csv lines row by row with the csv module. This handles quoted
+    values and is used as fallback by parse_csv_block.
+
+    Arguments:
+    lines -- list of csv lines without header
+
+    Returns: numpy array (float32) with one row per line
+    """
+    datareader = csv.reader(lines, delimiter=',', quotechar='|')
+    return np.array([[round(float(v), 4) for v in row] for row in datareader if len(row) > 0], dtype=np.float32)
+
+def parse_csv_block(lines, ncols=None):
+    """
+    Decodes a block of numeric csv lines at once into a numpy array. Values are
+    rounded to 4 decimals like in the row wise parser. Lines that contain quotes
+    or do not decode into a full matrix are parsed with _parse_csv_rows.
+
+    Arguments:
+    lines -- list of csv lines without header
+    ncols -- expected number of columns, if None it is taken from the first line
+
+    Returns: numpy array (float32) with one row per line
+
+    Raises ValueError if a line does not have ncols values.
+    """
+    lines = [l for l in lines if l.strip()]
+    if len(lines) == 0 :
+        return np.zeros((0, 0 if ncols is None else ncols), dtype=np.float32)
+    if ncols is None :
+        ncols = lines[0].count(',') + 1
+    text = ','.join([l.rstrip('\r\n') for l in lines])
+    if '|' in text or '"' in text :
+        return _parse_csv_rows(lines)
+    # the joined values of ragged lines could still add up to a full matrix
+    for i, l in enumerate(lines) :
+        if l.count(',') != ncols - 1 :
+            raise ValueError("Line {0} of the csv block has {1} values, expected {2}".format(i, l.count(',') + 1, ncols))
+    values = np.fromstring(text, dtype=np.float64, sep=',')
+    if values.size != len(lines) * ncols :
+        return _parse_csv_rows(lines)
+    # round half away from zero like round()
+    values = np.sign(values) * np.floor(np.abs(values) * 1e4 + 0.5) / 1e4
+    return values.astype(np.float32).reshape(len(lines), ncols)
+
+def _csv_row_blocks(csvfile, block_size, ncols=None):
+    """
+    Reads the lines of a csv file in blocks of a fixed size and decodes them.
+
+    Arguments:
+    csvfile    -- file object positioned behind the header
+    block_size -- maximum number of rows per block
+    ncols      -- number of columns of the file
+
+    Returns: generator of numpy arrays with at most block_size rows
+    """
+    while True :
+        lines = list(itertools.islice(csvfile, block_size))
+        if len(lines) == 0 : break
+        block = parse_csv_block(lines, ncols)
+        if len(block) > 0 :
+            yield block
+
+def convert_csv_to_hdf(fname, fname_out, preserve_target=True, classes=[], exclude=[], rel_data=[], block_size=CSV_BLOCK_SIZE, profile=None, layout=None):
     """
     Read data from csv file and converts it to h5.
 
+    The file is parsed in blocks of block_size rows which are appended to
+    resizable datasets, so the memory needed is bounded by the block size and
+    not by the length of the recording.
+
     Arguments:
     fname           -- the name of the csv file
     fname_out       -- export hdf5 name
@@ -221,169 +1802,218 @@ def convert_csv_to_hdf(fname, fname_out, preserve_target=True, classes=[], exclu
     classes         -- list of classes
     exclude         -- list of excludes
     rel_data        -- list of relative data this additionally computes relative features
+    block_size      -- number of rows that are parsed and written at once
+    profile         -- storage profile of the datasets (see get_storage_profile)
+    layout          -- signal layout ('rows' or 'columns'), None for SIGNAL_LAYOUT
 
     """
     lHeader = []
-    num_samples = 0
     excludeHeaders = []
     excludeIndex = []
     includeIndex = []
+    relIndex = []
     headerIndex = {}
-    data = []
     if not os.path.exists(fname) or not os.path.isfile(fname) :
         return
-    with open(fname, 'rb') as csvfile:
-        datareader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        bHeader = True
-        for row in datareader:
-            if bHeader :
-                for i in xrange(len(row)) :
-                    headerIndex[row[i]] = i
-                    if row[i] in exclude :
-                        excludeHeaders.append(row[i].lower())
-                        excludeIndex.append(i)
-                    else :
-                        lHeader.append(row[i])
-                        includeIndex.append(i)
-
-                bHeader = False
-            else :
-                data.append([round(float(v), 4) for v in row])
-                num_samples += 1
-    target = None
-    for hi in xrange(len(lHeader)) :
-        if lHeader[hi] in rel_data :
-            lHeader.append('relative {0}'.format(lHeader[hi]))
-            index = headerIndex[lHeader[hi]]
-            print len(data), " i : ", index, " -> ", lHeader[hi]
-            rel = p.absolute_to_relative([val[index] for val in data])
-            for i in xrange(len(data)):
-                data[i].append(rel[i])
-            includeIndex.append(len(data[0])-1)
-
+    old_samples = 0
+    old_file = None
     if os.path.exists(fname_out) :
-        target = get_labels(fname_out) # we want to ensure NOT to use already existing labeled data
-        shutil.move(fname_out, '{0}.bck.h5'.format(fname_out))
-    else :
-        target = np.zeros((num_samples),dtype=np.int32)
-    npdata = np.array(data, dtype=np.float32)
+        # we want to ensure NOT to use already existing labeled data
+        backup = '{0}.bck.h5'.format(fname_out)
+        shutil.move(fname_out, backup)
+        old_file = h5.File(backup, 'r')
+        old_samples = signal_shape(old_file)[0]
     f = h5.File(fname_out,'w')
     try :
-        data_group = f.create_group('data')
-        data_desc_group = f.create_group('data_desc')
-        data_group.create_dataset('seqid', data=np.zeros((num_samples),dtype=np.int32))
-        data_group.create_dataset('signal', data=npdata[:, includeIndex])
-        for e in xrange(len(excludeHeaders)) :
-            data_group.create_dataset(excludeHeaders[e],
-                        data=npdata[:,excludeIndex[e]])
-        data_group.create_dataset('target', data=target)
-        data_desc_group.create_dataset('classes', data=classes)
-        data_desc_group.create_dataset('description', data=lHeader)
+        with open(fname, 'rb') as csvfile:
+            header = next(csv.reader([next(csvfile, '')], delimiter=',', quotechar='|'), [])
+            for i in xrange(len(header)) :
+                headerIndex[header[i]] = i
+                if header[i] in exclude :
+                    excludeHeaders.append(header[i].lower())
+                    excludeIndex.append(i)
+                else :
+                    lHeader.append(header[i])
+                    includeIndex.append(i)
+            for hi in xrange(len(lHeader)) :
+                if lHeader[hi] in rel_data :
+                    relIndex.append(headerIndex[lHeader[hi]])
+                    lHeader.append('relative {0}'.format(lHeader[hi]))
+            data_group = f.create_group('data')
+            data_desc_group = f.create_group('data_desc')
+            seqid = _create_appendable_dataset(data_group, 'seqid', np.int32, profile=profile)
+            signal = create_signal(data_group, len(lHeader), profile, layout)
+            excluded = [_create_appendable_dataset(data_group, name, np.float32, profile=profile) for name in excludeHeaders]
+            target = _create_appendable_dataset(data_group, 'target', np.int32, profile=profile)
+            data_desc_group.create_dataset('classes', data=classes)
+            data_desc_group.create_dataset('description', data=lHeader)
+            num_samples = 0
+            last_values = None
+            for block in _csv_row_blocks(csvfile, block_size, len(header)) :
+                n = len(block)
+                # relative features continue across block borders
+                rel = np.diff(block[:, relIndex], axis=0)
+                first = block[:1, relIndex] if last_values is None else block[:1, relIndex] - last_values
+                last_values = block[-1:, relIndex]
+                append_signal(signal, np.hstack((block[:, includeIndex], np.vstack((first, rel)))))
+                for e in xrange(len(excludeHeaders)) :
+                    _append_rows(excluded[e], block[:, excludeIndex[e]])
+                block_target = np.zeros((n), dtype=np.int32)
+                if old_file is not None and num_samples < old_samples :
+                    labels = read_target(old_file, num_samples, min(old_samples, num_samples + n))
+                    block_target[:len(labels)] = labels
+                _append_rows(target, block_target)
+                _append_rows(seqid, np.zeros((n), dtype=np.int32))
+                num_samples += n
+            if old_file is not None and LABEL_GROUP in old_file :
+                old_file.copy(LABEL_GROUP, f)
     finally :
         f.close()
+        if old_file is not None :
+            old_file.close()
 
 
-def get_child(node, name):
+def parse_pose_file(fname):
     """
-    Get the child with the given name
-    Parameters:
-    node -- node
-    name -- name of the node
-    """
-    for n in node.childNodes:
-        if name and n.nodeName == name:
-            return n
+    Parses a single Kinect pose file incrementally. The timestamp of the
+    frame is taken from the file name.
 
-def get_children_of(node):
-    """
-    Get the element children.
+    Arguments:
+    fname -- path to the xml file of the frame
 
+    Returns: tuple (timestamp, header, values) or None if the file does not
+             contain a pose
+
+    Raises ValueError if the header of the frame has duplicate columns.
     """
-    return filter(lambda x: x.nodeType == x.ELEMENT_NODE, node.childNodes)
+    values = {}
+    parts = {'joints' : [], 'bodyparts' : []} # names in the order of the file, joints and bodyparts share them
+    path = []
+    for event, elem in ElementTree.iterparse(fname, events=('start', 'end')) :
+        if event == 'start' :
+            if len(path) == 0 and elem.tag != 'pose' : return None
+            path.append(elem.tag)
+            continue
+        if len(path) == 5 and path[1] == 'joints' and path[3] == 'euler' :
+            part = 'joint_{0}'.format(path[2])
+            values['{0}_{1}'.format(part, elem.tag)] = float(elem.text.strip())
+        elif len(path) == 5 and path[1] == 'bodyparts' :
+            part = 'position_{0}'.format(path[2])
+            scope = 'local' if path[3] == 'localposition' else 'global'
+            values['{0}_{1}_{2}'.format(part, scope, elem.tag)] = float(elem.text.strip())
+        elif len(path) == 3 and path[1] in parts and not path[2] in parts[path[1]] :
+            parts[path[1]].append(path[2])
+        path.pop()
+        elem.clear()
+    header = []
+    for part in parts['joints'] :
+        if 'joint_{0}_x'.format(part) in values :
+            header.extend(['joint_{0}_{1}'.format(part, a) for a in ('x', 'y', 'z')])
+    for part in parts['bodyparts'] :
+        if 'position_{0}_local_x'.format(part) in values :
+            header.extend(['position_{0}_{1}_{2}'.format(part, s, a) for s in ('local', 'global') for a in ('x', 'y', 'z')])
+    if len(set(header)) != len(header) :
+        raise ValueError("Duplicate columns in the pose of '{0}'".format(fname))
+    return int(os.path.basename(fname)[:-4]), header, [values[h] for h in header]
 
-def get_float_value(node):
-    return float(node.firstChild.data.strip())
+def _parse_pose_shard(fnames):
+    """
+    Parses a shard of pose files (used by the process pool of convert_xmldir_to_hdf).
 
-def parse_position(node):
-    g_local = get_child(node, 'localposition')
-    g_pos   = get_child(node, 'globalposition')
-    return [get_float_value(get_child(g_local, 'x')), get_float_value(get_child(g_local, 'y')), get_float_value(get_child(g_local, 'z')),
-            get_float_value(get_child(g_pos, 'x')), get_float_value(get_child(g_pos, 'y')), get_float_value(get_child(g_pos, 'z'))]
+    Arguments:
+    fnames -- list of xml files
 
-def parse_euler(node):
-    x_val = get_child(node, 'x')
-    y_val = get_child(node, 'y')
-    z_val = get_child(node, 'z')
-    return [get_float_value(x_val), get_float_value(y_val), get_float_value(z_val)]
+    Returns: tuple (timestamps, header, values) where values is a float32 array
+             with one row per frame in the order of the header
+    """
+    timestamps = []
+    header = None
+    rows = []
+    for fname in fnames :
+        frame = parse_pose_file(fname)
+        if frame is None : continue
+        ts, fheader, fvalues = frame
+        if header is None :
+            header = fheader
+        elif fheader != header : # frames with missing or reordered features
+            lookup = dict(zip(fheader, fvalues))
+            fvalues = [lookup.get(h, np.nan) for h in header]
+        timestamps.append(ts)
+        rows.append(fvalues)
+    return np.array(timestamps, dtype=np.int64), header, np.array(rows, dtype=np.float32)
 
-def convert_xmldir_to_hdf(dname, fname_out, preserve_target=True, classes=[], exclude=[], rel_data=[]):
+def convert_xmldir_to_hdf(dname, fname_out, preserve_target=True, classes=[], exclude=[], rel_data=[], processes=None, shard_size=XML_SHARD_SIZE, profile=None, layout=None):
     """
-    Read data from csv file and converts it to h5.
+    Read the Kinect pose files (one xml file per frame) of a directory and converts them to h5.
+
+    The files are parsed in shards by a process pool and merged in timestamp
+    order into preallocated arrays.
 
     Arguments:
-    fname           -- the name of the csv file
+    dname           -- directory with the xml files
     fname_out       -- export hdf5 name
     preserve_target -- if already a h5-file with target exists
     classes         -- list of classes
     exclude         -- list of excludes
     rel_data        -- list of relative data this additionally computes relative features
+    processes       -- number of worker processes, by default one less than the number of cpus
+    shard_size      -- number of files parsed by a worker at once
+    profile         -- storage profile of the datasets (see get_storage_profile)
+    layout          -- signal layout ('rows' or 'columns'), None for SIGNAL_LAYOUT
 
     """
-    lHeader = []
-    num_samples = 0
-    timestamps = []
-    data = {}
     if not os.path.exists(dname) or not os.path.isdir(dname) :
         return
-    for tr_xml in [fname for fname in os.listdir(dname) if fname.endswith('.xml')] :
-        dom_model = dom.parse(os.path.join(dname, tr_xml))
-        timestamps.append(int(fname[:-4]))
-        if dom_model.firstChild.nodeName !=  'pose' : continue
-        root = dom_model.documentElement
-        for angle in  get_children_of(get_child(root, 'joints')) :
-            n = 'joint_{0}'.format(str(angle.nodeName))
-            if n not in data :
-                data[n] = []
-            data[n].append(parse_euler(get_child(angle, 'euler')))
-        for pos in get_children_of(get_child(root, 'bodyparts')) :
-            n = 'position_{0}'.format(str(pos.nodeName))
-            if n not in data :
-                data[n] = []
-            data[n].append(parse_position(pos))
-        num_samples += 1
-    target = None
-    odata = []
-    for h, val in data.items() :
-        if len(val[0]) == 3 :
-            lHeader.append('{0}_x'.format(h))
-            lHeader.append('{0}_y'.format(h))
-            lHeader.append('{0}_z'.format(h))
-            for i in xrange(3) :
-                odata.append([v[i] for v in val])
-        elif len(val[0]) == 6 :
-            lHeader.append('{0}_local_x'.format(h))
-            lHeader.append('{0}_local_y'.format(h))
-            lHeader.append('{0}_local_z'.format(h))
-            lHeader.append('{0}_global_x'.format(h))
-            lHeader.append('{0}_global_y'.format(h))
-            lHeader.append('{0}_global_z'.format(h))
-            for i in xrange(6) :
-                odata.append([v[i] for v in val])
+    fnames = [os.path.join(dname, fname) for fname in sorted(os.listdir(dname)) if fname.endswith('.xml')]
+    shards = [fnames[i:i + shard_size] for i in xrange(0, len(fnames), shard_size)]
+    if processes is None :
+        processes = max(1, mp.cpu_count() - 1)
+    pool = mp.Pool(processes)
+    try :
+        # in shard order, the merged header must not depend on which worker finishes first
+        results = [r for r in pool.imap(_parse_pose_shard, shards) if len(r[0]) > 0]
+    finally :
+        pool.close()
+        pool.join()
+    lHeader = []
+    for _, header, _ in results :
+        lHeader.extend([h for h in header if h not in lHeader])
+    num_samples = sum([len(r[0]) for r in results])
+    timestamps = np.zeros((num_samples), dtype=np.int64)
+    npdata = np.empty((num_samples, len(lHeader)), dtype=np.float32)
+    npdata.fill(np.nan)
+    offset = 0
+    for ts, header, values in results :
+        n = len(ts)
+        timestamps[offset:offset + n] = ts
+        npdata[offset:offset + n, [lHeader.index(h) for h in header]] = values
+        offset += n
+    order = np.argsort(timestamps, kind='mergesort')
+    timestamps = timestamps[order]
+    npdata = npdata[order]
 
+    target = np.zeros((num_samples), dtype=np.int32)
+    backup = None
     if os.path.exists(fname_out) :
-        target = get_labels(fname_out) # we want to ensure NOT to use already existing labeled data
-        shutil.move(fname_out, '{0}.bck.h5'.format(fname_out))
-    else :
-        target = np.zeros((num_samples),dtype=np.int32)
-    npdata = np.array(odata, dtype=np.float32).reshape(num_samples, len(lHeader))
+        labels = get_labels(fname_out)[:num_samples] # we want to ensure NOT to use already existing labeled data
+        target[:len(labels)] = labels
+        backup = '{0}.bck.h5'.format(fname_out)
+        shutil.move(fname_out, backup)
     f = h5.File(fname_out,'w')
     try :
+        if backup is not None :
+            old_file = h5.File(backup, 'r')
+            try :
+                if LABEL_GROUP in old_file :
+                    old_file.copy(LABEL_GROUP, f)
+            finally :
+                old_file.close()
         data_group = f.create_group('data')
         data_desc_group = f.create_group('data_desc')
-        data_group.create_dataset('timestamps', data=timestamps)
-        data_group.create_dataset('seqid', data=np.zeros((num_samples),dtype=np.int32))
-        data_group.create_dataset('signal', data=npdata)
-        data_group.create_dataset('target', data=target)
+        create_dataset(data_group, 'timestamps', data=timestamps, profile=profile)
+        create_dataset(data_group, 'seqid', data=np.zeros((num_samples),dtype=np.int32), profile=profile)
+        append_signal(create_signal(data_group, len(lHeader), profile, layout), npdata)
+        create_dataset(data_group, 'target', data=target, profile=profile)
         data_desc_group.create_dataset('classes', data=classes)
         data_desc_group.create_dataset('description', data=lHeader)
     finally :
@@ -5,13 +5,19 @@
 """
 from PyQt4 import QtCore, QtGui
 import h5py as h5
+import logging
 import mmaat
 import mmaat.data as data
 import numpy as np
 import os
+import Queue
+import threading
 import time
 
+log = logging.getLogger("mmaat.ui.models.sensordata")
+
 HORIZONTAL_HEADERS = ["Channel"]
+MAX_RAW_SPAN = 500000 # longer windows are drawn from the summary pyramid only and not read into memory
 
 
 def hsv_display_colors(ncolors, hrange=(0,360), srange=(255,255), vrange=(65,255), nh='auto', ns=1, nv='auto'):
@@ -363,6 +369,328 @@ class SensorDataModelSegment(object):
         self.name = name
 
 
+class SegmentStore(object):
+    """
+    Container of segments with constant time access by segment id and logarithmic range
+    queries. Any object with the attributes sid, start and end can be stored.
+
+    The segments are kept in arrays sorted by their start together with the running
+    maximum of their ends, so the segments overlapping [a,b] are found by two binary
+    searches. The arrays are rebuilt lazily after segments were added or removed;
+    moves that keep the order of the starts are applied in place.
+    Iteration and indexing follow the order of the starts.
+    """
+    def __init__(self, segments=()):
+        """
+        Arguments:
+        segments -- initial segments
+        """
+        self.by_sid = {}
+        self.ordered = []
+        self.starts = np.zeros(0, dtype=np.float64)
+        self.ends = np.zeros(0, dtype=np.float64)
+        self.maxends = np.zeros(0, dtype=np.float64)
+        self.positions = {}
+        self.dirty = False
+        self.extend(segments)
+
+    def __len__(self):
+        return len(self.by_sid)
+
+    def __iter__(self):
+        self._index()
+        return iter(self.ordered[:])
+
+    def __getitem__(self, i):
+        """
+        Returns the i-th segment (or a list for slices) in the order of the starts.
+        """
+        self._index()
+        return self.ordered[i]
+
+    def __contains__(self, sid):
+        return sid in self.by_sid
+
+    def _index(self):
+        if not self.dirty : return
+        segments = self.by_sid.values()
+        starts = np.array([s.start for s in segments], dtype=np.float64)
+        order = np.argsort(starts, kind='mergesort')
+        self.ordered = [segments[i] for i in order]
+        self.starts = starts[order]
+        self.ends = np.array([s.end for s in self.ordered], dtype=np.float64)
+        self.maxends = np.maximum.accumulate(self.ends) if len(self.ends) > 0 else self.ends
+        self.positions = dict((s.sid, i) for i, s in enumerate(self.ordered))
+        self.dirty = False
+
+    def add(self, segment):
+        """
+        Adds a segment, a segment with the same sid is replaced.
+        """
+        self.by_sid[segment.sid] = segment
+        self.dirty = True
+
+    def extend(self, segments):
+        """
+        Adds several segments.
+        """
+        for segment in segments :
+            self.by_sid[segment.sid] = segment
+        self.dirty = True
+
+    def remove(self, segment):
+        """
+        Removes a segment, unknown segments are ignored.
+
+        Arguments:
+        segment -- the segment or its sid
+        """
+        sid = getattr(segment, 'sid', segment)
+        if sid in self.by_sid :
+            del self.by_sid[sid]
+            self.dirty = True
+
+    def clear(self):
+        self.by_sid = {}
+        self.dirty = True
+
+    def get(self, sid):
+        """
+        Returns: the segment with the given sid or None
+        """
+        return self.by_sid.get(sid)
+
+    def arrays(self):
+        """
+        Returns: (segments, starts, ends) in the order of the starts, starts and ends
+                 are numpy arrays that must not be modified
+        """
+        self._index()
+        return self.ordered, self.starts, self.ends
+
+    def move(self, sid, start=None, end=None):
+        """
+        Sets the bounds of a segment and updates the index.
+
+        Arguments:
+        sid -- the segment id
+
+        Keyword-Arguments:
+        start -- the new start; if None, the old value will be used (default: None)
+        end   -- the new end; if None, the old value will be used (default: None)
+
+        Returns: the moved segment or None if no such segment was found
+        """
+        segment = self.by_sid.get(sid)
+        if segment is None : return None
+        if start is not None : segment.start = start
+        if end is not None : segment.end = end
+        if self.dirty : return segment
+        i = self.positions[sid]
+        n = len(self.ordered)
+        if (i > 0 and self.starts[i-1] > segment.start) or (i < n-1 and self.starts[i+1] < segment.start) :
+            self.dirty = True # the order of the starts changed
+            return segment
+        self.starts[i] = segment.start
+        self.ends[i] = segment.end
+        # the running maximum only changes from i onwards
+        first = self.maxends[i-1] if i > 0 else -np.inf
+        self.maxends[i:] = np.maximum.accumulate(np.maximum(self.ends[i:], first))
+        return segment
+
+    def overlapping(self, a, b):
+        """
+        Returns the segments that overlap the closed range [a,b] in the order of their starts.
+        """
+        self._index()
+        hi = np.searchsorted(self.starts, b, side='right')
+        lo = np.searchsorted(self.maxends, a, side='left')
+        if lo >= hi : return []
+        ends = self.ends[lo:hi]
+        return [self.ordered[lo+i] for i in np.flatnonzero(ends >= a)]
+
+    def at(self, x):
+        """
+        Returns the segments that contain the position x.
+        """
+        return self.overlapping(x, x)
+
+    def neighbours(self, sid):
+        """
+        Returns: (previous, next) segment in the order of the starts, None at the borders
+        """
+        self._index()
+        if not sid in self.positions : return None, None
+        i = self.positions[sid]
+        return self.ordered[i-1] if i > 0 else None, self.ordered[i+1] if i+1 < len(self.ordered) else None
+
+
+class SegmentChanges(object):
+    """
+    Coalesced changes of a batch of segment operations, emitted with
+    SensorDataModel.segments_changed. Each segment is reported once: a segment
+    that was added and removed within the batch is not reported at all, a
+    segment that was added and then moved or relabeled is only reported as added.
+    """
+    def __init__(self):
+        self.states = {} # (idx, sid) -> 'added', 'removed' or 'changed'
+        self.order = []  # (idx, sid) in the order of their first change
+        self.ranges = {} # idx -> list of (start, end) touched by the batch
+
+    def __len__(self):
+        return len(self.states)
+
+    def record(self, kind, seg, start=None, end=None):
+        """
+        Records an operation on a segment.
+
+        Arguments:
+        kind -- 'added', 'removed' or 'changed'
+        seg  -- the SensorDataModelSegment
+
+        Keyword-Arguments:
+        start -- new start of a moved segment (default: None)
+        end   -- new end of a moved segment (default: None)
+        """
+        key = (seg.get_idx(), seg.get_sid())
+        old = self.states.get(key)
+        if old is None :
+            self.states[key] = kind
+            self.order.append(key)
+        elif kind == 'removed' :
+            if old == 'added' : del self.states[key]
+            else : self.states[key] = kind
+        ranges = self.ranges.setdefault(key[0], [])
+        ranges.append((seg.start, seg.end))
+        if start is not None or end is not None :
+            ranges.append((seg.start if start is None else start, seg.end if end is None else end))
+
+    def _keys(self, kind):
+        return [key for key in self.order if self.states.get(key) == kind]
+
+    def added(self):
+        """
+        Returns: list of (idx, sid) of the added segments
+        """
+        return self._keys('added')
+
+    def removed(self):
+        """
+        Returns: list of (idx, sid) of the removed segments
+        """
+        return self._keys('removed')
+
+    def changed(self):
+        """
+        Returns: list of (idx, sid) of the moved or relabeled segments
+        """
+        return self._keys('changed')
+
+
+class DataWorker(QtCore.QObject):
+    """
+    Background thread that reads and decimates data for the views so the Qt
+    main thread is not blocked. Every request has a key (e.g. (view, 'lines'));
+    a request is dropped when a newer request with the same key was submitted
+    before it ran or before its result arrived, so fast panning only prepares
+    the latest window. Results are handed to the callbacks on the main thread.
+    Jobs get a snapshot of the data they need when they are submitted, the
+    models are only changed on the main thread.
+    """
+    finished = QtCore.pyqtSignal(object) #emitted from the worker thread with (key, generation, result, callback)
+
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+        self.generations = {} # key -> generation of the newest request
+        self.lock = threading.Lock()
+        self.running = threading.Lock() # held while a job runs
+        self.queue = Queue.Queue()
+        self.thread = None # started by the first request
+        self.finished.connect(self._finished, QtCore.Qt.QueuedConnection)
+
+    def submit(self, key, job, callback):
+        """
+        Queues a request, older requests with the same key are dropped.
+
+        Arguments:
+        key      -- hashable key of the request
+        job      -- called without arguments in the worker thread, must only use
+                    values that are not changed by the main thread
+        callback -- called with the result of job in the main thread
+
+        Returns: the generation of the request
+        """
+        generation = self.cancel(key)
+        if self.thread is None :
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((key, generation, job, callback))
+        return generation
+
+    def cancel(self, key):
+        """
+        Drops the queued requests and pending results with a key.
+
+        Returns: the new generation of the key
+        """
+        with self.lock :
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+        return generation
+
+    def cancel_all(self):
+        """
+        Drops all queued requests and pending results.
+        """
+        with self.lock :
+            for key in self.generations :
+                self.generations[key] += 1
+
+    def wait(self):
+        """
+        Waits until the job that is running has finished.
+        """
+        with self.running :
+            pass
+
+    def is_current(self, key, generation):
+        """
+        Returns True if no newer request with the key was submitted.
+        """
+        with self.lock :
+            return self.generations.get(key) == generation
+
+    def _run(self):
+        while True :
+            request = self.queue.get()
+            if request is None : break
+            key, generation, job, callback = request
+            with self.running :
+                if not self.is_current(key, generation) : continue # superseded while queued
+                try :
+                    result = job()
+                except Exception :
+                    log.exception("Preparing data for {0} failed".format(key))
+                    continue
+            self.finished.emit((key, generation, result, callback))
+
+    def _finished(self, answer):
+        key, generation, result, callback = answer
+        if self.is_current(key, generation) :
+            callback(result)
+
+    def close(self):
+        """
+        Stops the worker thread, queued requests are dropped. A later request
+        starts a new thread.
+        """
+        if self.thread is None : return
+        self.cancel_all()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
 class DataModel():
     def __init__(self):
         self.CHANNELNAMES = []
@@ -372,6 +700,8 @@ class DataModel():
         self.begin = 0
         self.end = 0
         self.segmentmode = 0
+        self.pyramid = None # data.Pyramid of the recording, None until it is built
+        self.window_cache = None # data.WindowCache of the recording
     def set_label_mode(self, mode):
         """
             Sets the label mode.
@@ -448,11 +778,146 @@ class DataModel():
     def reset_channel_data(self,sensordata=None,channeldata=None):
         if sensordata is None : sensordata = self.sensordata
         if channeldata is None : channeldata = self.channeldata
-        signal = sensordata['data']['signal']
-        for channel in self.channeldata :
-            i_pos = mmaat.INDICES[channel.get_name()]
-            channel.set_data(signal[self.begin:self.end,i_pos])
-            channel.set_offset(self.begin)
+        window = self._window_request(sensordata, channeldata, self.begin, self.end)
+        self._set_window(window, self._read_channels(window))
+    def _window_request(self, sensordata, channeldata, begin, end):
+        """
+        Takes a snapshot of what reading the visible channels of a window needs,
+        so _read_channels can run in the data worker.
+        :Parameters:
+            sensordata  - HDF5 object
+            channeldata - list of SensorDataModelChannel
+            begin       - first sample
+            end         - end of the window (exclusive)
+        :Returns:
+            (sensordata, channeldata, begin, end, visible channels, columns, window cache or None)
+        """
+        # visible channels are read at once, hidden channels when they are accessed
+        visible = [c for c in channeldata if c.is_visible()]
+        if self.summary_only(begin, end) : visible = []
+        columns = [mmaat.INDICES[c.get_name()] for c in visible]
+        cache = self.window_cache if sensordata is self.sensordata else None
+        return sensordata, list(channeldata), begin, end, visible, columns, cache
+    def _read_channels(self, window):
+        """
+        Reads the visible channels of a window taken with _window_request. Only
+        the snapshot is used, so this can run in the data worker.
+        :Returns:
+            numpy array (samples x visible channels)
+        """
+        sensordata, _, begin, end, _, columns, cache = window
+        if cache is not None :
+            return cache.read(begin, end, columns)
+        return data.read_signal(sensordata, begin, end, columns)
+    def _set_window(self, window, block):
+        """
+        Hands the visible channels read by _read_channels to the channels.
+        """
+        sensordata, channeldata, begin, end, visible = window[:5]
+        for k in xrange(len(visible)) :
+            visible[k].set_data(block[:, k])
+        for channel in channeldata :
+            if not channel in visible :
+                channel.set_data(None)
+                channel.set_data_callback(lambda c=channel, b=begin, e=end : self._load_channel(sensordata, c, b, e))
+            channel.set_offset(begin)
+    def _load_channel(self, sensordata, channel, begin, end):
+        """
+        Reads the data of a single channel and keeps it in the channel.
+        :Parameters:
+            sensordata - HDF5 object
+            channel    - SensorDataModelChannel
+            begin      - first sample
+            end        - end of the window (exclusive)
+        :Returns:
+            numpy array
+        """
+        d = self._read_window(sensordata, begin, end, [mmaat.INDICES[channel.get_name()]])[:, 0]
+        channel.set_data(d)
+        return d
+    def _read_window(self, sensordata, begin, end, columns):
+        """
+        Reads a time window through the window cache of the recording.
+        """
+        if self.window_cache is not None and sensordata is self.sensordata :
+            return self.window_cache.read(begin, end, columns)
+        return data.read_signal(sensordata, begin, end, columns)
+    def has_summary(self):
+        return self.pyramid is not None
+    def summary_only(self, begin=None, end=None):
+        """
+        Returns True if a window (default: the loaded window) is too long to be
+        read into memory and is drawn from the summary pyramid only.
+        """
+        if begin is None : begin = self.begin
+        if end is None : end = self.end
+        return self.pyramid is not None and end - begin > MAX_RAW_SPAN
+    def get_summary(self, channels, columns, begin=None, end=None):
+        """
+        Reads the summary of channels for a range drawn on a number of pixel columns.
+        :Parameters:
+            channels - list of SensorDataModelChannel
+            columns  - number of pixel columns
+            begin    - first sample, None for the loaded window
+            end      - end of the range (exclusive), None for the loaded window
+        :Returns:
+            (x, min, max, mean) as returned by data.Pyramid.read, None if there
+            is no summary or the raw samples are needed
+        """
+        reader = self.summary_reader(channels, columns, begin, end)
+        return None if reader is None else reader()
+    def summary_reader(self, channels, columns, begin=None, end=None):
+        """
+        Takes a snapshot of what get_summary needs, so the summary can be read
+        in the data worker. The parameters are the ones of get_summary.
+        :Returns:
+            function without arguments that returns the summary, None if there
+            is no summary or the raw samples are needed
+        """
+        pyramid = self.pyramid
+        if pyramid is None : return None
+        if begin is None : begin = self.begin
+        if end is None : end = self.end
+        if pyramid.level(min(pyramid.samples, end) - max(0, begin), columns) is None : return None
+        indices = [mmaat.INDICES[c.get_name()] for c in channels]
+        return lambda : pyramid.read(begin, end, columns, indices)
+    def get_yspan(self, begin, end, channels):
+        """
+        Returns the minimum and maximum of channels in a range of samples,
+        from the summary pyramid for long ranges.
+        :Parameters:
+            begin    - first sample
+            end      - end of the range (exclusive)
+            channels - list of SensorDataModelChannel
+        :Returns:
+            (miny, maxy), (np.Inf, -np.Inf) if there are no samples
+        """
+        return self.yspan_reader(begin, end, channels)()
+    def yspan_reader(self, begin, end, channels):
+        """
+        Takes a snapshot of what get_yspan needs, so the range can be scanned in
+        the data worker. The parameters are the ones of get_yspan.
+        :Returns:
+            function without arguments that returns (miny, maxy)
+        """
+        if len(channels) == 0 : return lambda : (np.Inf, -np.Inf)
+        pyramid = self.pyramid
+        if pyramid is not None and pyramid.level(min(pyramid.samples, end) - max(0, begin), 1024) is not None :
+            indices = [mmaat.INDICES[c.get_name()] for c in channels]
+            def scan_summary() :
+                span = pyramid.span(begin, end, indices, columns=1024)
+                return (np.Inf, -np.Inf) if span is None else span
+            return scan_summary
+        arrays = [(c.get_offset(), c.get_data()) for c in channels]
+        def scan() :
+            miny, maxy = np.Inf, -np.Inf
+            for o, d in arrays :
+                a = d[max(0, begin - o):max(0, end - o)]
+                if len(a) == 0 : continue
+                miny = min(miny, np.nanmin(a))
+                maxy = max(maxy, np.nanmax(a))
+            return miny, maxy
+        return scan
     def get_data_offset(self):
         return self.begin
     def get_data_size(self):
@@ -483,11 +948,13 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
     segment_changed = QtCore.pyqtSignal(int,int)#emitted when position of a single segment changed (argument = segment id)
     segment_added = QtCore.pyqtSignal(int,int)  #emitted when a new segment has been added (but not when new_segment_data is emitted)
     segment_removed = QtCore.pyqtSignal(int,int)#emitted when a new segment has been removed (but not when new_segment_data is emitted)
+    segments_changed = QtCore.pyqtSignal(object)#emitted once per batch of segment operations instead of the single signals above (argument = SegmentChanges)
     animation_step = QtCore.pyqtSignal(int) #emitted when the animation step that should be displayed has changed
     animation_stopped = QtCore.pyqtSignal() #emitted when an ongoing animation has reached the last step
     dynamic_connection_terminated = QtCore.pyqtSignal() #emitted when the dynamic connection has been terminated and no more data will be received
     refmot_sid_changed = QtCore.pyqtSignal(int) #emitted when selecting the segment that is used as reference motion
     sig_update_channels = QtCore.pyqtSignal()           # emitted when view needs to update
+    summary_ready = QtCore.pyqtSignal(str)  #emitted from the builder thread when the summary pyramid of a file has been written (argument = file name)
     SEGMENT_TYPES = ('gestures', 'attention')
     
     def __init__(self):
@@ -501,8 +968,15 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         self.i = 0 #timestep for animation
         self.next_sid = 0 #segment id for SensorDataModelSegment objects
         self.segments = {}
+        self.segment_types = list(SensorDataModel.SEGMENT_TYPES) # annotation layers, extra layers are added when a file has them
+        self.layer_names = {} # label names of extra annotation layers
+        self.journal = None # data.LabelJournal of the recording
+        self.dirty_ranges = {} # layer index -> list of (start, end) edited since the labels were stored
+        self.replaying = False
+        self.batch = None # SegmentChanges of the open batch
+        self.batch_depth = 0
         for i in range(len(SensorDataModel.SEGMENT_TYPES)) :
-            self.segments[i] = []
+            self.segments[i] = SegmentStore()
         self.attention_segments = []
         self.interactive_lastupdate = 0
         self.interactive_updateinterval = 1 / 10.0
@@ -513,12 +987,16 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         self.rows = 0
         self.label_colors = {}
         self.default_label_color = (153,187,153) #green with low saturation
-        self.signatureslst = []
-        self.signatures = []
+        self.signatures = None # data.SignatureArchive of the recording
         self.idx = []
         self.png_by_index = {}
+        self.storage_profile = None # storage profile for written datasets, None uses data.STORAGE_PROFILE
         # set the root item to add other items to
         self.rootItem = RootTreeItem()
+        self.summary_ready.connect(self._open_summary)
+        self.worker = DataWorker() # reads and decimates windows off the main thread
+        self.pending_window = None # (begin, end) of the window the worker is reading
+        self.summary_builder = None # (thread, cancel event) of the summary pyramid built in the background
 
     def update_channels(self, names):
         """
@@ -727,10 +1205,26 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         dataChanged(QModelIndex,QModelIndex) - once for each root item in the tree view
         self.new_dataset                     - once after all other operations returned
         """
+        if self.window_cache is not None :
+            self.window_cache.close()
+        self.worker.cancel((self, 'window'))
+        self.pending_window = None
         self.sensordata = h5.File(hdf5_file,'r')
         self.sensorfname = hdf5_file
+        self.window_cache = data.WindowCache(self.sensordata)
+        if self.journal is not None :
+            self.journal.close()
+        self.journal = data.LabelJournal(hdf5_file + data.JOURNAL_SUFFIX)
+        self.dirty_ranges = {}
+        if self.pyramid is not None :
+            self.pyramid.close()
+        self.pyramid = data.get_pyramid(hdf5_file)
+        self._stop_summary_builder()
+        if self.pyramid is None :
+            cancel = threading.Event()
+            self.summary_builder = (data.build_pyramid_async(hdf5_file, self.summary_ready.emit, cancel), cancel)
         desc, classes = data.read_description(self.sensordata)
-        self.len_sensordata = len(self.sensordata['data']['signal'])
+        self.len_sensordata = data.signal_shape(self.sensordata)[0]
         self.label_colors = {}
         colors = [QtGui.QColor.fromHsv(h,s,v).getRgb()[:-1] for h,s,v in hsv_display_colors(len(classes),srange=(100,100),vrange=(180,180),nv=1)]
         for i in xrange(len(classes)) :
@@ -740,7 +1234,6 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         self.update_channels(desc)
         self.end = self.get_data_num_samples()
         self.interactive_lastupdate = 0
-        self.signatures = [None] * len(self.signatureslst)
         # first remove all old rows
         self.clean_channels()
         self.setup_channels_and_segments()
@@ -812,61 +1305,64 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         Arguments:
             i -- index
         """
-        if i < len(self.signatures) and i >= 0 :
-            if self.signatures[i] is None :
-                self.signatures[i] = data.read_hand_signature(self.signatureslst[i])
+        if self.signatures is not None and i < len(self.signatures) and i >= 0 :
             return self.signatures[i]
         return None
 
+    def set_signature_source(self, source):
+        """
+        Sets the hand signatures of the recording. A container written by
+        data.pack_signatures next to a signature directory is preferred over
+        the csv files of the directory.
+        Arguments:
+            source -- signature directory or container, None to remove the signatures
+        """
+        if self.signatures is not None :
+            self.signatures.close()
+            self.signatures = None
+        if source is None : return
+        packed = source.rstrip(os.sep) + data.SIGNATURE_ARCHIVE_SUFFIX
+        if os.path.isdir(source) and os.path.exists(packed) :
+            source = packed
+        if os.path.exists(source) :
+            self.signatures = data.SignatureArchive(source)
+
     def setup_channels_and_segments(self):
         self.init_channels()
         self.reset_channel_data()
         self._maintain_ylims(None) #reset ylim data for all channels
         #reset segmentation data
-        self.segments[self.segmentmode] = []
-        target = self.sensordata['data']['target'][:]
-        attention = None
-        if 'attention' in self.sensordata['data'] :
-            attention =  self.sensordata['data']['attention']
-        last_label = target[0]
-        last_attention = None
-        if attention is not None :
-            last_attention = np.argmax(attention[0])
-        start = None
-        start_attention = None
-        inclass = False
-        inattention = False
-        for i in xrange(1, len(target)) :
-            if target[i] != last_label :
-                if start == None :
-                    start = i
-                    inclass = True
-                elif inclass :
-                    self.add_segment(start, i, mmaat.CLASSES[last_label])
-                    if not target[i] == 0 : # Two classes are directly connected
-                        start = i
-                        inclass = True
-                    else :
-                        start = None
-                        inclass = False
-                last_label = target[i]
-            if attention is not None :
-                a = np.argmax(attention[i])
-                if a != last_attention :
-                    if start_attention == None :
-                        start_attention = i
-                        inattention = True
-                    elif inattention :
-                        self.add_segment(start_attention, i, mmaat.ATTENTION[last_attention], 1)
-                        if not a == 0 : # Two classes are directly connected
-                            start_attention = i
-                            inattention = True
-                        else :
-                            start_attention = None
-                            inattention = False
-                    last_attention = a
+        for idx in self.segments :
+            self.segments[idx] = SegmentStore()
+        # the views drop the segments of the previous file, the new ones of the
+        # label mode (see get_labels) are reported with one segments_changed
+        # and added to the UI in chunks
         self.new_dataset.emit()
         self.new_segment_data.emit()
+        tables = {}
+        for layer in data.label_layers(self.sensordata) :
+            tables[layer] = data.read_label_table(self.sensordata, layer)
+        # files without interval tables: runs of the dense labels
+        if not 'gestures' in tables :
+            tables['gestures'] = (data.label_runs(data.read_target(self.sensordata)), list(mmaat.CLASSES))
+        if not 'attention' in tables and 'attention' in self.sensordata['data'] :
+            attention = np.argmax(self.sensordata['data']['attention'][:], axis=1)
+            tables['attention'] = (data.label_runs(attention), list(mmaat.ATTENTION))
+        self.begin_batch()
+        try :
+            for layer, (intervals, names) in tables.iteritems() :
+                idx = self.get_segment_index(layer)
+                if idx >= len(SensorDataModel.SEGMENT_TYPES) :
+                    self.layer_names[idx] = names
+                segments = [(int(start), int(end), names[lid] if lid < len(names) else str(lid)) for start, end, lid in intervals]
+                if idx == self.segmentmode :
+                    self.add_segments(segments, idx, edited=False)
+                else :
+                    self._append_segments(idx, segments)
+            if self.journal is not None : # edits that were not stored before the last session ended
+                self._replay_journal()
+        finally :
+            self.end_batch()
 
     def interactive_step(self,data):
         if self.first_update :
@@ -1048,12 +1544,13 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         self.new_segment_data -- once after all other operations have returned
         """
         self.next_sid = 0
-        self.segments[self.segmentmode] = []
+        self._layer_cleared(self.segmentmode)
+        self.segments[self.segmentmode] = SegmentStore()
         for s in segments :
-            if isinstance(s, SensorDataModelSegment) :
-                self.segments[self.segmentmode].append(s)
-            else :
-                self.segments[self.segmentmode].append(SensorDataModelSegment(self.next_sid,s[0],s[1]))
+            if not isinstance(s, SensorDataModelSegment) :
+                s = SensorDataModelSegment(self.segmentmode,self.next_sid,s[0],s[1])
+            self.segments[self.segmentmode].add(s)
+            self._segment_edited('add', s)
             self.next_sid += 1
         self.new_segment_data.emit()
 
@@ -1061,10 +1558,47 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         """
         Returns the current segment data
 
-        Returns: list of SensorDataModelSegment objects
+        Returns: list of SensorDataModelSegment objects ordered by their start
         """
         return self.segments[self.segmentmode][:]
 
+    def get_labels_in_range(self, idx, start, end):
+        """
+        Returns the segments of a layer that overlap a range
+
+        Arguments:
+        idx   -- index of the annotation layer
+        start -- first index of the range
+        end   -- last index of the range
+
+        Returns: list of SensorDataModelSegment objects ordered by their start
+        """
+        return self.segments[idx].overlapping(start, end)
+
+    def get_labels_at(self, idx, x):
+        """
+        Returns the segments of a layer that contain a position
+
+        Arguments:
+        idx -- index of the annotation layer
+        x   -- sample index
+
+        Returns: list of SensorDataModelSegment objects ordered by their start
+        """
+        return self.segments[idx].at(x)
+
+    def get_label_neighbours(self, idx, sid):
+        """
+        Returns the segments before and after a segment
+
+        Arguments:
+        idx -- index of the annotation layer
+        sid -- the segment id as obtained from SensorDataModelSegement.get_sid()
+
+        Returns: tuple (previous, next), None if there is no such segment
+        """
+        return self.segments[idx].neighbours(sid)
+
     def get_label(self, idx, sid):
         """
         Returns a single segment object
@@ -1075,9 +1609,7 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         Returns: the SensorDataModelSegment with the given sid or None if no such
                  object was found
         """
-        for s in self.segments[idx] :
-            if s.get_sid() == sid : return s
-        return None
+        return self.segments[idx].get(sid)
 
     def get_label_color(self,sid):
         """
@@ -1088,11 +1620,11 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
 
         Returns: tuple (r,g,b) in range(255)
         """
-        for s in self.segments[self.segmentmode] :
-            if s.get_sid() == sid :
-                name = s.get_name()
-                if name in self.label_colors : return self.label_colors[name]
-                else : return self.default_label_color
+        s = self.segments[self.segmentmode].get(sid)
+        if s is not None :
+            name = s.get_name()
+            if name in self.label_colors : return self.label_colors[name]
+            else : return self.default_label_color
 
     def add_segment(self,start,end,name="NONE", idx=0):
         """
@@ -1106,14 +1638,152 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         the segment id of the new segment
 
         Emits the following signals:
-        self.segment_added -- once
+        self.segment_added -- once, unless a batch is open
         """
         sid = self.next_sid
         self.next_sid += 1
-        self.segments[idx].append(SensorDataModelSegment(idx,sid,start,end,name=name))
-        self.segment_added.emit(idx, sid)
+        seg = SensorDataModelSegment(idx,sid,start,end,name=name)
+        self.segments[idx].add(seg)
+        self._segment_edited('add', seg)
+        if self.batch is not None :
+            self.batch.record('added', seg)
+        else :
+            self.segment_added.emit(idx, sid)
         return sid
 
+    def add_segments(self, segments, idx=0, edited=True):
+        """
+        Adds several segment objects to the model at once
+
+        Arguments:
+        segments -- list of tuples (start, end, name)
+        idx      -- index of the annotation layer
+        edited   -- False for segments read from the file, they are not
+                    journaled or marked as dirty
+
+        Returns:
+        list with the segment ids of the new segments
+
+        Emits the following signals:
+        self.segments_changed -- once when no other batch is open
+        """
+        self.begin_batch()
+        try :
+            sids = self._append_segments(idx, segments)
+            for sid in sids :
+                seg = self.segments[idx].get(sid)
+                if edited : self._segment_edited('add', seg)
+                self.batch.record('added', seg)
+        finally :
+            self.end_batch()
+        return sids
+
+    def remove_segments(self, idx, sids):
+        """
+        Removes several segment objects from the model at once
+
+        Arguments:
+        idx  -- index of the annotation layer
+        sids -- list of segment ids
+
+        Emits the following signals:
+        self.segments_changed -- once when no other batch is open
+        """
+        self.begin_batch()
+        try :
+            for sid in sids :
+                self.remove_segment(idx, sid)
+        finally :
+            self.end_batch()
+
+    def relabel_segments(self, idx, sids, label):
+        """
+        Assigns a label to several segments at once
+
+        Arguments:
+        idx   -- index of the annotation layer
+        sids  -- list of segment ids
+        label -- new name of the label
+
+        Emits the following signals:
+        self.segments_changed -- once when no other batch is open
+        """
+        self.begin_batch()
+        try :
+            for sid in sids :
+                self.relabel_segment(idx, sid, label)
+        finally :
+            self.end_batch()
+
+    def move_segments(self, idx, moves):
+        """
+        Moves several segment objects at once
+
+        Arguments:
+        idx   -- index of the annotation layer
+        moves -- list of tuples (sid, start, end), None keeps a bound
+
+        Emits the following signals:
+        self.segments_changed -- once when no other batch is open
+        """
+        self.begin_batch()
+        try :
+            for sid, start, end in moves :
+                self.move_segment(idx, sid, start, end)
+        finally :
+            self.end_batch()
+
+    def begin_batch(self):
+        """
+        Opens a batch of segment operations. Until the matching end_batch() the
+        operations do not emit segment_added, segment_removed and segment_changed
+        but are recorded and emitted together with segments_changed. Batches can
+        be nested, the signal is emitted when the outermost batch ends.
+        """
+        if self.batch_depth == 0 :
+            self.batch = SegmentChanges()
+        self.batch_depth += 1
+
+    def end_batch(self):
+        """
+        Closes a batch of segment operations.
+
+        Emits the following signals:
+        self.segments_changed -- once when the outermost batch ends and anything changed
+        """
+        self.batch_depth -= 1
+        if self.batch_depth > 0 : return
+        changes, self.batch = self.batch, None
+        if len(changes) > 0 :
+            self.segments_changed.emit(changes)
+
+    def _segment_signal(self, kind, seg, start=None, end=None):
+        """
+        Emits the signal of a single segment operation or records it in the open batch.
+        """
+        if self.batch is not None :
+            self.batch.record(kind, seg, start, end)
+        elif kind == 'removed' :
+            self.segment_removed.emit(seg.get_idx(), seg.get_sid())
+        else :
+            self.segment_changed.emit(seg.get_idx(), seg.get_sid())
+
+    def _append_segments(self, idx, segments):
+        """
+        Appends segment objects to a layer without emitting signals.
+
+        Arguments:
+        idx      -- index of the annotation layer
+        segments -- list of tuples (start, end, name)
+
+        Returns:
+        list with the segment ids of the new segments
+        """
+        sids = range(self.next_sid, self.next_sid + len(segments))
+        self.next_sid += len(segments)
+        self.segments[idx].extend([SensorDataModelSegment(idx, sid, start, end, name=name) for sid, (start, end, name) in zip(sids, segments)])
+        return sids
+
     def remove_segment(self,idx, sid):
         """
         Removes a segment object from the model
@@ -1126,11 +1796,9 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         """
         s = self.get_segment(idx, sid)
         if s == None : return
-        if self.get_label_mode() == 1 :
-            self.attention_segments.remove(s)
-        else :
-            self.segments[self.segmentmode].remove(s)
-        self.segment_removed.emit(idx, sid)
+        self._segment_edited('remove', s)
+        self.segments[idx].remove(s)
+        self._segment_signal('removed', s)
 
     def relabel_segment(self, idx, sid, label):
         """
@@ -1144,9 +1812,10 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
 
         """
         s = self.get_segment(idx,sid)
-        if s is not None :
-            s.set_name(label)
-        self.segment_changed.emit(idx, sid)
+        if s is None : return
+        self._segment_edited('relabel', s, new_name=label)
+        s.set_name(label)
+        self._segment_signal('changed', s)
 
     def save_segment(self,sid,filename):
         if filename == "" : return
@@ -1163,9 +1832,7 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         Returns: the SensorDataModelSegment with the given sid or None if no such
                  object was found
         """
-        for s in self.segments[idx] :
-            if s.get_sid() == sid : return s
-        return None
+        return self.segments[idx].get(sid)
     def move_segment(self,idx,sid,start=None,end=None):
         """
         Moves a segment object to a new location
@@ -1183,9 +1850,12 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         """
         s = self.get_label(idx,sid)
         if s == None : return
-        if start != None : s.set_start(start)
-        if end != None : s.set_end(end)
-        if start != None or end != None :
+        if start == None and end == None : return
+        self._segment_edited('move', s, new_start=s.start if start is None else start, new_end=s.end if end is None else end)
+        if self.batch is not None :
+            self.batch.record('changed', s, start, end)
+        self.segments[idx].move(sid, start, end)
+        if self.batch is None :
             self.segment_changed.emit(idx,sid)
 
     def store_labels(self):
@@ -1194,17 +1864,152 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         And stores the labels in h5 file.
         """
         if self.sensordata is None : return
+        # queued reads are dropped and a running one finishes before the file is closed
+        self.worker.cancel_all()
+        self.worker.wait()
+        self.pending_window = None
+        # the summary builder keeps the file open for reading, which blocks opening it for writing
+        self._stop_summary_builder()
+        if self.window_cache is not None :
+            self.window_cache.close()
+            self.window_cache = None
         if self.sensordata.id :
             self.sensordata.close()
+        if len(self.dirty_ranges) == 0 : return # nothing was edited since the labels were stored
+        h5_file = None
         try :
             h5_file = h5.File(self.sensorfname,'a')
-            h5_file['data']['target'][:] = 0
-            for seg in self.segments[self.segmentmode] :
-                h5_file['data']['target'][seg.start:seg.end] = mmaat.ID_CLASSES[seg.name]
-        except Exception as e :
-            print e
+            for idx in sorted(self.dirty_ranges.keys()) : # only the edited layers are rewritten
+                names = self.get_segment_label_names(idx)
+                ids = dict((names[i], i) for i in xrange(len(names)))
+                for seg in self.segments[idx] :
+                    if not seg.name in ids :
+                        ids[seg.name] = len(names)
+                        names.append(seg.name)
+                intervals = [(seg.start, seg.end, ids[seg.name]) for seg in self.segments[idx]]
+                data.write_label_table(h5_file, self.segment_types[idx], intervals, names, self.storage_profile)
+            if 0 in self.dirty_ranges and 'target' in h5_file['data'] : # the dense labels are materialized from the table (data.read_target)
+                del h5_file['data']['target']
+            self.dirty_ranges = {}
+            if self.journal is not None :
+                self.journal.clear()
+        except Exception :
+            log.exception("Storing the labels in {0} failed".format(self.sensorfname))
         finally:
-            h5_file.close()
+            if h5_file is not None :
+                h5_file.close()
+
+    def get_dirty_ranges(self):
+        """
+            Returns the index ranges edited since the labels were stored.
+            :Returns:
+                dict layer index -> list of (start, end)
+        """
+        return self.dirty_ranges
+
+    def _segment_edited(self, op, seg, **kwargs):
+        """
+            Marks the range of an edited segment as dirty and writes the
+            operation to the journal.
+            :Parameters:
+                op     -- 'add', 'remove', 'move' or 'relabel'
+                seg    -- SensorDataModelSegment before the edit
+                kwargs -- new_start and new_end for 'move', new_name for 'relabel'
+        """
+        idx = seg.get_idx()
+        ranges = self.dirty_ranges.setdefault(idx, [])
+        ranges.append((seg.start, seg.end))
+        if op == 'move' :
+            ranges.append((kwargs['new_start'], kwargs['new_end']))
+        if self.journal is not None and not self.replaying :
+            entry = {'op' : op, 'layer' : self.segment_types[idx], 'start' : int(seg.start), 'end' : int(seg.end), 'name' : seg.name}
+            for key, value in kwargs.iteritems() :
+                entry[key] = value if isinstance(value, basestring) else int(value)
+            self.journal.append(entry)
+
+    def _layer_cleared(self, idx):
+        """
+            Marks a whole layer as dirty before its segments are replaced.
+            :Parameters:
+                idx -- index of the layer
+        """
+        self.dirty_ranges.setdefault(idx, []).append((0, self.get_data_num_samples()))
+        if self.journal is not None and not self.replaying :
+            self.journal.append({'op' : 'clear', 'layer' : self.segment_types[idx]})
+
+    def _replay_journal(self):
+        """
+            Applies the operations of the journal to the segments loaded from the file.
+        """
+        self.replaying = True
+        try :
+            for op in self.journal.read() :
+                idx = self.get_segment_index(op['layer'])
+                if op['op'] == 'clear' :
+                    self._layer_cleared(idx)
+                    self.segments[idx] = SegmentStore()
+                    continue
+                if op['op'] == 'add' :
+                    # the add may already be in the stored tables (e.g. a crash before the journal was cleared)
+                    if any(seg.start == op['start'] and seg.end == op['end'] and seg.name == op['name']
+                           for seg in self.segments[idx].overlapping(op['start'], op['end'])) :
+                        continue
+                    sid = self._append_segments(idx, [(op['start'], op['end'], op['name'])])[0]
+                    self._segment_edited('add', self.segments[idx].get(sid))
+                    if self.batch is not None and idx == self.segmentmode :
+                        self.batch.record('added', self.segments[idx].get(sid))
+                    continue
+                s = None
+                for seg in self.segments[idx].overlapping(op['start'], op['end']) :
+                    if seg.start == op['start'] and seg.end == op['end'] and seg.name == op['name'] :
+                        s = seg
+                        break
+                if s is None : continue
+                if op['op'] == 'remove' :
+                    self._segment_edited('remove', s)
+                    self.segments[idx].remove(s)
+                elif op['op'] == 'move' :
+                    self._segment_edited('move', s, new_start=op['new_start'], new_end=op['new_end'])
+                    self.segments[idx].move(s.sid, op['new_start'], op['new_end'])
+                elif op['op'] == 'relabel' :
+                    self._segment_edited('relabel', s, new_name=op['new_name'])
+                    s.set_name(op['new_name'])
+        finally :
+            self.replaying = False
+
+    def get_segment_index(self, layer):
+        """
+            Returns the index of an annotation layer, unknown layers are added.
+            :Parameters:
+                layer -- name of the layer
+            :Returns:
+                index into self.segments
+        """
+        if not layer in self.segment_types :
+            self.segment_types.append(layer)
+            self.segments[len(self.segment_types) - 1] = SegmentStore()
+        return self.segment_types.index(layer)
+
+    def get_segment_label_names(self, idx):
+        """
+            Returns the label names of an annotation layer, the position of a
+            name is the label id stored in the file.
+            :Parameters:
+                idx -- index of the layer
+            :Returns:
+                list of names
+        """
+        if idx == 0 : return list(mmaat.CLASSES)
+        if idx == 1 : return list(mmaat.ATTENTION)
+        return list(self.layer_names.get(idx, []))
+
+    def set_storage_profile(self, profile):
+        """
+            Sets the storage profile used when labels are stored.
+            :Parameters:
+                profile -- name of a profile in data.STORAGE_PROFILES or None for the default
+        """
+        self.storage_profile = profile
 
     def set_segment_name(self,idx,sid,name):
         """
@@ -1216,8 +2021,9 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         """
         s = self.get_label(idx,sid)
         if s == None : return
+        self._segment_edited('relabel', s, new_name=name)
         s.set_name(name)
-        self.segment_changed.emit(idx, sid)
+        self._segment_signal('changed', s)
     def get_visible_yspan(self):
         vchans = self.get_visible_channels()
         if len(vchans) == 0 : return -1,1 #default values
@@ -1237,15 +2043,66 @@ class SensorDataModel(QtCore.QAbstractItemModel, DataModel):
         return self.get_data_num_samples()
 
     def load_into_memory(self,lower,upper):
-        self.begin = lower
-        self.end = upper
-        self.reset_channel_data()
+        """
+        Loads a window into memory. The visible channels are read by the data
+        worker, the window is switched and dataset_changed is emitted when they
+        have arrived; a window that is replaced before is dropped.
+        """
+        self.pending_window = (lower, upper)
+        window = self._window_request(self.sensordata, self.channeldata, lower, upper)
+        self.worker.submit((self, 'window'), lambda : (window, self._read_channels(window)), self._window_loaded)
+
+    def _window_loaded(self, result):
+        window, block = result
+        self.pending_window = None
+        if window[0] is not self.sensordata : return # another file was opened
+        self.begin, self.end = window[2:4]
+        self._set_window(window, block)
         self.dataset_changed.emit()
         self._maintain_ylims(None) #reset ylim data
 
+    def is_loading(self):
+        """
+        Returns True while a window requested with load_into_memory is read.
+        """
+        return self.pending_window is not None
+
+    def _stop_summary_builder(self):
+        """
+        Cancels the summary pyramid built in the background and waits until the
+        builder has closed the data file.
+        """
+        if self.summary_builder is None : return
+        thread, cancel = self.summary_builder
+        cancel.set()
+        thread.join()
+        self.summary_builder = None
+
+    def _open_summary(self, fname):
+        """
+        Opens the summary pyramid built in the background if it belongs to the current file.
+        """
+        if self.sensorfname is None or str(fname) != self.sensorfname or self.pyramid is not None : return
+        self.pyramid = data.get_pyramid(self.sensorfname)
+        if self.pyramid is not None :
+            self.sig_update_channels.emit()
+
     def close(self):
         """
         Closes the data file.
         """
+        self.worker.close()
+        self._stop_summary_builder()
+        self.pending_window = None
+        if self.window_cache is not None :
+            self.window_cache.close()
+            self.window_cache = None
         if self.sensordata is not None :
             self.sensordata.close()
+        if self.pyramid is not None :
+            self.pyramid.close()
+            self.pyramid = None
+        if self.journal is not None :
+            self.journal.close()
+            self.journal = None
+        self.set_signature_source(None)
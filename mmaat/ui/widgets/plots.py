@@ -5,11 +5,17 @@
  Maintainer: Markus Weber
 '''
 from PyQt4 import QtCore, QtGui
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-from mmaat.ui.models.sensordata import SensorDataModelSegment
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.transforms import Bbox
+from mmaat.analysis import decimation
+from mmaat.ui.models.sensordata import SegmentStore, SensorDataModelSegment
+import collections
 import logging
 import matplotlib.pyplot as plt
 import numpy as np
+import struct
 import time
 
 log = logging.getLogger("mmaat.ui.widgets.plots")
@@ -27,56 +33,141 @@ def hexcolor(color) :
 def textypos_by_ylim(ylim):
     return ylim[1] - 0.1 * abs(ylim[1] - ylim[0])
 
-class SensorPyplotView(FigureCanvas):
-    mouse_released = QtCore.pyqtSignal(QtGui.QMouseEvent)
-    mouse_pressed_left = QtCore.pyqtSignal(QtGui.QMouseEvent)
-    mouse_pressed_right = QtCore.pyqtSignal(QtGui.QMouseEvent)
-    mouse_dragged_left = QtCore.pyqtSignal(QtGui.QMouseEvent)
-    mouse_dragged_right = QtCore.pyqtSignal(QtGui.QMouseEvent)
-    ylim_changed = QtCore.pyqtSignal(float,float)
-    xlim_changed = QtCore.pyqtSignal(float,float,bool)
-    subplotbounds = [0.02,0.98,0.02,0.98]
+def span_verts(bounds):
+    '''
+    Returns the rectangles of vertical spans for a PolyCollection in the x-axis
+    transform (x in data, y in axes coordinates), like axvspan.
+    :Parameters:
+        bounds - list of (start, end)
+    :Returns:
+        numpy array (spans x 4 x 2)
+    '''
+    b = np.array(bounds, dtype=np.float64).reshape(-1, 2)
+    verts = np.zeros((len(b), 4, 2))
+    verts[:, 0:2, 0] = b[:, 0:1]
+    verts[:, 2:4, 0] = b[:, 1:2]
+    verts[:, 1:3, 1] = 1
+    return verts
+
+def grid_ticks(lo,hi,n=8):
+    '''
+    Returns round values between lo and hi for grid lines, about n of them.
+    '''
+    if not hi > lo : return np.zeros(0)
+    raw = (hi - lo) / float(n)
+    magnitude = 10 ** np.floor(np.log10(raw))
+    step = magnitude * min(f for f in (1, 2, 2.5, 5, 10) if f * magnitude >= raw)
+    return np.arange(np.ceil(lo / step) * step, hi, step) + 0.0 # no negative zero
+
+def painter_path(x,y):
+    '''
+    Returns a QPainterPath through points given in pixels with gaps at
+    non-finite points. The path is read from its QDataStream representation,
+    which is much faster than adding the points one by one for long lines.
+    :Parameters:
+        x - numpy array with the x pixel coordinates
+        y - numpy array with the y pixel coordinates
+    '''
+    path = QtGui.QPainterPath()
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.any() : return path
+    # a point after a gap starts a new subpath (element type 0 = MoveTo, 1 = LineTo)
+    types = np.ones(len(x), dtype=np.int32)
+    types[0] = 0
+    types[1:][~finite[:-1]] = 0
+    elements = np.empty(finite.sum(), dtype=[('type', '>i4'), ('x', '>f8'), ('y', '>f8')])
+    elements['type'] = types[finite]
+    elements['x'] = x[finite]
+    elements['y'] = y[finite]
+    # element count, elements, index of the start of the last subpath and the fill rule (0 = OddEvenFill)
+    cstart = np.flatnonzero(elements['type'] == 0)[-1]
+    stream = QtCore.QDataStream(QtCore.QByteArray(struct.pack('>i', len(elements)) + elements.tostring() + struct.pack('>ii', cstart, 0)))
+    stream >> path
+    if stream.status() != QtCore.QDataStream.Ok :
+        path = QtGui.QPainterPath()
+        for t, px, py in elements :
+            if t == 0 : path.moveTo(px, py)
+            else : path.lineTo(px, py)
+    return path
+
+def decimate_lines(request):
+    '''
+    Decimates the lines of a snapshot taken by SensorView._line_request, runs
+    in the data worker. Channels with the same offset and length are decimated
+    together.
+    :Parameters:
+        request - dict with
+                  keys    - list of channel keys
+                  window  - (begin, end) of the samples in memory
+                  span    - number of samples shown on the axes
+                  width   - pixel width of the axes
+                  method  - decimation method
+                  summary - (summary reader, columns), None to use the samples
+                  arrays  - list of (channel key, offset, data) if summary is None
+    :Returns:
+        dict channel key -> (x, y)
+    '''
+    xy = {}
+    if request['summary'] is not None :
+        reader, columns = request['summary']
+        summary = reader()
+        if summary is None :
+            for k in request['keys'] : xy[k] = (np.zeros(0), np.zeros(0))
+            return xy
+        x, y = decimation.envelope(summary[0], summary[1], summary[2], columns)
+        for i, k in enumerate(request['keys']) :
+            xy[k] = (x, y[:, i])
+        return xy
+    groups = {}
+    for k, offset, y in request['arrays'] :
+        if y is None : y = np.zeros(0)
+        groups.setdefault((offset, len(y)), []).append((k, y))
+    for (offset, n), members in groups.iteritems() :
+        if n == 0 :
+            for k, y in members : xy[k] = (np.zeros(0), np.zeros(0))
+            continue
+        columns = int(np.ceil(request['width'] * n / max(1.0, request['span'])))
+        x, y = decimation.decimate(np.column_stack([y for k, y in members]), columns, request['method'])
+        x = x + offset
+        for i, (k, _) in enumerate(members) :
+            xy[k] = (x if x.ndim == 1 else x[:, i], y[:, i])
+    return xy
+
+class SensorView(object):
+    '''
+    Parts of the plot of a SensorDataModel that do not depend on how it is
+    drawn: the segments, the decimation of the visible channels and the mouse
+    signals. Subclasses are QWidgets that define the signals of
+    SensorPyplotView and implement get_xlim, get_ylim, _axes_width,
+    data_changed, region_changed and draw_plot. SensorView has to be their
+    first base class, its mouse events replace the ones of the widget.
+    '''
+    LABEL_SPACING = 30 # minimal distance of two drawn segment labels in pixels
     def __init__(self, UPDATE_FRAMERATE=25):
         self.seg_default_color = "#99BB99"
-        self.figure = plt.Figure(figsize=(8, 4), dpi=100)
-        plt.ion()
-        self.figure.subplots_adjust(
-            left=self.subplotbounds[0],
-            right=self.subplotbounds[1],
-            bottom=self.subplotbounds[2],
-            top=self.subplotbounds[3])
-        FigureCanvas.__init__(self,self.figure)
-        self.setSizePolicy(QtGui.QSizePolicy.Expanding,QtGui.QSizePolicy.Expanding)
-        self.eval_seg = None
-        self.eval_ref_seg = None
         self.model = None
-        self.lines = {}
-        self.anim = None
-        self.ylim = (0,0)
         ''' Segments '''
-        self.segments = {}
-        self.segment_labels = {}
+        self.segments = {} # sid -> SensorDataModelSegment with the drawn bounds
+        self.segment_index = SegmentStore() # interval index of the drawn segments, for culling
+        self.segment_labels = {} # sid -> label text of DATA segments
         self.segment_colors = {}
+        self.segment_alphas = {}
+        self.hidden_segments = set()
+        self.label_width = 0 # widest segment label drawn so far in pixels
+        ''' Update timer '''
         self.drawing_trigger = False
-        '''--------------------------------------'''
         self.updates = 0
-        ''' Update timer '''
-        self.update_time = 0.05
-        self.cum_update_time = 0
-        self.timer_id = -1
         self.last_update = time.time()
         self.sleep_time = (1. / UPDATE_FRAMERATE) * 1000
-        # save the clean slate background -- everything but the animated line
-        # is drawn and saved in the pixel buffer background
-        self.background = None
-        self.canvas = None
-        self.axes = None
-        self.old_size = None
-        self.old_xlim = None
-        self.old_ylim = None
+        self.anim_x = None
         self.has_new_data = False
         self.autoscale_y = False
-
+        self.decimation = 'minmax' # see mmaat.analysis.decimation.DECIMATION_METHODS
+        self.line_segments = [] # decimated lines of the visible channels (see _line_segments)
+        self.line_keys = []
+        self.line_colors = []
+        self.line_window = (0, 0) # window of the samples in memory the lines were decimated from
+        self.line_source = None # (decimation method, summary available) of the lines
 
     def set_model(self,model):
         '''
@@ -105,61 +196,9 @@ class SensorPyplotView(FigureCanvas):
             self.mouse_pressed_left.emit(event)
     def _has_new_data_slot(self):
         self.has_new_data = True
-        self.data_changed()
-    def new_plot(self):
-        #clear old data
-        for sid in self.segments.keys()[:] : self.remove_segment(sid)
-        for k in self.lines.keys() : self._rmline(k)
-        if self.anim != None : self.anim.remove()
-        self.anim = None
-        self.figure.clf()
-        y_min = float("inf")
-        y_max = -float("inf")
-        x_min = 0
-        #insert new data
         if not self.model is None :
-            x_min = self.model.get_data_offset()
-            self.axes = self.figure.add_subplot(111)
-            self.axes.set_autoscaley_on(False)
-            self.axes.set_autoscalex_on(False)
-            # Store figure size
-            self.old_size = self.axes.bbox.width, self.axes.bbox.height
-            vchan = self.model.get_visible_channels()
-            for c in vchan :
-                xdata,ydata = self._getxy(c)
-                ls = self.axes.plot(xdata,ydata,color=np.array(c.get_color())/255.0, animated=True,linestyle="-")
-                self.lines[str(c.get_channel_id())+"/"+c.get_name()] = ls[0] # it is only one line
-                if len(ydata) > 0 :
-                    yspan = (min(ydata),max(ydata))
-                    if yspan[0] < y_min : y_min = yspan[0]
-                    if yspan[1] > y_max : y_max = yspan[1]
-            if len(vchan) == 0 : y_min,y_max = (-1,1)
-            self.axes.grid()
-            self.draw()
-        self.ylim = [y_min,y_max]
-        if not self.lines is None :
-            # Setting the boundaries
-            x_max = x_min + len(self.model)
-            self.axes.set_xlim(x_min, x_max)
-            self.axes.set_ylim(self.ylim[0],self.ylim[1])
-            self.old_xlim = (x_min,x_max)
-            self.old_ylim = self.ylim
-            self.xlim_changed.emit(x_min,x_max,False)
-            self.ylim_changed.emit(self.ylim[0],self.ylim[1])
-        yticks = self.axes.get_yticklabels()
-        for t in yticks :
-            t.set_size("x-small")
-        xticks = self.axes.get_xticklabels()
-        for t in xticks :
-            t.set_size("x-small")
-        self.canvas = self.figure.canvas
-        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+            self.model.worker.cancel((self, 'lines')) # decimated from the old data
         self.data_changed()
-
-    def _rmline(self,key):
-        if not key in self.lines : return
-        del self.lines[key]
-
     def _ckey(self,channel):
         return str(channel.get_channel_id())+"/"+channel.get_name()
 
@@ -169,7 +208,7 @@ class SensorPyplotView(FigureCanvas):
             :Parameters:
                 segments - dict with segments
         '''
-        if self.axes == None : return
+        if self.get_xlim() is None : return
         for k in self.segments.keys() :
             self.remove_segment(k)
         for s in segments :
@@ -184,7 +223,7 @@ class SensorPyplotView(FigureCanvas):
             color - color of the segment
             alpha - alpha value of segment
         '''
-        if self.axes == None or segment == None : #
+        if self.get_xlim() is None or segment == None : #
             return #for robustness
         if color == None :
             color = self.seg_default_color
@@ -193,16 +232,14 @@ class SensorPyplotView(FigureCanvas):
         start,end = segment.get_bounds()
         sid = segment.get_sid()
         idx = segment.get_idx()
-        self.segments[sid] = self.axes.axvspan(start,end,color=color,alpha=alpha,animated=True)
+        if sid in self.segments : self.remove_segment(sid)
+        self.segments[sid] = SensorDataModelSegment(idx,sid,start,end)
+        self._segments_changed(start,end)
+        self.segment_index.add(self.segments[sid])
         self.segment_colors[sid] = color
+        self.segment_alphas[sid] = alpha
         if not (self.model.get_label(idx, sid) is None) : #only add label text if this is a DATA segment
-            self.segment_labels[sid] = self.axes.annotate(
-                segment.get_name(),(start,0),
-                xytext=(start,textypos_by_ylim(self.ylim)),
-                textcoords="data",
-                animated=True,
-                fontsize="small"
-            )
+            self.segment_labels[sid] = segment.get_name()
             self.set_segment_color(sid,self.model.get_label_color(sid))
         self.data_changed()
 
@@ -213,12 +250,12 @@ class SensorPyplotView(FigureCanvas):
             newcolor - new color of the segment
         '''
         if not self.segments.has_key(sid) : return
-        seg = self.segments[sid]
         if not newcolor is None :
             col = "#"+hexcolor(newcolor)
         else :
             col = self.seg_default_color
-        seg.set_color(col)
+        if self.segment_colors.get(sid) == col : return
+        self._segments_changed(*self.segments[sid].get_bounds())
         self.segment_colors[sid] = col
         self.data_changed()
 
@@ -227,24 +264,33 @@ class SensorPyplotView(FigureCanvas):
         Removes a segment.
             sid - id of the segment
         '''
-        if not sid in self.segments.keys() : return
-        self.segments[sid].remove()
+        if not sid in self.segments : return
+        self._segments_changed(*self.segments[sid].get_bounds())
         del self.segments[sid]
+        self.segment_index.remove(sid)
         del self.segment_colors[sid]
+        del self.segment_alphas[sid]
+        self.hidden_segments.discard(sid)
         if sid in self.segment_labels :
             del self.segment_labels[sid]
         self.data_changed()
 
     def set_segments_visible(self,vis):
-        for sid in self.segments :
-            line = self.segments[sid]
-            line.set_visible(vis)
+        if vis :
+            self.hidden_segments.clear()
+        else :
+            self.hidden_segments.update(self.segments.keys())
+        self._segments_changed()
         self.data_changed()
 
     def set_segment_visible(self,sid,vis):
         if not sid in self.segments : return #robustness fix
-        line = self.segments[sid]
-        line.set_visible(vis)
+        if vis != (not sid in self.hidden_segments) :
+            self._segments_changed(*self.segments[sid].get_bounds())
+        if vis :
+            self.hidden_segments.discard(sid)
+        else :
+            self.hidden_segments.add(sid)
         self.data_changed()
 
     def update_segment(self,a1,a2=None,a3=None):
@@ -257,62 +303,469 @@ class SensorPyplotView(FigureCanvas):
             start,end = a1.get_bounds()
         else :
             sid,start,end = (a1,a2,a3)
+            idx = self.segments[sid].get_idx() if sid in self.segments else 0
         if not sid in self.segments.keys() :
             self.add_segment(SensorDataModelSegment(idx, sid,start,end))
         else :
-            boundary = self.segments[sid].get_xy()
-            boundary[0,0] = start
-            boundary[1,0] = start
-            boundary[2,0] = end
-            boundary[3,0] = end
-            self.segments[sid].set_xy(boundary)
+            old_start,old_end = self.segments[sid].get_bounds()
+            self._segments_changed(old_start,old_end)
+            self._segments_changed(start,end)
+            self.segment_index.move(sid,start,end)
+            pad = 0
             if sid in self.segment_labels :
                 self.set_segment_color(sid,self.model.get_label_color(sid))
-                self.segment_labels[sid].set_text(self.model.get_label(idx,sid).get_name())
-                self.segment_labels[sid].xyann = (start,textypos_by_ylim(self.ylim))
-        self.data_changed()
+                name = self.model.get_label(idx,sid).get_name()
+                pad = self.label_width + self.LABEL_SPACING # the label and the labels it hides
+                if name != self.segment_labels[sid] :
+                    self.segment_labels[sid] = name
+                    self.region_changed(start,start,pad)
+            # only the strips between the old and the new edges change
+            if start != old_start : self.region_changed(old_start,start,pad)
+            if end != old_end : self.region_changed(old_end,end)
 
-    def data_changed(self):
+    def _segments_changed(self,start=None,end=None):
+        '''
+        Called when the segments in a range of samples have been changed, for
+        dropping cached drawings of them.
+        :Parameters:
+            start - first sample, None for all segments
+            end   - last sample
+        '''
+        pass
+
+    def _lines_changed(self):
+        '''
+        Called when the lines were decimated with another method or source,
+        for dropping cached drawings of them.
+        '''
+        pass
+
+    def _line_segments(self,lines):
+        '''
+        Returns the segments of a LineCollection for decimated lines.
+        :Parameters:
+            lines - list of (x, y)
+        :Returns:
+            numpy array (lines x points x 2) if all lines share x, else list of (points x 2) arrays
+        '''
+        if len(lines) > 0 and all(x is lines[0][0] and len(y) == len(x) for x, y in lines) :
+            # channels decimated together share x, the segments are filled in one go
+            segments = np.empty((len(lines), len(lines[0][0]), 2))
+            segments[:, :, 0] = lines[0][0]
+            segments[:, :, 1] = [y for _, y in lines]
+            return segments
+        return [np.column_stack((x, y)) for x, y in lines]
+
+    def _clip_segments(self,start,end):
+        '''
+        Returns the parts of the lines in a range of samples, including one point on either side.
+        '''
+        if isinstance(self.line_segments, np.ndarray) :
+            x = self.line_segments[0, :, 0] if len(self.line_segments) > 0 else np.zeros(0)
+            a = max(0, np.searchsorted(x, start) - 1)
+            return self.line_segments[:, a:np.searchsorted(x, end) + 1]
+        clipped = []
+        for seg in self.line_segments :
+            a = max(0, np.searchsorted(seg[:, 0], start) - 1)
+            clipped.append(seg[a:np.searchsorted(seg[:, 0], end) + 1])
+        return clipped
+    def save_figure(self,fname,dpi=100):
+        '''
+        Saves the plot as it is shown with matplotlib, independent of how the
+        view draws it.
+        :Parameters:
+            fname - file name, the format is taken from the extension (e.g. png, pdf, svg)
+            dpi   - resolution of raster formats
+        '''
+        if self.get_xlim() is None : return
+        dpi = float(dpi)
+        figure = plt.Figure(figsize=(max(1, self.width()) / dpi, max(1, self.height()) / dpi), dpi=dpi)
+        FigureCanvasAgg(figure)
+        figure.subplots_adjust(
+            left=self.subplotbounds[0],
+            right=self.subplotbounds[1],
+            bottom=self.subplotbounds[2],
+            top=self.subplotbounds[3])
+        axes = figure.add_subplot(111)
+        axes.set_autoscale_on(False)
+        axes.set_xlim(self.get_xlim())
+        axes.set_ylim(self.get_ylim())
+        axes.grid()
+        axes.add_collection(LineCollection(self.line_segments, colors=self.line_colors, linestyles='-'), autolim=False)
+        styles, labels = self._visible_segments()
+        for style, bounds in styles.iteritems() :
+            axes.add_collection(PolyCollection(span_verts(bounds), color=style[0], alpha=style[1],
+                                               transform=axes.get_xaxis_transform()), autolim=False)
+        y = textypos_by_ylim(self.get_ylim())
+        for start, text in self._shown_labels(labels) :
+            axes.text(start, y, text, fontsize="small", clip_on=True)
+        if not self.anim_x is None :
+            axes.axvline(self.anim_x, linestyle="dashed", color="black")
+        for t in axes.get_xticklabels() + axes.get_yticklabels() :
+            t.set_size("x-small")
+        figure.savefig(fname, dpi=dpi)
+
+    def _schedule_draw(self):
         if self.drawing_trigger or not self.isVisible() : return
         since_last = time.time() - self.last_update
         wait_for = max((0, self.sleep_time - since_last))
         QtCore.QTimer.singleShot(wait_for, self.draw_plot)
         self.drawing_trigger = True
 
+    def get_number_of_samples(self):
+        return self.model.get_number_of_samples()
+
+    def _visible_segments(self,xmin=None,xmax=None):
+        '''
+        Returns the segments overlapping a range, by default the xlim.
+        :Returns:
+            styles - dict (color, alpha) -> list of (start, end) of the shown segments
+            labels - list of (start, text) ordered by start
+        '''
+        if xmin is None or xmax is None : xmin,xmax = self.get_xlim()
+        styles = {}
+        labels = []
+        for seg in self.segment_index.overlapping(xmin,xmax) :
+            k = seg.sid
+            if not k in self.hidden_segments :
+                styles.setdefault((self.segment_colors[k], self.segment_alphas[k]), []).append((seg.start, seg.end))
+            if k in self.segment_labels :
+                labels.append((seg.start, self.segment_labels[k]))
+        return styles, labels
+
+    def _shown_labels(self,labels):
+        '''
+        Returns the labels that are drawn, every label hides the labels that
+        start closer than LABEL_SPACING pixels to it.
+        :Parameters:
+            labels - list of (start, text) ordered by start
+        '''
+        xmin,xmax = self.get_xlim()
+        min_dist = self.LABEL_SPACING * abs(xmax - xmin) / max(1.0, self._axes_width())
+        shown = []
+        for start, text in labels :
+            if len(shown) > 0 and start - shown[-1][0] < min_dist : continue
+            shown.append((start, text))
+        return shown
+
+    def _getxy(self,channel):
+        return self._getxy_all([channel])[self._ckey(channel)]
+
+    def _getxy_all(self,channels,span=None,width=None):
+        '''
+        Decimates the data of several channels to the pixel width of the axes.
+        :Parameters:
+            channels - list of channels
+            span     - number of samples shown on the axes, None for the current xlim
+            width    - pixel width of the axes, None for the current width
+        :Returns:
+            dict channel key -> (x, y)
+        '''
+        return decimate_lines(self._line_request(channels, span, width))
+
+    def _line_request(self,channels,span=None,width=None):
+        '''
+        Takes a snapshot of the model state needed to decimate the lines, so that
+        decimate_lines can run in the data worker while the model changes.
+        :Parameters:
+            see _getxy_all
+        :Returns:
+            dict, see decimate_lines
+        '''
+        if span is None :
+            xlim = self.get_xlim()
+            span = len(self.model) if xlim is None else abs(xlim[1] - xlim[0])
+        if width is None : width = self._axes_width()
+        begin, end = self.model.get_data_offset(), self.model.end
+        keys = [self._ckey(c) for c in channels]
+        summary = None
+        # long windows are drawn from the summary pyramid without touching the samples
+        if self.decimation == 'minmax' or self.model.summary_only() :
+            columns = int(np.ceil(width * (end - begin) / max(1.0, span)))
+            summary = self.model.summary_reader(channels, columns)
+        arrays = None
+        if summary is None :
+            arrays = [(k, c.get_offset(), c.get_data()) for k, c in zip(keys, channels)]
+        else :
+            summary = (summary, columns)
+        return dict(keys=keys, window=(begin, end), span=span, width=width,
+                    method=self.decimation, summary=summary, arrays=arrays)
+
+    def _request_lines(self):
+        '''
+        Decimates the visible channels for the current xlim in the data worker of
+        the model, the lines are set by _lines_ready when the result arrives. A
+        newer request (e.g. while panning) drops the older ones.
+        '''
+        channels = self.model.get_visible_channels()
+        request = self._line_request(channels)
+        source = (self.decimation, self.model.has_summary())
+        self.model.worker.submit((self, 'lines'), lambda : decimate_lines(request),
+                                 lambda xy : self._lines_ready(channels, xy, request['window'], source))
+
+    def _lines_ready(self,channels,xy,window,source):
+        '''
+        Sets the lines decimated by the data worker.
+        :Parameters:
+            channels - list of visible channels
+            xy       - dict channel key -> (x, y) (see _getxy_all)
+            window   - (begin, end) of the samples in memory when the lines were requested
+            source   - (decimation method, summary available) when the lines were requested
+        '''
+        self.line_window = window
+        if source != self.line_source :
+            self.line_source = source
+            self._lines_changed()
+        self._set_line_data(channels, xy)
+        if self.autoscale_y :
+            self.set_ylim(self.model.get_visible_yspan())
+        self.data_changed()
+
+    def set_decimation(self,method):
+        '''
+        Sets the decimation method of the lines.
+        :Parameters:
+            method - 'minmax' (default) or 'lttb'
+        '''
+        if not method in decimation.DECIMATION_METHODS :
+            raise ValueError("Unknown decimation method '{0}'".format(method))
+        self.decimation = method
+        self._has_new_data_slot()
+    def set_autoscale_y(self,auto):
+        self.autoscale_y = auto
+
+
+
+class SensorPyplotView(SensorView, FigureCanvas):
+    mouse_released = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_pressed_left = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_pressed_right = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_dragged_left = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_dragged_right = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    ylim_changed = QtCore.pyqtSignal(float,float)
+    xlim_changed = QtCore.pyqtSignal(float,float,bool)
+    subplotbounds = [0.02,0.98,0.02,0.98]
+    TILE_WIDTH = 256   # pixel width of a cached tile of lines and segments
+    TILE_CACHE = 128   # number of cached tiles of both layers
+    TILE_LAYERS = ('lines', 'segments') # tiles of the lines are only rendered again when the data changes
+    DIRTY_MARGIN = 3   # pixels redrawn on either side of a changed strip
+    def __init__(self, UPDATE_FRAMERATE=25):
+        SensorView.__init__(self, UPDATE_FRAMERATE)
+        self.figure = plt.Figure(figsize=(8, 4), dpi=100)
+        plt.ion()
+        self.figure.subplots_adjust(
+            left=self.subplotbounds[0],
+            right=self.subplotbounds[1],
+            bottom=self.subplotbounds[2],
+            top=self.subplotbounds[3])
+        FigureCanvas.__init__(self,self.figure)
+        self.setSizePolicy(QtGui.QSizePolicy.Expanding,QtGui.QSizePolicy.Expanding)
+        self.eval_seg = None
+        self.eval_ref_seg = None
+        self.lines = {}
+        self.anim = None
+        self.ylim = (0,0)
+        self.segment_collections = {} # (color, alpha) -> PolyCollection with the visible segments of that style
+        self.label_texts = [] # Text artists reused for the visible labels
+        ''' Update timer '''
+        self.update_time = 0.05
+        self.cum_update_time = 0
+        self.timer_id = -1
+        # save the clean slate background -- everything but the animated line
+        # is drawn and saved in the pixel buffer background
+        self.background = None
+        self.background_image = None # RGBA copy of the canvas with the background, for redrawing strips
+        self.dirty = None # (start, end, pad) of the strips to redraw, None redraws the whole plot
+        self.shown_labels = set() # (start, text) of the labels drawn last
+        self.canvas = None
+        self.axes = None
+        self.old_size = None
+        self.old_xlim = None
+        self.old_ylim = None
+        self.use_collection = True # all channels are drawn as one LineCollection instead of one line per channel
+        self.collection = None
+        self.collection_keys = [] # channel keys in the order of the lines of the collection
+        self.use_tiles = True # lines and segments are drawn from cached tiles while panning
+        self.tiles = collections.OrderedDict() # (layer, tile index) -> RGBA image
+        self.tile_key = None # scale and ylim the tiles were rendered with
+        self.tile_figure = None # off-screen figure the tiles are rendered on
+
+
+    def new_plot(self):
+        #clear old data
+        for sid in self.segments.keys()[:] : self.remove_segment(sid)
+        for k in self.lines.keys() : self._rmline(k)
+        if self.anim != None : self.anim.remove()
+        self.anim = None
+        self.anim_x = None
+        self.collection = None
+        self.collection_keys = []
+        self.line_keys = []
+        self.segment_collections = {}
+        self.label_texts = []
+        self.invalidate_tiles()
+        self.figure.clf()
+        y_min = float("inf")
+        y_max = -float("inf")
+        x_min = 0
+        #insert new data
+        if not self.model is None :
+            x_min = self.model.get_data_offset()
+            self.axes = self.figure.add_subplot(111)
+            self.axes.set_autoscaley_on(False)
+            self.axes.set_autoscalex_on(False)
+            # Store figure size
+            self.old_size = self.axes.bbox.width, self.axes.bbox.height
+            vchan = self.model.get_visible_channels()
+            self.model.worker.cancel((self, 'lines'))
+            self.line_window = (self.model.get_data_offset(), self.model.end)
+            self.line_source = (self.decimation, self.model.has_summary())
+            xy = self._getxy_all(vchan, span=len(self.model))
+            self._set_line_data(vchan, xy)
+            for c in vchan :
+                xdata,ydata = xy[self._ckey(c)]
+                if len(ydata) > 0 :
+                    yspan = (min(ydata),max(ydata))
+                    if yspan[0] < y_min : y_min = yspan[0]
+                    if yspan[1] > y_max : y_max = yspan[1]
+            if len(vchan) == 0 : y_min,y_max = (-1,1)
+            self.axes.grid()
+            self.draw()
+        self.ylim = [y_min,y_max]
+        if not self.lines is None :
+            # Setting the boundaries
+            x_max = x_min + len(self.model)
+            self.axes.set_xlim(x_min, x_max)
+            self.axes.set_ylim(self.ylim[0],self.ylim[1])
+            self.old_xlim = (x_min,x_max)
+            self.old_ylim = self.ylim
+            self.xlim_changed.emit(x_min,x_max,False)
+            self.ylim_changed.emit(self.ylim[0],self.ylim[1])
+        yticks = self.axes.get_yticklabels()
+        for t in yticks :
+            t.set_size("x-small")
+        xticks = self.axes.get_xticklabels()
+        for t in xticks :
+            t.set_size("x-small")
+        self.canvas = self.figure.canvas
+        self._save_background()
+        self.data_changed()
+
+    def _set_lines(self,channels,xy):
+        '''
+        Updates one line per channel with the decimated data of the channels.
+        :Parameters:
+            channels - list of visible channels
+            xy       - dict channel key -> (x, y) (see _getxy_all)
+        '''
+        active_keys = [self._ckey(c) for c in channels]
+        for k in self.lines.keys() :
+            #remove lines that have been disabled
+            if not k in active_keys :
+                self._rmline(k)
+                continue
+            #update data
+            l = self.lines[k]
+            xdata,ydata = xy[k]
+            l.set_ydata(ydata)
+            l.set_xdata(xdata)
+
+        #add lines that where enabled
+        for i in xrange(len(channels)) :
+            if not active_keys[i] in self.lines.keys() :
+                c = channels[i]
+                xdata,ydata = xy[active_keys[i]]
+                ls = self.axes.plot(xdata,ydata,color=np.array(c.get_color())/255.0, animated=True,linestyle='-')
+                self.lines[active_keys[i]] = ls[0]
+
+    def _set_line_data(self,channels,xy):
+        '''
+        Sets the decimated data of the visible channels on the lines or the
+        collection and keeps it for the tiles.
+        :Parameters:
+            channels - list of visible channels
+            xy       - dict channel key -> (x, y) (see _getxy_all)
+        '''
+        keys = [self._ckey(c) for c in channels]
+        self.line_segments = self._line_segments([xy[k] for k in keys])
+        if keys != self.line_keys : # the data of a moved window is the same, other channels are not
+            self.line_colors = [np.array(c.get_color())/255.0 for c in channels]
+            self.line_keys = keys
+            self.invalidate_tiles(layer='lines')
+        if self.use_collection :
+            self._set_collection(channels, self.line_segments)
+        else :
+            self._set_lines(channels, xy)
+
+    def _set_collection(self,channels,segments):
+        '''
+        Updates the LineCollection with the decimated data of the channels, the
+        collection is created on first use and then changed in place.
+        :Parameters:
+            channels - list of visible channels
+            segments - lines of the channels (see _line_segments)
+        '''
+        keys = [self._ckey(c) for c in channels]
+        if self.collection is None :
+            self.collection = LineCollection(segments, animated=True, linestyles='-')
+            self.axes.add_collection(self.collection, autolim=False)
+        else :
+            self.collection.set_segments(segments)
+        if keys != self.collection_keys :
+            self.collection.set_color([np.array(c.get_color())/255.0 for c in channels])
+            self.collection_keys = keys
+
+    def set_use_collection(self,enabled):
+        '''
+        Selects whether all channels are drawn as one LineCollection or as one line per channel.
+        :Parameters:
+            enabled - True for the LineCollection
+        '''
+        self.use_collection = enabled
+        for k in self.lines.keys() : self._rmline(k)
+        if self.collection is not None :
+            self.collection.remove()
+            self.collection = None
+            self.collection_keys = []
+        self._has_new_data_slot()
+
+    def _rmline(self,key):
+        if not key in self.lines : return
+        del self.lines[key]
+
+    def _segments_changed(self,start=None,end=None):
+        self.invalidate_tiles(start,end,layer='segments')
+
+    def _lines_changed(self):
+        self.invalidate_tiles(layer='lines')
+
+    def data_changed(self):
+        self.dirty = None # the whole plot is redrawn
+        self._schedule_draw()
+
+    def region_changed(self,start,end,pad=0):
+        '''
+        Schedules a redraw of the strip of the plot between two samples, the
+        rest of the plot is kept.
+        :Parameters:
+            start - first sample
+            end   - last sample
+            pad   - pixels added right of end, e.g. for a segment label
+        '''
+        if self.dirty is not None :
+            self.dirty.append((min(start,end), max(start,end), pad))
+        self._schedule_draw()
+
     def resizeEvent(self, event):
         FigureCanvas.resizeEvent(self, event)
+        self.has_new_data = True # the decimation depends on the pixel width
         self.draw_plot()
 
     def update_plot(self):
         if self.axes is None : return
         self.axes.grid()
         if not self.model is None :
-            active_channels = self.model.get_visible_channels()
-            active_keys = [self._ckey(c) for c in active_channels]
-            for k in self.lines.keys() :
-                #remove lines that have been disabled
-                if not k in active_keys :
-                    self._rmline(k)
-                    continue
-                #update data
-                idx = active_keys.index(k)
-                c = active_channels[idx]
-                l = self.lines[k]
-                xdata,ydata = self._getxy(c)
-                l.set_ydata(ydata)
-                l.set_xdata(xdata)
-
-            #add lines that where enabled
-            for i in xrange(len(active_channels)) :
-                if not active_keys[i] in self.lines.keys() :
-                    c = active_channels[i]
-                    xdata,ydata = self._getxy(c)
-                    ls = self.axes.plot(xdata,ydata,color=np.array(c.get_color())/255.0, animated=True,linestyle='-')
-                    self.lines[active_keys[i]] = ls[0]
-            if self.autoscale_y :
-                ymin,ymax = self.model.get_visible_yspan()
-                self.axes.set_ylim((ymin,ymax))
-                self.ylim_changed.emit(ymin,ymax)
+            self._request_lines()
         self.data_changed()
 
     def animation_step(self,i):
@@ -320,10 +773,12 @@ class SensorPyplotView(FigureCanvas):
         if not self.anim is None :
             self.anim.remove()
         self.anim = self.axes.vlines(i,self.axes.axis()[2],self.axes.axis()[3],linestyles="dashed",color="black", animated=True)
-        self.data_changed()
-
-    def get_number_of_samples(self):
-        return self.model.get_number_of_samples()
+        if self.anim_x is None :
+            self.data_changed()
+        else :
+            self.region_changed(self.anim_x,self.anim_x)
+            self.region_changed(i,i)
+        self.anim_x = i
 
     def get_ylim(self):
         if self.axes == None : return None
@@ -333,14 +788,14 @@ class SensorPyplotView(FigureCanvas):
         if self.axes == None : return None
         return self.axes.get_xlim()
 
+    def _axes_width(self):
+        return self.width() if self.axes is None else self.axes.bbox.width
+
     def set_ylim(self,bottom,top=None,silent=False):
         if self.axes == None : return # robustness fix
         if top == None : bottom,top = bottom # enables passing of tuples as only argument
         self.ylim = [bottom,top]
         self.axes.set_ylim(self.ylim)
-        for k in self.segment_labels :
-            l = self.segment_labels[k]
-            l.xytext = (l.xytext[0],textypos_by_ylim(self.ylim))
         self.data_changed()
         if not silent : self.ylim_changed.emit(bottom,top)
 
@@ -350,14 +805,17 @@ class SensorPyplotView(FigureCanvas):
         do = self.model.get_data_offset()
         l = len(self.model)
         ds = self.model.get_data_size()
-        if self.model != None and (do > bottom or top > do+l) and top < ds :
+        if self.model != None and (do > bottom or top > do+l) and top < ds and not self.model.is_loading() :
             log.warning("trying to display data that is not in memory (xlim {xmin},{xmax} / memory buffer {bmin},{bmax})".format(
                 xmin=bottom,
                 xmax=top,
                 bmin=do,
                 bmax=do+l)
             )
+        old = self.axes.get_xlim()
         self.axes.set_xlim([bottom,top])
+        if abs(old[1] - old[0]) != abs(top - bottom) :
+            self.has_new_data = True # the decimation depends on the span
         self.data_changed()
         self.xlim_changed.emit(bottom,top,silent)
 
@@ -388,14 +846,27 @@ class SensorPyplotView(FigureCanvas):
                 self.old_ylim = current_ylim
                 self.old_xlim = current_xlim
                 self.draw()
-                self.background = self.copy_from_bbox(self.axes.bbox)
+                self._save_background()
+                self.dirty = None
 
-            self.canvas.restore_region(self.background)
-            self.draw_lines()
-            self.draw_segments()
-            self.draw_anim_line()
-            # just redraw the axes rectangle
-            self.blit(self.figure.bbox)
+            shown = set(self._shown_labels(self._visible_segments()[1]))
+            if self.dirty :
+                # a moved label can show or hide labels outside of the changed strips
+                for start, text in shown.symmetric_difference(self.shown_labels) :
+                    self.dirty.append((start, start, self.label_width))
+            self.shown_labels = shown
+            clips = self._dirty_rects()
+            if clips is None :
+                self.canvas.restore_region(self.background)
+                self._draw_layers()
+                # just redraw the axes rectangle
+                self.blit(self.figure.bbox)
+            else :
+                for clip in clips :
+                    self._restore_strip(clip)
+                    self._draw_layers(clip)
+                    self.blit(clip)
+            self.dirty = []
             self.updates += 1
             self.last_update = time.time()
         finally :
@@ -404,37 +875,594 @@ class SensorPyplotView(FigureCanvas):
             #if self.updates > 0 : self.update_time = self.cum_update_time * 1.0 / self.updates #TODO remove
             self.drawing_trigger = False
 
-    def draw_lines(self):
+    def _save_background(self):
+        '''
+        Keeps the drawn background for restoring the whole axes or strips of it.
+        '''
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        renderer = self.get_renderer()
+        self.background_image = np.frombuffer(renderer.buffer_rgba(), np.uint8).reshape(
+            int(renderer.height), int(renderer.width), 4).copy()
+
+    def _dirty_rects(self):
+        '''
+        Returns the pixel rectangles of the changed strips, merged where they
+        overlap, or None if the whole plot has to be redrawn.
+        '''
+        if self.dirty is None or self.background_image is None : return None
+        bbox = self.axes.bbox
+        xmin,xmax = self.axes.get_xlim()
+        scale = bbox.width / (xmax - xmin)
+        strips = []
+        for start, end, pad in sorted(self.dirty) :
+            x0 = max(np.floor(bbox.x0), np.floor(bbox.x0 + (start - xmin) * scale) - self.DIRTY_MARGIN)
+            x1 = min(np.ceil(bbox.x1), np.ceil(bbox.x0 + (end - xmin) * scale + pad) + self.DIRTY_MARGIN)
+            if x1 <= x0 : continue # outside of the xlim
+            if len(strips) > 0 and x0 <= strips[-1][1] :
+                strips[-1][1] = max(strips[-1][1], x1)
+            else :
+                strips.append([x0, x1])
+        if sum(b - a for a, b in strips) > bbox.width / 2 : return None # cheaper at once
+        y0, y1 = np.floor(bbox.y0), np.ceil(bbox.y1)
+        return [Bbox.from_extents(a, y0, b, y1) for a, b in strips]
+
+    def _restore_strip(self,clip):
+        '''
+        Restores the background in a pixel rectangle.
+        '''
+        height = self.background_image.shape[0]
+        x0, y0, x1, y1 = [int(v) for v in clip.extents]
+        strip = np.ascontiguousarray(self.background_image[height - y1:height - y0, x0:x1][::-1]) # bottom row first
+        renderer = self.get_renderer()
+        gc = renderer.new_gc()
+        renderer.draw_image(gc, x0, y0, strip)
+        gc.restore()
+
+    def _draw_layers(self,clip=None):
+        '''
+        Draws lines, segments, labels and the animation line, optionally only in a pixel rectangle.
+        '''
+        if self.use_tiles :
+            self.draw_tiles(clip)
+            self.draw_segment_labels(self._visible_segments()[1], clip)
+        else :
+            self.draw_lines(clip)
+            self.draw_segments(clip)
+        self.draw_anim_line(clip)
+
+    def _draw_artist(self,artist,clip=None):
+        '''
+        Draws an artist, clipped to a pixel rectangle if clip is given.
+        '''
+        if clip is None :
+            self.axes.draw_artist(artist)
+            return
+        clipbox, clip_on = artist.get_clip_box(), artist.get_clip_on()
+        artist.set_clip_box(clip)
+        artist.set_clip_on(True)
+        self.axes.draw_artist(artist)
+        artist.set_clip_box(clipbox)
+        artist.set_clip_on(clip_on)
+
+    def draw_lines(self,clip=None):
         '''
         Draws the lines in the plot.
         '''
+        if self.collection is not None :
+            self._draw_artist(self.collection, clip)
         for k in self.lines.keys() :
-            self.axes.draw_artist(self.lines[k])
+            self._draw_artist(self.lines[k], clip)
 
-    def draw_segments(self):
+    def draw_segments(self,clip=None):
         '''
-        Draws the segments in the plot.
+        Draws the segments in the visible range of the plot, one collection per
+        color and the labels that do not overlap.
         '''
-        for k in self.segments.keys() :
-            self.axes.draw_artist(self.segments[k])
-            if k in self.segment_labels :
-                self.axes.draw_artist(self.segment_labels[k])
+        styles, labels = self._visible_segments()
+        for style, bounds in styles.iteritems() :
+            self._draw_artist(self._segment_collection(style, bounds), clip)
+        self.draw_segment_labels(labels, clip)
 
-    def draw_anim_line(self):
+    def _segment_collection(self,style,bounds):
+        '''
+        Returns the collection of a segment style with new bounds.
+        :Parameters:
+            style  - (color, alpha)
+            bounds - list of (start, end)
+        '''
+        verts = span_verts(bounds)
+        coll = self.segment_collections.get(style)
+        if coll is None :
+            coll = PolyCollection(verts, color=style[0], alpha=style[1], animated=True,
+                                  transform=self.axes.get_xaxis_transform())
+            self.axes.add_collection(coll, autolim=False)
+            self.segment_collections[style] = coll
+        else :
+            coll.set_verts(verts)
+        return coll
+
+    def draw_segment_labels(self,labels,clip=None):
+        '''
+        Draws the labels of segments, skipping labels that start closer than
+        LABEL_SPACING pixels to the previous one.
+        :Parameters:
+            labels - list of (start, text) ordered by start
+            clip   - pixel rectangle, None draws all labels
+        '''
+        xmin,xmax = self.axes.get_xlim()
+        samples_per_pixel = abs(xmax - xmin) / max(1.0, self.axes.bbox.width)
+        y = textypos_by_ylim(self.axes.get_ylim())
+        n = 0
+        for start, text in self._shown_labels(labels) :
+            if clip is not None :
+                x = self.axes.bbox.x0 + (start - xmin) / samples_per_pixel
+                if x > clip.x1 or x + self.label_width < clip.x0 : continue
+            if n == len(self.label_texts) :
+                self.label_texts.append(self.axes.text(0, 0, "", animated=True, fontsize="small", clip_on=True))
+            t = self.label_texts[n]
+            t.set_position((start, y))
+            t.set_text(text)
+            self._draw_artist(t, clip)
+            if clip is None :
+                self.label_width = max(self.label_width, t.get_window_extent().width)
+            n += 1
+
+    def draw_anim_line(self,clip=None):
         '''
         Draws the vertical animation line.
         '''
         if not self.anim is None :
-            self.axes.draw_artist(self.anim)
+            self._draw_artist(self.anim, clip)
+
+    def invalidate_tiles(self,start=None,end=None,layer=None):
+        '''
+        Drops the cached tiles that overlap a range of samples.
+        :Parameters:
+            start - first sample, None drops all tiles of the layer
+            end   - last sample
+            layer - 'lines' or 'segments', None for both
+        '''
+        layers = self.TILE_LAYERS if layer is None else (layer,)
+        if start is None or end is None or self.tile_key is None :
+            for key in [key for key in self.tiles if key[0] in layers] :
+                del self.tiles[key]
+            return
+        tile_span = self.tile_key[0] * self.TILE_WIDTH
+        for k in xrange(int(np.floor(start / tile_span)), int(np.floor(end / tile_span)) + 1) :
+            for l in layers :
+                self.tiles.pop((l, k), None)
+
+    def set_use_tiles(self,enabled):
+        '''
+        Selects whether lines and segments are drawn from cached tiles or on every frame.
+        :Parameters:
+            enabled - True for the tiles
+        '''
+        self.use_tiles = enabled
+        self.invalidate_tiles()
+        self.data_changed()
+
+    def draw_tiles(self,clip=None):
+        '''
+        Draws the lines and segments of the xlim from tiles of TILE_WIDTH pixels.
+        The tiles are aligned to multiples of their span, so while panning at
+        the same scale only the newly exposed tiles are rendered.
+        :Parameters:
+            clip - pixel rectangle, None draws the whole axes
+        '''
+        bbox = self.axes.bbox
+        width, height = int(round(bbox.width)), int(round(bbox.height))
+        if width <= 0 or height <= 0 : return
+        xmin,xmax = self.axes.get_xlim()
+        spp = (xmax - xmin) / bbox.width # samples per pixel
+        key = (spp, tuple(self.axes.get_ylim()), height, len(self.model))
+        if key != self.tile_key :
+            self.tiles.clear()
+            self.tile_key = key
+        if clip is None : clip = bbox
+        # pixel columns of the axes that are drawn
+        c0 = max(0, int(np.floor(clip.x0 - bbox.x0)))
+        c1 = min(width, int(np.ceil(clip.x1 - bbox.x0)))
+        if c1 <= c0 : return
+        tile_span = spp * self.TILE_WIDTH
+        first = int(np.floor((xmin + c0 * spp) / tile_span))
+        last = int(np.floor((xmin + c1 * spp) / tile_span))
+        offset = int(round((xmin - first * tile_span) / spp)) + c0
+        renderer = self.get_renderer()
+        for layer in self.TILE_LAYERS : # segments above the lines, like draw_segments
+            strip = np.hstack([self._tile(layer, k, height) for k in xrange(first, last + 1)])
+            image = np.ascontiguousarray(strip[::-1, offset:offset + c1 - c0]) # the renderer expects the bottom row first
+            gc = renderer.new_gc()
+            gc.set_clip_rectangle(clip)
+            renderer.draw_image(gc, bbox.x0 + c0, bbox.y0, image)
+            gc.restore()
+
+    def _tile(self,layer,k,height):
+        '''
+        Returns tile k of a layer, tiles of the lines that are not completely
+        covered by the window the lines were decimated from are rendered but
+        not cached.
+        '''
+        if (layer, k) in self.tiles :
+            self.tiles[(layer, k)] = self.tiles.pop((layer, k)) # most recently used
+            return self.tiles[(layer, k)]
+        tile_span = self.tile_key[0] * self.TILE_WIDTH
+        start, end = k * tile_span, (k + 1) * tile_span
+        tile = self._render_tile(layer, start, end, height)
+        n = len(self.model)
+        lo, hi = self.line_window
+        if layer == 'segments' or end <= 0 or start >= n or (max(start, 0) >= lo and min(end, n) <= hi) :
+            self.tiles[(layer, k)] = tile
+            while len(self.tiles) > self.TILE_CACHE :
+                self.tiles.popitem(last=False)
+        return tile
+
+    def _render_tile(self,layer,start,end,height):
+        '''
+        Renders the lines or the segments of a range of samples off-screen.
+        :Returns:
+            RGBA image (height x TILE_WIDTH x 4), top row first
+        '''
+        dpi = float(self.figure.dpi)
+        if self.tile_figure is None :
+            self.tile_figure = plt.Figure(dpi=dpi)
+            FigureCanvasAgg(self.tile_figure)
+            self.tile_figure.patch.set_alpha(0)
+            axes = self.tile_figure.add_axes([0, 0, 1, 1])
+            axes.axis('off')
+            axes.set_autoscale_on(False)
+            self.tile_lines = LineCollection([], linestyles='-')
+            axes.add_collection(self.tile_lines, autolim=False)
+        axes = self.tile_figure.axes[0]
+        self.tile_figure.set_size_inches(self.TILE_WIDTH / dpi, height / dpi)
+        axes.set_xlim(start, end)
+        axes.set_ylim(self.axes.get_ylim())
+        for coll in axes.collections[1:] :
+            coll.remove()
+        self.tile_lines.set_visible(layer == 'lines')
+        if layer == 'lines' :
+            self.tile_lines.set_segments(self._clip_segments(start, end))
+            self.tile_lines.set_color(self.line_colors)
+        else :
+            styles, _ = self._visible_segments(start, end)
+            for style, bounds in styles.iteritems() :
+                coll = PolyCollection(span_verts(bounds), color=style[0], alpha=style[1], transform=axes.get_xaxis_transform())
+                axes.add_collection(coll, autolim=False)
+        canvas = self.tile_figure.canvas
+        canvas.draw()
+        w, h = canvas.get_width_height()
+        return np.frombuffer(canvas.buffer_rgba(), np.uint8).reshape(h, w, 4).copy()
+
     def showEvent(self,evt):
         FigureCanvas.showEvent(self,evt)
         if (evt) : self.data_changed() #draw changes that have happened since we where last visible
-    def _getxy(self,channel):
-        y = channel.get_data()[::4] #TODO no hardcoded subsampling
-        x = np.arange(len(y))*4 + channel.get_offset()
-        return x,y
-    def set_autoscale_y(self,auto):
-        self.autoscale_y = auto
+
+
+class SensorPainterView(SensorView, QtGui.QWidget):
+    '''
+    Plot of the visible channels and the segments of a SensorDataModel that is
+    painted with QPainter instead of matplotlib, with the interface of
+    SensorPyplotView. The grid and the lines are painted on a pixmap that is
+    kept until the data or the limits change, the segments and labels on a
+    copy of it and the animation line is painted over that copy.
+    '''
+    mouse_released = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_pressed_left = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_pressed_right = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_dragged_left = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    mouse_dragged_right = QtCore.pyqtSignal(QtGui.QMouseEvent)
+    ylim_changed = QtCore.pyqtSignal(float,float)
+    xlim_changed = QtCore.pyqtSignal(float,float,bool)
+    subplotbounds = [0.02,0.98,0.02,0.98]
+    GRID_LINES = 8     # about the number of grid lines along either axis
+    PIXEL_RANGE = 1e4  # y pixels beyond the axes are clamped to this distance, QPainter misbehaves with huge coordinates
+    def __init__(self, UPDATE_FRAMERATE=25):
+        QtGui.QWidget.__init__(self)
+        SensorView.__init__(self, UPDATE_FRAMERATE)
+        self.setSizePolicy(QtGui.QSizePolicy.Expanding,QtGui.QSizePolicy.Expanding)
+        self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent) # the pixmap covers the whole widget
+        self.xlim = None # None until a dataset is plotted
+        self.ylim = [0,0]
+        self.line_pixmap = None # grid and lines, None if they have to be painted again
+        self.pixmap = None # line_pixmap with the segments and labels
+
+    def new_plot(self):
+        #clear old data
+        for sid in self.segments.keys()[:] : self.remove_segment(sid)
+        self.anim_x = None
+        self.xlim = None
+        self.line_segments = []
+        self.line_keys = []
+        self.line_colors = []
+        self.line_pixmap = None
+        if self.model is None :
+            self.data_changed()
+            return
+        #insert new data
+        x_min = self.model.get_data_offset()
+        x_max = x_min + len(self.model)
+        self.xlim = [x_min,x_max]
+        y_min = float("inf")
+        y_max = -float("inf")
+        vchan = self.model.get_visible_channels()
+        self.model.worker.cancel((self, 'lines'))
+        self.line_window = (self.model.get_data_offset(), self.model.end)
+        self.line_source = (self.decimation, self.model.has_summary())
+        xy = self._getxy_all(vchan, span=len(self.model))
+        self._set_line_data(vchan, xy)
+        for c in vchan :
+            xdata,ydata = xy[self._ckey(c)]
+            if len(ydata) > 0 :
+                yspan = (np.nanmin(ydata),np.nanmax(ydata))
+                if yspan[0] < y_min : y_min = yspan[0]
+                if yspan[1] > y_max : y_max = yspan[1]
+        if len(vchan) == 0 : y_min,y_max = (-1,1)
+        self.ylim = [y_min,y_max]
+        self.xlim_changed.emit(x_min,x_max,False)
+        self.ylim_changed.emit(self.ylim[0],self.ylim[1])
+        self.data_changed()
+
+    def _set_line_data(self,channels,xy):
+        '''
+        Keeps the decimated data of the visible channels for painting.
+        :Parameters:
+            channels - list of visible channels
+            xy       - dict channel key -> (x, y) (see _getxy_all)
+        '''
+        self.line_keys = [self._ckey(c) for c in channels]
+        self.line_segments = self._line_segments([xy[k] for k in self.line_keys])
+        self.line_colors = [np.array(c.get_color())/255.0 for c in channels]
+        self.line_pixmap = None
+
+    def _segments_changed(self,start=None,end=None):
+        self.pixmap = None
+
+    def data_changed(self):
+        self.pixmap = None
+        self._schedule_draw()
+
+    def region_changed(self,start,end,pad=0):
+        '''
+        Schedules a redraw of the strip of the plot between two samples. The
+        segments are painted again as a whole on the kept lines, which is cheap.
+        :Parameters:
+            start - first sample
+            end   - last sample
+            pad   - pixels added right of end, e.g. for a segment label
+        '''
+        self.data_changed()
+
+    def resizeEvent(self, event):
+        QtGui.QWidget.resizeEvent(self, event)
+        self.has_new_data = True # the decimation depends on the pixel width
+        self.line_pixmap = None
+        self.pixmap = None
+        self.draw_plot()
+
+    def showEvent(self,evt):
+        QtGui.QWidget.showEvent(self,evt)
+        if (evt) : self.data_changed() #draw changes that have happened since we where last visible
+
+    def update_plot(self):
+        if self.xlim is None : return
+        if not self.model is None :
+            self._request_lines()
+        self.data_changed()
+
+    def animation_step(self,i):
+        if self.xlim is None : return
+        old = self.anim_x
+        self.anim_x = i
+        # only the columns of the old and the new animation line are painted again
+        for x in (old, i) :
+            if not x is None :
+                px = int(self._to_pixels(x, 0)[0])
+                self.update(px - 2, 0, 5, self.height())
+
+    def get_ylim(self):
+        if self.xlim is None : return None
+        return tuple(self.ylim)
+
+    def get_xlim(self):
+        if self.xlim is None : return None
+        return tuple(self.xlim)
+
+    def _axes_width(self):
+        return (self.subplotbounds[1] - self.subplotbounds[0]) * self.width()
+
+    def _axes_rect(self):
+        '''
+        Returns the pixel rectangle of the axes, placed like the subplot of SensorPyplotView.
+        '''
+        left,right,bottom,top = self.subplotbounds
+        return QtCore.QRectF(left * self.width(), (1 - top) * self.height(),
+                             (right - left) * self.width(), (top - bottom) * self.height())
+
+    def _to_pixels(self,x,y):
+        '''
+        Maps samples and values to pixel coordinates of the widget.
+        :Parameters:
+            x - sample or numpy array of samples
+            y - value or numpy array of values
+        :Returns:
+            px, py
+        '''
+        rect = self._axes_rect()
+        xmin,xmax = self.xlim
+        ymin,ymax = self.ylim
+        px = rect.left() + (np.asarray(x, dtype=np.float64) - xmin) * (rect.width() / max(1e-9, xmax - xmin))
+        py = rect.bottom() - (np.asarray(y, dtype=np.float64) - ymin) * (rect.height() / max(1e-9, ymax - ymin))
+        return px, py
+
+    def set_ylim(self,bottom,top=None,silent=False):
+        if self.xlim is None : return # robustness fix
+        if top == None : bottom,top = bottom # enables passing of tuples as only argument
+        self.ylim = [bottom,top]
+        self.line_pixmap = None
+        self.data_changed()
+        if not silent : self.ylim_changed.emit(bottom,top)
+
+    def set_xlim(self,bottom,top=None,silent=False):
+        if self.xlim is None : return #robustness fix
+        if top == None : bottom,top = bottom # enables passing of tuples as only argument
+        do = self.model.get_data_offset()
+        l = len(self.model)
+        ds = self.model.get_data_size()
+        if (do > bottom or top > do+l) and top < ds and not self.model.is_loading() :
+            log.warning("trying to display data that is not in memory (xlim {xmin},{xmax} / memory buffer {bmin},{bmax})".format(
+                xmin=bottom,
+                xmax=top,
+                bmin=do,
+                bmax=do+l)
+            )
+        old = self.xlim
+        self.xlim = [bottom,top]
+        if abs(old[1] - old[0]) != abs(top - bottom) :
+            self.has_new_data = True # the decimation depends on the span
+        self.line_pixmap = None
+        self.data_changed()
+        self.xlim_changed.emit(bottom,top,silent)
+
+    def draw_plot(self):
+        '''
+            Called by the update mechanism.
+        '''
+        try :
+            if self.xlim is None : return
+            if self.has_new_data :
+                self.update_plot()
+                self.has_new_data = False
+            self.update()
+            self.updates += 1
+            self.last_update = time.time()
+        finally :
+            self.drawing_trigger = False
+
+    def paintEvent(self, event):
+        if self.pixmap is None or self.pixmap.size() != self.size() :
+            self.paint_pixmap()
+        painter = QtGui.QPainter()
+        painter.begin(self)
+        painter.drawPixmap(event.rect(), self.pixmap, event.rect())
+        if not self.xlim is None :
+            self.paint_anim_line(painter)
+        painter.end()
+
+    def paint_pixmap(self):
+        '''
+        Paints the plot without the animation line on the pixmap, the grid and
+        the lines are only painted again if they have changed.
+        '''
+        if self.line_pixmap is None or self.line_pixmap.size() != self.size() :
+            self.line_pixmap = QtGui.QPixmap(self.size())
+            self.line_pixmap.fill(QtGui.QColor(255,255,255,255))
+            if not self.xlim is None :
+                painter = QtGui.QPainter()
+                painter.begin(self.line_pixmap)
+                self.paint_grid(painter)
+                self.paint_lines(painter)
+                painter.end()
+        self.pixmap = self.line_pixmap.copy()
+        if not self.xlim is None :
+            painter = QtGui.QPainter()
+            painter.begin(self.pixmap)
+            self.paint_segments(painter)
+            painter.end()
+
+    def paint_grid(self,painter):
+        '''
+        Paints the grid, the tick values and the frame of the axes.
+        '''
+        rect = self._axes_rect()
+        font = painter.font()
+        font.setPointSize(7)
+        painter.setFont(font)
+        xticks = grid_ticks(self.xlim[0], self.xlim[1], self.GRID_LINES)
+        yticks = grid_ticks(self.ylim[0], self.ylim[1], self.GRID_LINES)
+        px, _ = self._to_pixels(xticks, 0)
+        _, py = self._to_pixels(0, yticks)
+        painter.setPen(QtGui.QColor(176,176,176,255))
+        for x in px :
+            painter.drawLine(QtCore.QPointF(x, rect.top()), QtCore.QPointF(x, rect.bottom()))
+        for y in py :
+            painter.drawLine(QtCore.QPointF(rect.left(), y), QtCore.QPointF(rect.right(), y))
+        painter.setPen(QtGui.QColor(96,96,96,255))
+        for x, value in zip(px, xticks) :
+            painter.drawText(QtCore.QPointF(x + 2, rect.bottom() - 2), "{0:g}".format(value))
+        for y, value in zip(py, yticks) :
+            painter.drawText(QtCore.QPointF(rect.left() + 2, y - 2), "{0:g}".format(value))
+        painter.setPen(QtGui.QColor(0,0,0,255))
+        painter.setBrush(QtCore.Qt.NoBrush)
+        painter.drawRect(rect)
+
+    def paint_lines(self,painter):
+        '''
+        Paints the parts of the decimated lines that are in the xlim.
+        '''
+        rect = self._axes_rect()
+        painter.setClipRect(rect)
+        painter.setBrush(QtCore.Qt.NoBrush)
+        top, bottom = rect.top() - self.PIXEL_RANGE, rect.bottom() + self.PIXEL_RANGE
+        xmin,xmax = self.xlim
+        for line, color in zip(self._clip_segments(xmin, xmax), self.line_colors) :
+            if len(line) == 0 : continue
+            px, py = self._to_pixels(line[:, 0], line[:, 1])
+            painter.setPen(QtGui.QColor.fromRgbF(*color[:3]))
+            painter.drawPath(painter_path(px, np.clip(py, top, bottom)))
+        painter.setClipping(False)
+
+    def paint_segments(self,painter):
+        '''
+        Paints the segments in the xlim as rectangles over the full height of
+        the axes and the labels that do not overlap.
+        '''
+        rect = self._axes_rect()
+        painter.setClipRect(rect)
+        painter.setPen(QtCore.Qt.NoPen)
+        styles, labels = self._visible_segments()
+        for (color, alpha), bounds in styles.iteritems() :
+            brush = QtGui.QColor(color)
+            brush.setAlphaF(alpha)
+            for start, end in bounds :
+                x0, x1 = self._to_pixels(np.array([start, end]), 0)[0]
+                painter.fillRect(QtCore.QRectF(x0, rect.top(), x1 - x0, rect.height()), brush)
+        font = painter.font()
+        font.setPointSize(8)
+        painter.setFont(font)
+        painter.setPen(QtGui.QColor(0,0,0,255))
+        metrics = painter.fontMetrics()
+        _, y = self._to_pixels(0, textypos_by_ylim(self.ylim))
+        for start, text in self._shown_labels(labels) :
+            x, _ = self._to_pixels(start, 0)
+            painter.drawText(QtCore.QPointF(x, y), text)
+            self.label_width = max(self.label_width, metrics.width(text))
+        painter.setClipping(False)
+
+    def paint_anim_line(self,painter):
+        '''
+        Paints the vertical animation line.
+        '''
+        if self.anim_x is None : return
+        rect = self._axes_rect()
+        x, _ = self._to_pixels(self.anim_x, 0)
+        painter.setPen(QtGui.QPen(QtGui.QColor(0,0,0,255), 1, QtCore.Qt.DashLine))
+        painter.drawLine(QtCore.QPointF(x, rect.top()), QtCore.QPointF(x, rect.bottom()))
+
+
+SENSOR_VIEWS = ('matplotlib', 'qpainter')
+
+def create_sensor_view(backend='matplotlib', UPDATE_FRAMERATE=25):
+    '''
+    Creates the plot widget of the sensor data.
+    :Parameters:
+        backend - 'matplotlib' (default, SensorPyplotView) or 'qpainter' (SensorPainterView)
+        UPDATE_FRAMERATE - maximal number of redraws per second
+    '''
+    if backend == 'matplotlib' :
+        return SensorPyplotView(UPDATE_FRAMERATE)
+    elif backend == 'qpainter' :
+        return SensorPainterView(UPDATE_FRAMERATE)
+    raise ValueError("Unknown view backend '{0}'".format(backend))
 
 
 class SegmentPyplotView(FigureCanvas):
@@ -503,30 +1531,69 @@ class SegmentPyplotView(FigureCanvas):
 
     def update_data(self):
         if not self.has_new_data : return
-        self.ymin_auto = np.Inf
-        self.ymax_auto = -np.Inf
+        self.has_new_data = False
         chans = self.data_model.get_active_channels()
+        segment = self.segment
+        columns = max(1, int(self.axes.bbox.width))
         o = self.data_model.get_data_offset()
-        for c in chans :
-            data = c.get_data()[self.segment[0]-o:self.segment[1]-o]
+        # long segments are drawn from the summary pyramid
+        summary = self.data_model.summary_reader(chans, columns, segment[0], segment[1])
+        arrays = None if summary is not None else [c.get_data() for c in chans]
+        self.data_model.worker.submit((self, 'segment'), lambda : self._read_segment(chans, segment, columns, o, summary, arrays),
+                                      self._segment_ready)
+
+    def _read_segment(self,chans,segment,columns,o,summary,arrays):
+        '''
+        Reads the data of the channels in a segment, runs in the data worker.
+        :Parameters:
+            chans   - list of channels
+            segment - (start, end)
+            columns - pixel width of the axes
+            o       - offset of the samples in memory
+            summary - summary reader of the segment, None to use the samples
+            arrays  - list of the samples of the channels if summary is None
+        :Returns:
+            segment, list of (channel, x, data)
+        '''
+        if summary is not None :
+            summary = summary()
+            if summary is None : return segment, [(c, np.zeros(0), np.zeros(0)) for c in chans]
+            sx, sy = decimation.envelope(summary[0], summary[1], summary[2], columns)
+            sx = np.clip(sx - segment[0], 0, segment[1] - segment[0])
+        lines = []
+        for i, c in enumerate(chans) :
+            if summary is not None :
+                x, data = sx, sy[:, i]
+            else :
+                data = arrays[i][segment[0]-o:segment[1]-o]
+                x = np.arange(len(data))
+            lines.append((c, x, data))
+        return segment, lines
+
+    def _segment_ready(self,result):
+        if self.axes is None : return # reset while the segment was read
+        segment, lines = result
+        self.ymin_auto = np.Inf
+        self.ymax_auto = -np.Inf
+        for c, x, data in lines :
             ckey = self._ckey(c)
             if ckey in self.lines :
-                self.lines[ckey][0].set_xdata(range(len(data)))
+                self.lines[ckey][0].set_xdata(x)
                 self.lines[ckey][0].set_ydata(data)
             else :
-                self.lines[ckey] = self.axes.plot(data,color=np.array(c.get_color())/255.0,animated=True)
+                self.lines[ckey] = self.axes.plot(x,data,color=np.array(c.get_color())/255.0,animated=True)
             #remember minimum and maximum for autoscaling
             if len(data) == 0 :
                 self.ymin_auto = -1
                 self.ymax_auto = 1
             else :
-                ymin,ymax = min(data),max(data)
+                ymin,ymax = np.nanmin(data),np.nanmax(data)
                 if ymin < self.ymin_auto : self.ymin_auto = ymin
                 if ymax > self.ymax_auto : self.ymax_auto = ymax
-        self.axes.set_xlim(0,self.segment[1]-self.segment[0])
-        self.has_new_data = False
+        self.axes.set_xlim(0,segment[1]-segment[0])
         self.background_changed = True
         self.new_segment_bounds.emit()
+        self.data_changed()
 
     def draw_background(self):
         if self.background_changed :
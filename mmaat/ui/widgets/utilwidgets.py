@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from PyQt4 import QtCore, QtGui
-from mmaat.ui.models.sensordata import SensorDataModelSegment
+from mmaat.ui.models.sensordata import SegmentStore, SensorDataModelSegment
 import logging
 import mmaat
+import numpy as np
 
 log = logging.getLogger("mmaat.ui.widgets.utilwidgets")
 
@@ -132,6 +133,7 @@ class Tab(QtGui.QWidget):
 class TabBar(QtGui.QWidget):
     mouse_pressed = QtCore.pyqtSignal(QtGui.QMouseEvent,float)
     mouse_released = QtCore.pyqtSignal(QtGui.QMouseEvent,float)
+    mouse_moved = QtCore.pyqtSignal(QtGui.QMouseEvent,float)
 
     def __init__(self, _name):
         QtGui.QWidget.__init__(self)
@@ -139,6 +141,9 @@ class TabBar(QtGui.QWidget):
         self.bigticks = []
         self.bordercolor = QtGui.QColor(0,0,0,255)
         self.name = _name
+        self.marker_source = None # callable returning [(relx, QColor)] of tabs painted by the bar itself
+        self.marker_h = 15
+        self.marker_w = 6
 
     def paintEvent(self,event):
         painter = QtGui.QPainter()
@@ -157,11 +162,28 @@ class TabBar(QtGui.QWidget):
         for t in self.bigticks :
             t = t*self.width()
             painter.drawLine(t,self.height(),t,int(self.height()*1.0/3.0))
+        if not self.marker_source is None :
+            self.paint_markers(painter)
         painter.setBrush(transparent)
         painter.setPen(self.bordercolor)
         painter.drawRect(QtCore.QRect(0,0,self.width()-1,self.height()-1))
         painter.end()
 
+    def paint_markers(self,painter):
+        """
+        Paints the tabs of marker_source with the shape of Tab widgets.
+        """
+        painter.setRenderHint(QtGui.QPainter.Antialiasing,on=True)
+        top = self.height() - self.marker_h
+        bottom = self.height()
+        half = self.marker_w/2.0
+        for relx,color in self.marker_source() :
+            x = relx*self.width()
+            painter.setBrush(color)
+            painter.setPen(color)
+            painter.drawPolygon(QtCore.QPointF(x,top),QtCore.QPointF(x-half,bottom),QtCore.QPointF(x+half,bottom))
+        painter.setRenderHint(QtGui.QPainter.Antialiasing,on=False)
+
     def set_ticks(self,ticks):
         self.ticks = ticks
         self.repaint()
@@ -185,6 +207,11 @@ class TabBar(QtGui.QWidget):
         relx = self.get_relx(event.pos().x())
         self.mouse_pressed.emit(event,relx)
 
+    def mouseMoveEvent(self,event):
+        if not self.isEnabled() : return #disable all functionality
+        relx = self.get_relx(event.pos().x())
+        self.mouse_moved.emit(event,relx)
+
     def get_relx(self,absx):
         return 1.0*absx/self.width()
 
@@ -392,7 +419,8 @@ class PlotControlSegment():
     """
     Model class representing a Segment with two Tabs in a PlotControl widget
     """
-    def __init__(self, idx, sid,start,end,start_tab,end_tab,color=QtGui.QColor(0,0,0),start_tab_shadow=None,end_tab_shadow=None,has_visualization=False):
+    def __init__(self, idx, sid,start,end,start_tab,end_tab,color=QtGui.QColor(0,0,0),start_tab_shadow=None,end_tab_shadow=None,has_visualization=False,
+                 move_callback=None,mouse_release_callback=None,global_shadow=False):
         """
         Creates a PlotControlSegment widget with all options
 
@@ -409,6 +437,9 @@ class PlotControlSegment():
         start_tab_shadow  -- Tab widget used as shadow of the start tab on the global TabBar (default None)
         end_tab_shadow    -- Tab widget used as shadow of the end tab on the global TabBar (default None)
         has_visualization -- if True the Segment will be visualized in the Pyplot widget (default False)
+        move_callback          -- see PlotControl.add_segment (default None)
+        mouse_release_callback -- see PlotControl.add_segment (default None)
+        global_shadow          -- if True a painted shadow is shown on the global TabBar (default False)
         """
         self.idx = idx
         self.sid = sid
@@ -420,6 +451,9 @@ class PlotControlSegment():
         self.start_tab_shadow = start_tab_shadow
         self.end_tab_shadow = end_tab_shadow
         self.has_visualization = has_visualization
+        self.move_callback = move_callback
+        self.mouse_release_callback = mouse_release_callback
+        self.global_shadow = global_shadow
         self.is_visible = True
     def to_sdms(self):
         """
@@ -463,8 +497,16 @@ class PlotControl(QtGui.QWidget):
     same coordinate system as the SensorPyplotView. The global TabBar works with
     global coordinates and includes by default a (black) segment that can be used
     to set the display section of the plot (and thus of the local TabBar).
+
+    With painted segments the local segments have no Tab widgets: the TabBars
+    paint the segment bounds and the shadows themselves, and only the segment
+    closest to the mouse on the local TabBar gets Tab widgets as handles. This
+    keeps the number of widgets constant for any number of segments.
     """
-    def __init__(self,view,include_animation_control=True,attention_mode=True):
+    HANDLE_DISTANCE = 8 # pixels around the mouse in which a painted segment bound becomes a handle
+    OVERVIEW_DELAY = 250 # ms by which rebuilds of the painted shadows are coalesced, e.g. while dragging
+
+    def __init__(self,view,include_animation_control=True,attention_mode=True,painted_segments=False):
         """
         Creates a new PlotControl widget that will control the given SensorPyplotView
 
@@ -477,6 +519,8 @@ class PlotControl(QtGui.QWidget):
         Keyword-Arguments:
         include_animation_control -- if True, the widget will contain GUI elements to control
                                  the animation of plot data (default True)
+        painted_segments       -- if True, local segments are painted by the TabBars instead of
+                                  being Tab widgets (default False)
         """
         QtGui.QWidget.__init__(self)
         self.include_animation_control = include_animation_control
@@ -489,6 +533,12 @@ class PlotControl(QtGui.QWidget):
         self.counter = 0
         self.counter_t = 0
         self.local_segments = {}
+        self.local_segment_index = SegmentStore() # local segments by position, for culling
+        self.shown_segments = set() # sids of local segments whose tabs may be visible
+        self.painted_segments = painted_segments
+        self.handle_sid = None # painted segment that currently has Tab widgets
+        self.overview = None # cached painted shadows of the global TabBar
+        self.overview_pending = False
         self.global_segments = {}
         self.local_tabs = {}
         self.global_tabs = {}
@@ -512,6 +562,10 @@ class PlotControl(QtGui.QWidget):
         self.local_bar.setMinimumSize(100,15)
         self.global_bar = TabBar('global')
         self.global_bar.setMinimumSize(100,15)
+        if painted_segments :
+            self.local_bar.setMouseTracking(True)
+            self.local_bar.marker_source = self._local_markers
+            self.global_bar.marker_source = self._global_markers
         self.axislayout = AxisLayout(self.view)
         self.start_button = QtGui.QPushButton("Play")
         self.stop_button = QtGui.QPushButton("Stop")
@@ -603,6 +657,7 @@ class PlotControl(QtGui.QWidget):
             self.start_button.clicked.connect(self._play_pause)
             self.stop_button.clicked.connect(self._stop)
         self.local_bar.mouse_released.connect(self._lb_mouse_release)
+        self.local_bar.mouse_moved.connect(self._lb_mouse_moved)
         self.global_bar.mouse_released.connect(self._gb_mouse_release)
         self.yauto_button.clicked.connect(self._autoresizey)
         self.view.ylim_changed.connect(self._ylim_changed)
@@ -742,6 +797,8 @@ class PlotControl(QtGui.QWidget):
             xseg.end_tab.raise_()
 
     def _xlim_tab_moved(self,idx,sid,start=None,end=None):
+        # with a summary pyramid the whole recording can be shown at once
+        if self.model.has_summary() : return
         xmin, xmax = self.get_xlim()
         if start != None :
             if xmax-start > self.max_xspan :
@@ -785,9 +842,11 @@ class PlotControl(QtGui.QWidget):
                     adjust(s.end_tab,s.end)
                 for t in self.local_tabs.values() :
                     adjust(t.shadow_tab,t.pos)
-                for s in self.local_segments.values() :
-                    adjust(s.start_tab_shadow,s.start)
-                    adjust(s.end_tab_shadow,s.end)
+                if not self.painted_segments : # painted segments have no shadow tabs, the overview is redrawn below
+                    for s in self.local_segments.values() :
+                        adjust(s.start_tab_shadow,s.start)
+                        adjust(s.end_tab_shadow,s.end)
+                self._painted_segments_changed()
         finally :
             self.xspan = nxspan
     def _get_data_size(self):
@@ -835,31 +894,151 @@ class PlotControl(QtGui.QWidget):
         self._update_tab_visibility(i,j)
     def _update_tab_visibility(self,xmin,xmax):
         in_display_area = lambda x : x >= xmin and x <= xmax
-        for seg in self.local_segments.values() :
-            seg.start_tab.setVisible(in_display_area(seg.start) and seg.is_visible)
-            seg.end_tab.setVisible(in_display_area(seg.end) and seg.is_visible)
-            if seg.start_tab.isVisible() :
-                seg.start_tab.set_rel_pos(self._abstorel(seg.start, "local"))
-            if seg.end_tab.isVisible() :
-                seg.end_tab.set_rel_pos(self._abstorel(seg.end, "local"))
+        if self.painted_segments :
+            if self.handle_sid in self.local_segments :
+                self._place_segment_tabs(self.local_segments[self.handle_sid], xmin, xmax)
+            self.local_bar.update()
+        else :
+            visible = self.local_segment_index.overlapping(xmin, xmax)
+            shown = set(seg.sid for seg in visible)
+            for sid in self.shown_segments - shown :
+                if sid in self.local_segments :
+                    self.local_segments[sid].start_tab.setVisible(False)
+                    self.local_segments[sid].end_tab.setVisible(False)
+            self.shown_segments = shown
+            for seg in visible :
+                self._place_segment_tabs(seg, xmin, xmax)
         for tab in self.local_tabs.values() :
             tab.tab.setVisible(in_display_area(tab.pos))
             if tab.tab.isVisible() :
                 tab.tab.set_rel_pos(self._abstorel(tab.pos, "local"))
 
+    def _place_segment_tabs(self,seg,xmin,xmax):
+        in_display_area = lambda x : x >= xmin and x <= xmax
+        seg.start_tab.setVisible(in_display_area(seg.start) and seg.is_visible)
+        seg.end_tab.setVisible(in_display_area(seg.end) and seg.is_visible)
+        if seg.start_tab.isVisible() :
+            seg.start_tab.set_rel_pos(self._abstorel(seg.start, "local"))
+        if seg.end_tab.isVisible() :
+            seg.end_tab.set_rel_pos(self._abstorel(seg.end, "local"))
+
+    def _painted_segments_changed(self):
+        if not self.painted_segments : return
+        self.local_bar.update()
+        if not self.overview_pending :
+            self.overview_pending = True
+            QtCore.QTimer.singleShot(self.OVERVIEW_DELAY, self._refresh_overview)
+
+    def _refresh_overview(self):
+        self.overview_pending = False
+        self.overview = None
+        self.global_bar.update()
+
+    def _local_markers(self):
+        """
+        Returns the painted tabs of the local TabBar: the visible bounds of all segments
+        in the display area except the segment that has Tab widgets as handles.
+        """
+        markers = []
+        if self.model is None or self.model.get_sensordata() is None : return markers
+        xmin,xmax = self.get_xlim()
+        for seg in self.local_segment_index.overlapping(xmin, xmax) :
+            if not seg.is_visible or not seg.start_tab is None : continue
+            for x in (seg.start, seg.end) :
+                if x >= xmin and x <= xmax :
+                    markers.append((self._abstorel(x, "local"), seg.color))
+        return markers
+
+    def _global_markers(self):
+        """
+        Returns the painted shadows of the global TabBar, at most one per pixel column.
+        """
+        if self.model is None or self.model.get_sensordata() is None : return []
+        key = (self.global_bar.width(), self._get_data_size())
+        if self.overview is None or self.overview[0] != key :
+            segments, starts, ends = self.local_segment_index.arrays()
+            shown = np.array([seg.global_shadow and seg.is_visible for seg in segments], dtype=bool)
+            bounds = np.concatenate((starts[shown], ends[shown]))
+            owners = np.concatenate((np.flatnonzero(shown), np.flatnonzero(shown)))
+            width = max(1, key[0])
+            columns, first = np.unique(np.floor(bounds * width / key[1]).astype(np.int64), return_index=True)
+            markers = [(1.0 * c / width, self._get_pale_color(segments[owners[i]].color)) for c, i in zip(columns, first)]
+            self.overview = (key, markers)
+        return self.overview[1]
+
+    def _lb_mouse_moved(self,evt,relx):
+        """
+        Turns the painted segment closest to the mouse into a handle with Tab widgets.
+        """
+        if not self.painted_segments or evt.buttons() != QtCore.Qt.NoButton : return
+        if self.model is None or self.model.get_sensordata() is None : return
+        x = self._reltoabs(relx, "local")
+        xmin,xmax = self.get_xlim()
+        tolerance = self.HANDLE_DISTANCE * float(xmax - xmin) / max(1, self.local_bar.width())
+        closest = None
+        distance = None
+        for seg in self.local_segment_index.overlapping(x - tolerance, x + tolerance) :
+            if not seg.is_visible : continue
+            d = min(abs(seg.start - x), abs(seg.end - x))
+            if d <= tolerance and (distance is None or d < distance) :
+                closest,distance = seg,d
+        sid = None if closest is None else closest.sid
+        if sid != self.handle_sid :
+            self._set_handle(sid)
+
+    def _set_handle(self,sid):
+        """
+        Moves the Tab widgets of the painted segments to another segment.
+
+        Arguments:
+        sid -- id of the local segment that gets the handles, None removes them
+        """
+        if self.handle_sid in self.local_segments :
+            seg = self.local_segments[self.handle_sid]
+            for tab in (seg.start_tab, seg.end_tab) :
+                if not tab is None : tab.setParent(None)
+            seg.start_tab,seg.end_tab = None,None
+        self.handle_sid = sid
+        if sid in self.local_segments :
+            seg = self.local_segments[sid]
+            self._create_segment_tabs(seg, self.local_bar)
+            xmin,xmax = self.get_xlim()
+            self._place_segment_tabs(seg, xmin, xmax)
+        self.local_bar.update()
+
+    def _create_segment_tabs(self,seg,bar):
+        """
+        Creates the start and end Tab widgets of a segment on a TabBar.
+        """
+        idx,sid = seg.idx,seg.sid
+        start,end = Tab(),Tab()
+        start.h = 15; start.setColor(seg.color)
+        end.h = 15; end.setColor(seg.color)
+        start.always_left_of(end)
+        end.always_right_of(start)
+        start.setParent(bar)
+        end.setParent(bar)
+        start.moved_by_user.connect(lambda relx : self._tab_moved_by_user(idx, sid, seg.move_callback, relx, "start"))
+        end.moved_by_user.connect(lambda relx : self._tab_moved_by_user(idx, sid, seg.move_callback, relx, "end"))
+        start.mouse_released.connect(lambda evt : self._mouse_released_on_tab(sid, seg.mouse_release_callback, evt, "start"))
+        end.mouse_released.connect(lambda evt : self._mouse_released_on_tab(sid, seg.mouse_release_callback, evt, "end"))
+        seg.start_tab,seg.end_tab = start,end
+
     def _autoresizey(self):
-        ymin = 0
-        ymax = 1
         chans = self.model.get_visible_channels()
         xmin,xmax = self.get_xlim()
-        o = self.model.get_data_offset()
-        if len(chans) > 0 :
-            cymin = [min(c.get_data()[xmin-o:xmax-o]) for c in chans]
-            cymax = [max(c.get_data()[xmin-o:xmax-o]) for c in chans]
-            ymin = min(cymin)
-            ymax = max(cymax)
-            ymin = ymin - 0.01 * (ymax - ymin)
-            ymax = ymax + 0.01 * (ymax - ymin)
+        if len(chans) == 0 :
+            self.model.worker.cancel((self, 'yspan'))
+            self.view.set_ylim(0,1)
+            return
+        # the y range is scanned in the data worker of the model
+        self.model.worker.submit((self, 'yspan'), self.model.yspan_reader(xmin, xmax, chans), self._set_yspan)
+
+    def _set_yspan(self, span):
+        ymin, ymax = span
+        if not np.isfinite(ymin) or not np.isfinite(ymax) : ymin, ymax = 0, 1
+        ymin = ymin - 0.01 * (ymax - ymin)
+        ymax = ymax + 0.01 * (ymax - ymin)
         self.view.set_ylim(ymin,ymax)
 
     def set_model(self,model):
@@ -1000,6 +1179,10 @@ class PlotControl(QtGui.QWidget):
         elif sid in self.local_segments :
             seg = self.local_segments[sid]
             del self.local_segments[sid]
+            self.local_segment_index.remove(sid)
+            self.shown_segments.discard(sid)
+            if sid == self.handle_sid : self.handle_sid = None
+            self._painted_segments_changed()
         else : return
         start,end = seg.start_tab,seg.end_tab
         shadow_start,shadow_end = seg.start_tab_shadow,seg.end_tab_shadow
@@ -1055,23 +1238,19 @@ class PlotControl(QtGui.QWidget):
         Returns:
         The segment id that has been assigned to the new tab (identical to sid if sid is not None)
         """
-        start,end = Tab(),Tab()
         if sid is None :
             self.counter += 1
             sid = self.counter
         else :
             if sid in self.local_segments or sid in self.global_segments :
                 raise Exception("Duplicate segment id %d" % sid)
-        start.h = 15; start.setColor(color)
-        end.h = 15; end.setColor(color)
-        start.always_left_of(end)
-        end.always_right_of(start)
-        shadow_start = None
-        shadow_end = None
+        seg = PlotControlSegment(idx, sid, startx, endx, None, None, color, has_visualization=has_visualization,
+                                 move_callback=move_callback, mouse_release_callback=mouse_release_callback,
+                                 global_shadow=global_shadow)
         if domain == "local" :
-            start.setParent(self.local_bar)
-            end.setParent(self.local_bar)
-            if global_shadow :
+            if not self.painted_segments :
+                self._create_segment_tabs(seg, self.local_bar)
+            if global_shadow and not self.painted_segments :
                 shadow_start,shadow_end = Tab(),Tab()
                 shadow_start.h = 15; shadow_end.h = 15
                 pale_color = self._get_pale_color(color)
@@ -1085,22 +1264,14 @@ class PlotControl(QtGui.QWidget):
                 shadow_end.lower()
                 shadow_start.show()
                 shadow_end.show()
-            seg = PlotControlSegment(idx, sid, startx, endx, start, end, color, shadow_start, shadow_end, has_visualization)
+                seg.start_tab_shadow,seg.end_tab_shadow = shadow_start,shadow_end
             self.local_segments[sid] = seg
+            self.local_segment_index.add(seg)
         elif domain == "global" :
-            start.setParent(self.global_bar)
-            end.setParent(self.global_bar)
-            seg = PlotControlSegment(idx, sid, startx, endx, start, end, color, shadow_start, shadow_end, has_visualization)
-            start.show()
-            end.show()
+            self._create_segment_tabs(seg, self.global_bar)
+            seg.start_tab.show()
+            seg.end_tab.show()
             self.global_segments[sid] = seg
-        cbs = lambda relx : self._tab_moved_by_user(idx, sid, move_callback, relx, "start")
-        cbe = lambda relx : self._tab_moved_by_user(idx, sid, move_callback, relx, "end")
-        start.moved_by_user.connect(cbs)
-        end.moved_by_user.connect(cbe)
-
-        start.mouse_released.connect(lambda evt : self._mouse_released_on_tab(sid, mouse_release_callback, evt, "start"))
-        end.mouse_released.connect(lambda evt : self._mouse_released_on_tab(sid, mouse_release_callback, evt, "end"))
 
         if has_visualization :
             vis_color = self._get_pale_color(seg.color,sat=0.3,val=1)
@@ -1177,6 +1348,10 @@ class PlotControl(QtGui.QWidget):
                 rx = self._abstorel(corrected,domain)
                 seg.end_tab.set_rel_pos(rx)
                 seg.end = corrected
+        if not seg is None and domain == "local" :
+            self.local_segment_index.move(sid)
+            self.shown_segments.add(sid)
+            self._painted_segments_changed()
 
         if not seg is None and seg.has_visualization : self.view.update_segment(seg.to_sdms())
         if not move_callback is None :
@@ -1221,23 +1396,28 @@ class PlotControl(QtGui.QWidget):
             start_tab,end_tab = seg.start_tab,seg.end_tab
             start_shadow,end_shadow = seg.start_tab_shadow,seg.end_tab_shadow
             if not end is None :
-                relend = self._abstorel(end,"local")
-                end_tab.set_rel_pos(relend)
+                if not end_tab is None :
+                    relend = self._abstorel(end,"local")
+                    end_tab.set_rel_pos(relend)
                 seg.end = end
                 if not end_shadow is None :
                     relend_s = self._abstorel(end,"global")
                     end_shadow.set_rel_pos(relend_s)
             if not start is None :
-                relstart = self._abstorel(start,"local")
-                start_tab.set_rel_pos(relstart)
+                if not start_tab is None :
+                    relstart = self._abstorel(start,"local")
+                    start_tab.set_rel_pos(relstart)
                 seg.start = start
                 if not start_shadow is None :
                     relstart_s = self._abstorel(start,"global")
                     start_shadow.set_rel_pos(relstart_s)
+            self.local_segment_index.move(sid)
+            self.shown_segments.add(sid)
+            self._painted_segments_changed()
         if not seg is None :
             if seg.has_visualization :
                 self.view.update_segment(seg.to_sdms())
-            if not self.get_xlim() is None :
+            if not seg.start_tab is None and not self.get_xlim() is None :
                 xmin,xmax = self.get_xlim()
                 in_display_area = lambda x : x >= xmin and x <= xmax
                 seg.start_tab.setVisible(in_display_area(seg.start))
@@ -1323,8 +1503,9 @@ class PlotControl(QtGui.QWidget):
             seg = self.global_segments[sid]
         if not seg is None :
             seg.color = color
-            seg.start_tab.setColor(color)
-            seg.end_tab.setColor(color)
+            if not seg.start_tab is None :
+                seg.start_tab.setColor(color)
+                seg.end_tab.setColor(color)
             if not seg.start_tab_shadow is None :
                 seg.start_tab_shadow.setColor(self._get_pale_color(color))
             if not seg.end_tab_shadow is None :
@@ -1332,6 +1513,7 @@ class PlotControl(QtGui.QWidget):
             if seg.has_visualization :
                 vis_color = self._get_pale_color(color, sat=0.3, val=1)
                 self.view.set_segment_color(seg.sid,(vis_color.red(),vis_color.green(),vis_color.blue()))
+            self._painted_segments_changed()
 
     def set_segment_visible(self,sid,visible):
         """
@@ -1347,9 +1529,10 @@ class PlotControl(QtGui.QWidget):
         in_display_area = lambda x : x >= xmin and x <= xmax
         if sid in self.local_segments :
             seg = self.local_segments[sid]
-            if in_display_area(seg.start) :
+            self.shown_segments.add(sid)
+            if in_display_area(seg.start) and not seg.start_tab is None :
                 seg.start_tab.setVisible(visible)
-            if in_display_area(seg.end) :
+            if in_display_area(seg.end) and not seg.end_tab is None :
                 seg.end_tab.setVisible(visible)
         elif sid in self.global_segments :
             seg = self.global_segments[sid]
@@ -1362,6 +1545,7 @@ class PlotControl(QtGui.QWidget):
         if seg.has_visualization :
             self.view.set_segment_visible(sid,visible)
         seg.is_visible = visible
+        self._painted_segments_changed()
 
     def clear_segments(self):
         """
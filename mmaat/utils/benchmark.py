@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+'''
+ DFKI GmbH 2013 - 20xx
+ All rights reserved.
+ Maintainer: Markus Weber
+'''
+import mmaat.data as data
+import mmaat.utils.io as io
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+def write_synthetic_csv(fname, rows=100000, cols=200):
+    '''
+        Writes a wide numeric csv export as produced by the Leap/Kinect recorders.
+        :Parameters:
+            fname - path to csv file
+            rows  - number of samples
+            cols  - number of features
+    '''
+    values = np.random.randn(rows, cols) * 100
+    with open(fname, 'w') as csvfile :
+        csvfile.write(','.join(['feature{0}'.format(i) for i in xrange(cols)]))
+        csvfile.write('\n')
+        np.savetxt(csvfile, values, fmt='%.6f', delimiter=',')
+
+def benchmark_csv_parsers(fname, block_size=data.CSV_BLOCK_SIZE):
+    '''
+        Compares the row wise csv parser with the bulk block parser.
+        :Parameters:
+            fname      - path to csv file
+            block_size - number of lines per block
+        :Returns:
+            (rows, seconds row wise, seconds bulk)
+    '''
+    with open(fname, 'rb') as csvfile :
+        lines = csvfile.readlines()[1:]
+    st = time.time()
+    for b in xrange(0, len(lines), block_size) :
+        data._parse_csv_rows(lines[b:b + block_size])
+    t_rows = time.time() - st
+    st = time.time()
+    for b in xrange(0, len(lines), block_size) :
+        data.parse_csv_block(lines[b:b + block_size])
+    t_bulk = time.time() - st
+    return len(lines), t_rows, t_bulk
+
+def benchmark_csv_import(fname, block_size=data.CSV_BLOCK_SIZE):
+    '''
+        Measures the time of a complete csv to HDF5 import.
+        :Parameters:
+            fname      - path to csv file
+            block_size - number of lines per block
+        :Returns:
+            seconds
+    '''
+    fname_out = os.path.join(tempfile.mkdtemp(), 'benchmark.h5')
+    st = time.time()
+    data.convert_csv_to_hdf(fname, fname_out, block_size=block_size)
+    return time.time() - st
+
+if __name__ == "__main__" :
+    options = io.read_commandline(sys.argv[1:], short="hi:r:c:b:", long_des=["help", "input=", "rows=", "cols=", "block="])
+    if options.has_option(["h", "help"]) :
+        print "benchmark.py [-i csvfile] [-r rows] [-c cols] [-b blocksize]"
+        sys.exit(0)
+    fname = options.option(["i", "input"], None)
+    block_size = int(options.option(["b", "block"], data.CSV_BLOCK_SIZE))
+    if fname is None :
+        fname = os.path.join(tempfile.mkdtemp(), 'benchmark.csv')
+        write_synthetic_csv(fname, int(options.option(["r", "rows"], 100000)), int(options.option(["c", "cols"], 200)))
+    rows, t_rows, t_bulk = benchmark_csv_parsers(fname, block_size)
+    print "rows             : {0}".format(rows)
+    print "row wise parser  : {0:.3f}s ({1:.0f} rows/s)".format(t_rows, rows / t_rows)
+    print "bulk parser      : {0:.3f}s ({1:.0f} rows/s)".format(t_bulk, rows / t_bulk)
+    print "speedup          : {0:.1f}x".format(t_rows / t_bulk)
+    print "complete import  : {0:.3f}s".format(benchmark_csv_import(fname, block_size))
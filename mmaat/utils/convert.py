@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''
+ DFKI GmbH 2013 - 20xx
+ All rights reserved.
+ Maintainer: Markus Weber
+'''
+import h5py as h5
+import mmaat.data as data
+import mmaat.utils.io as io
+import sys
+
+USAGE = '''convert.py [options] file.h5 [file.h5 ...]
+       convert.py -s signature_dir [signature_dir ...]
+
+Rewrites recordings in place or packs hand signature directories.
+
+Options:
+    -p, --profile=NAME  storage profile ({profiles}), default: {default}
+    -l, --layout=NAME   signal layout ({layouts}), default: keep the layout of the file
+    -g, --group=N       channels per dataset of the column layout, default: {group_size}
+    -s, --signatures    pack the csv files of signature directories into one container each
+    -t, --target        write the dense 'target' dataset from the stored label intervals
+    -y, --pyramid       write the min/max/mean summary pyramid next to each file
+    -h, --help          show this help
+'''
+
+def repack_files(fnames, profile=None, layout=None, group_size=None):
+    '''
+        Re-packs data files in place with a storage profile and signal layout.
+        :Parameters:
+            fnames     - list of HDF5 files
+            profile    - name of the storage profile
+            layout     - signal layout, None keeps the layout of each file
+            group_size - channels per dataset of the column layout
+    '''
+    for fname in fnames :
+        print "Repacking {0} ({1}{2})".format(fname, profile if profile is not None else data.STORAGE_PROFILE,
+                                              '' if layout is None else ', {0} layout'.format(layout))
+        data.repack_hdf(fname, profile, layout=layout, group_size=group_size)
+
+def pack_signature_dirs(dnames, profile=None):
+    '''
+        Packs hand signature directories into containers next to them.
+        :Parameters:
+            dnames  - list of signature directories
+            profile - name of the storage profile
+    '''
+    for dname in dnames :
+        print "Packing {0} -> {1}".format(dname, data.pack_signatures(dname, profile=profile))
+
+def materialize_targets(fnames, profile=None):
+    '''
+        Writes the dense target of recordings whose labels are stored as intervals.
+        :Parameters:
+            fnames  - list of HDF5 files
+            profile - name of the storage profile
+    '''
+    for fname in fnames :
+        print "Writing target of {0}".format(fname)
+        h5_file = h5.File(fname, 'a')
+        try :
+            data.materialize_target(h5_file, profile)
+        finally :
+            h5_file.close()
+
+def build_pyramids(fnames, profile=None):
+    '''
+        Writes the summary pyramids used by the viewer to draw long ranges.
+        :Parameters:
+            fnames  - list of HDF5 files
+            profile - name of the storage profile
+    '''
+    for fname in fnames :
+        print "Summarizing {0} -> {1}".format(fname, data.build_pyramid(fname, profile=profile))
+
+if __name__ == "__main__" :
+    options = io.read_commandline(sys.argv[1:], short="hstyp:l:g:", long_des=["help", "signatures", "target", "pyramid", "profile=", "layout=", "group="])
+    if options.has_option(["h", "help"]) or len(options.arguments) == 0 :
+        print USAGE.format(profiles=', '.join(sorted(data.STORAGE_PROFILES.keys())), default=data.STORAGE_PROFILE,
+                           layouts=', '.join(data.SIGNAL_LAYOUTS), group_size=data.CHANNEL_GROUP_SIZE)
+        sys.exit(0)
+    if options.has_option(["s", "signatures"]) :
+        pack_signature_dirs(options.arguments, options.option(["p", "profile"], None))
+        sys.exit(0)
+    if options.has_option(["t", "target"]) :
+        materialize_targets(options.arguments, options.option(["p", "profile"], None))
+        sys.exit(0)
+    if options.has_option(["y", "pyramid"]) :
+        build_pyramids(options.arguments, options.option(["p", "profile"], None))
+        sys.exit(0)
+    group_size = options.option(["g", "group"], None)
+    repack_files(options.arguments, options.option(["p", "profile"], None), options.option(["l", "layout"], None),
+                 None if group_size is None else int(group_size))
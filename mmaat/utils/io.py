@@ -134,7 +134,7 @@ def read_commandline(args, short="chdl:i:o:b:",
                 o = o[1:]
             option.add_options(o, a)
         for a in args :
-            option.add_argument(a)
+            option.set_arguments(a)
     except getopt.GetoptError, err:
         # print help information and exit:
         print "ERROR : {0}".format(str(err)) # will print something like "option -a not recognized"